@@ -0,0 +1,120 @@
+"""
+Peak memory and time of common average referencing: the previous
+implementation (several full copies of the signals) against the block-wise
+`subtract_CAR`, returning a new array or referencing in place, the
+per-device loop against the grouped reference of `subtract_CAR_by_device`,
+and common median reference with np.nanmedian against `subtract_CMR`.
+
+Usage: python bench_car.py --channels 256 --duration 600 --devices 8
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from ecogvis.signal_processing.common_referencing import subtract_CAR, \
+    subtract_CAR_by_device, subtract_CMR
+
+
+def subtract_CAR_copies(X, b_size=16):
+    """Previous implementation of `subtract_CAR` (without bad channels)."""
+    X_car = X.copy()
+    channels, time_points = X.shape
+    s = channels // b_size
+    r = channels % b_size
+    X_1 = X[:channels - r].copy().reshape((s, b_size, time_points))
+    X_1car = X_car[:channels - r].copy().reshape((s, b_size, time_points))
+    X_1 -= np.nanmean(X_1car, axis=1, keepdims=True)
+    if r > 0:
+        X_2 = X[channels - r:].copy()
+        X_2 -= np.nanmean(X_car[channels - r:].copy(), axis=0, keepdims=True)
+        return np.vstack([X_1.reshape((s * b_size, time_points)), X_2])
+    return X_1.reshape((s * b_size, time_points))
+
+
+def subtract_CAR_by_device_loop(X, elec_info):
+    """Previous loop of `subtract_CAR_by_device` (mean across channels)."""
+    new_X = np.copy(X)
+    for elec_device in elec_info.group_name.unique():
+        elec_idx = elec_info.loc[
+            elec_info.group_name == elec_device].index.values
+        cur_X = np.copy(X[elec_idx, :])
+        cur_X -= np.nanmean(cur_X, axis=0, keepdims=True)
+        new_X[elec_idx, :] = cur_X
+    return new_X
+
+
+def subtract_CMR_nanmedian(X, b_size=16):
+    """Common median reference of channel blocks with np.nanmedian."""
+    new_X = np.empty_like(X)
+    for c0 in range(0, X.shape[0], b_size):
+        group = X[c0:c0 + b_size]
+        new_X[c0:c0 + b_size] = group - np.nanmedian(group, axis=0)
+    return new_X
+
+
+def measure(func, X):
+    tracemalloc.start()
+    start = time.time()
+    Y = func(X)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return Y, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=600.)
+    parser.add_argument('--rate', type=float, default=400.)
+    parser.add_argument('--b-size', type=int, default=16)
+    parser.add_argument('--devices', type=int, default=8)
+    args = parser.parse_args()
+
+    n_time = int(args.duration * args.rate)
+    X = np.random.RandomState(0).randn(args.channels, n_time)
+    print('signals: {:.0f} MB'.format(X.nbytes / 2**20))
+
+    Xref, elapsed, peak = measure(
+        lambda X: subtract_CAR_copies(X, args.b_size), X)
+    print('{:>10} {:>8.2f} s {:>8.0f} MB'.format('copies', elapsed,
+                                                 peak / 2**20))
+
+    Y, elapsed, peak = measure(lambda X: subtract_CAR(X, args.b_size), X)
+    print('{:>10} {:>8.2f} s {:>8.0f} MB  (max abs diff {:.1e})'.format(
+        'new array', elapsed, peak / 2**20, np.abs(Y - Xref).max()))
+    del Y
+
+    Y, elapsed, peak = measure(
+        lambda X: subtract_CAR(X, args.b_size, out=X), X.copy())
+    print('{:>10} {:>8.2f} s {:>8.0f} MB  (max abs diff {:.1e})'.format(
+        'in place', elapsed, peak / 2**20, np.abs(Y - Xref).max()))
+    del Y
+
+    # devices of interleaved channels
+    elec_info = pd.DataFrame({'group_name': [
+        'device{}'.format(ch % args.devices) for ch in range(args.channels)]})
+    Xref, elapsed, peak = measure(
+        lambda X: subtract_CAR_by_device_loop(X, elec_info), X)
+    print('{:>10} {:>8.2f} s {:>8.0f} MB'.format('dev. loop', elapsed,
+                                                 peak / 2**20))
+    Y, elapsed, peak = measure(
+        lambda X: subtract_CAR_by_device(X, elec_info), X)
+    print('{:>10} {:>8.2f} s {:>8.0f} MB  (max abs diff {:.1e})'.format(
+        'grouped', elapsed, peak / 2**20, np.abs(Y - Xref).max()))
+
+    Xref, elapsed, peak = measure(
+        lambda X: subtract_CMR_nanmedian(X, args.b_size), X)
+    print('{:>10} {:>8.2f} s {:>8.0f} MB'.format('nanmedian', elapsed,
+                                                 peak / 2**20))
+    Y, elapsed, peak = measure(
+        lambda X: subtract_CMR(X, args.b_size, out=X), X.copy())
+    print('{:>10} {:>8.2f} s {:>8.0f} MB  (max abs diff {:.1e})'.format(
+        'CMR', elapsed, peak / 2**20, np.abs(Y - Xref).max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Write time, file size and read times of a (n_time, n_channels) float32 LFP
+dataset with different HDF5 layouts (see `storage`): contiguous, the default
+chunking of h5py, and chunks of a few seconds by a few channels with and
+without compression.
+
+Two read patterns of the GUI are timed, each on a newly opened file:
+- viewer: windows of 2 s by 16 channels at random times, read twice as by
+  `TimeSeriesPlotter` (scale and plotted data),
+- ERP: epochs of 2 s of one channel around each event, for all channels, as
+  by the ERP dialog.
+
+Usage: python bench_chunk_layout.py --channels 128 --duration 600
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from ecogvis.signal_processing.storage import storage_chunks, \
+    storage_options
+
+gzip = {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}
+layouts = [
+    ('contiguous', {'chunk_duration': None}),
+    ('h5py auto gzip', 'auto'),
+    ('0.5 s x 16', {'chunk_duration': .5}),
+    ('1 s x 16', {}),
+    ('2 s x 16', {'chunk_duration': 2.}),
+    ('5 s x 16', {'chunk_duration': 5.}),
+    ('1 s x 1', {'chunk_channels': 1}),
+    ('1 s x 64', {'chunk_channels': 64}),
+    ('1 s x 16 gzip1', gzip),
+    ('5 s x 16 gzip1', dict(gzip, chunk_duration=5.)),
+    ('1 s x 16 gzip1 -sh', dict(gzip, shuffle=False)),
+    ('1 s x 16 gzip4', dict(gzip, compression_opts=4)),
+    ('1 s x 16 lzf', {'compression': 'lzf', 'shuffle': True}),
+]
+
+
+def lfp_like(n_time, n_channels, rate, seed=0):
+    """1/f noise in volts, as float32 (compresses like real LFP)."""
+    rng = np.random.RandomState(seed)
+    data = np.empty((n_time, n_channels), dtype='float32')
+    for c0 in range(0, n_channels, 16):
+        c1 = min(c0 + 16, n_channels)
+        noise = np.fft.rfft(rng.randn(n_time, c1 - c0), axis=0)
+        noise /= np.maximum(np.fft.rfftfreq(n_time, 1. / rate), 1.)[:, None]
+        data[:, c0:c1] = 1e-4 * np.fft.irfft(noise, n=n_time, axis=0)
+    return data
+
+
+def write(path, data, rate, storage):
+    if storage == 'auto':
+        kwargs = {'chunks': True, 'compression': 'gzip'}
+    else:
+        options = storage_options(storage)
+        kwargs = {'chunks': storage_chunks(data.shape, rate, options),
+                  'compression': options['compression'],
+                  'compression_opts': options['compression_opts'],
+                  'shuffle': options['shuffle'] or None}
+    start = time.time()
+    with h5py.File(path, 'w') as f:
+        dset = f.create_dataset('data', data=data, **kwargs)
+        chunks = dset.chunks
+    return time.time() - start, chunks
+
+
+def read_viewer(path, windows, n_win):
+    with h5py.File(path, 'r') as f:
+        dset = f['data']
+        start = time.time()
+        for t0, c0 in windows:
+            channels = np.arange(c0, c0 + 16)
+            np.std(dset[t0:t0 + n_win, channels], axis=0)
+            dset[t0:t0 + n_win, channels].T
+        return time.time() - start
+
+
+def read_erp(path, events, n_half):
+    with h5py.File(path, 'r') as f:
+        dset = f['data']
+        start = time.time()
+        for ch in range(dset.shape[1]):
+            Y = np.zeros((len(events), 2 * n_half))
+            for tr, t in enumerate(events):
+                if dset[t - n_half:t + n_half, ch].shape[0] == Y.shape[1]:
+                    Y[tr, :] = dset[t - n_half:t + n_half, ch]
+        return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=128)
+    parser.add_argument('--duration', type=float, default=600.)
+    parser.add_argument('--rate', type=float, default=400.)
+    parser.add_argument('--windows', type=int, default=100)
+    parser.add_argument('--events', type=int, default=50)
+    args = parser.parse_args()
+
+    n_time = int(args.duration * args.rate)
+    data = lfp_like(n_time, args.channels, args.rate)
+    print('LFP ({}, {}): {:.0f} MB'.format(n_time, args.channels,
+                                           data.nbytes / 2**20))
+    rng = np.random.RandomState(1)
+    n_win = int(2 * args.rate)
+    windows = list(zip(rng.randint(0, n_time - n_win, args.windows),
+                       16 * rng.randint(0, args.channels // 16, args.windows)))
+    n_half = int(args.rate)
+    events = np.sort(rng.randint(n_half, n_time - n_half, args.events))
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench_layout.h5')
+    print('{:>20} {:>14} {:>8} {:>8} {:>8} {:>8}'.format(
+        'layout', 'chunks', 'MB', 'write', 'viewer', 'ERP'))
+    for name, storage in layouts:
+        elapsed, chunks = write(path, data, args.rate, storage)
+        size = os.path.getsize(path) / 2**20
+        viewer = read_viewer(path, windows, n_win)
+        erp = read_erp(path, events, n_half)
+        print('{:>20} {:>14} {:>8.0f} {:>7.2f}s {:>7.2f}s {:>7.2f}s'.format(
+            name, str(chunks), size, elapsed, viewer, erp))
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
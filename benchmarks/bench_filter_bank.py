@@ -0,0 +1,57 @@
+"""
+Per channel and per band Hilbert transforms (as previously done in
+`spectral_decomposition`) against the batched filter bank, with complex and
+real FFTs, with the 54 Chang lab bands.
+
+Usage: python bench_filter_bank.py --channels 16 --duration 60
+"""
+import argparse
+import time
+
+import numpy as np
+from process_nwb.wavelet_transform import gaussian
+
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.hilbert_transform import hilbert_transform, \
+    gaussian_filter_bank, hilbert_filter_bank
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=60.)
+    parser.add_argument('--rate', type=float, default=400.)
+    parser.add_argument('--max-bytes', type=int, default=2**28)
+    args = parser.parse_args()
+
+    n_time = int(args.duration * args.rate)
+    X = np.random.RandomState(0).randn(args.channels, n_time).astype('float32')
+    cfs, sds = chang_lab['cfs'], chang_lab['sds']
+
+    start = time.time()
+    Xloop = np.zeros((len(cfs), args.channels, n_time))
+    for ch in range(args.channels):
+        X_fft_h = None
+        for ii, (cf, sd) in enumerate(zip(cfs, sds)):
+            kernel = gaussian(n_time, args.rate, cf, sd)
+            Xh, X_fft_h = hilbert_transform(X[[ch]], args.rate, kernel,
+                                            X_fft_h=X_fft_h)
+            Xloop[ii, ch] = abs(Xh).astype('float32')
+    loop = time.time() - start
+    print('{:>12} {:>8.2f} s'.format('loop', loop))
+
+    filters = gaussian_filter_bank(n_time, args.rate, cfs, sds)
+    for name, kwargs in [('filter bank', {}),
+                         ('rfft c128', {'use_rfft': True}),
+                         ('rfft c64', {'use_rfft': True,
+                                       'dtype': 'complex64'})]:
+        start = time.time()
+        Xbank = hilbert_filter_bank(X, args.rate, filters,
+                                    max_bytes=args.max_bytes, **kwargs)
+        bank = time.time() - start
+        print('{:>12} {:>8.2f} s  (speedup {:.1f}x, max rel diff {:.1e})'.format(
+            name, bank, loop / bank, np.abs(Xbank - Xloop).max() / Xloop.max()))
+
+
+if __name__ == '__main__':
+    main()
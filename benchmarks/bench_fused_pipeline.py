@@ -0,0 +1,53 @@
+"""
+Two-step preprocessing and High Gamma estimation (`preprocess_raw_data`, then
+`high_gamma_estimation`, which reads the LFP back from the file) against the
+fused `preprocess_high_gamma`, on the example file of the tests scaled up.
+
+Usage: python bench_fused_pipeline.py --channels 64 --duration 300
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.processing_data import preprocess_raw_data, \
+    high_gamma_estimation, preprocess_high_gamma
+from synthetic import scale_example_nwb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=300.)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    two_step = os.path.join(folder, 'bench_two_step.nwb')
+    fused = os.path.join(folder, 'bench_fused.nwb')
+    scale_example_nwb(two_step, args.channels, args.duration)
+    scale_example_nwb(fused, args.channels, args.duration)
+
+    config = {'referencing': ('CAR', 16), 'Notch': 60, 'Downsample': 400.}
+    bands_vals = np.array([chang_lab['cfs'][29:37], chang_lab['sds'][29:37]])
+
+    start = time.time()
+    preprocess_raw_data(two_step, config)
+    high_gamma_estimation(two_step, bands_vals)
+    elapsed_two_step = time.time() - start
+
+    start = time.time()
+    preprocess_high_gamma(fused, config, bands_vals)
+    elapsed_fused = time.time() - start
+
+    print('{:>10} {:>8.2f} s'.format('two-step', elapsed_two_step))
+    print('{:>10} {:>8.2f} s  (speedup {:.1f}x)'.format(
+        'fused', elapsed_fused, elapsed_two_step / elapsed_fused))
+    os.remove(two_step)
+    os.remove(fused)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Time and output size of the spectral decomposition of a recording in the
+Chang lab bands, with all bands computed at the LFP rate against the
+multirate filter bank (see `multirate`), with the bands stored at their
+pyramid rate ('native') or upsampled back to the LFP rate ('common'), and
+the maximum difference of amplitude relative to the maximum amplitude of
+each band.
+
+Usage: python bench_multirate.py --channels 16 --duration 600
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.hilbert_transform import gaussian_filter_bank, \
+    hilbert_filter_bank
+from ecogvis.signal_processing.multirate import band_levels, \
+    multirate_filter_bank, upsample
+
+
+def full(X, rate, centers, sds):
+    filters = gaussian_filter_bank(X.shape[-1], rate, centers, sds)
+    return hilbert_filter_bank(X, rate, filters, use_rfft=True)
+
+
+def native(X, rate, centers, sds):
+    return [(level, bands, Xa) for level, bands, Xa in
+            multirate_filter_bank(X, rate, centers, sds)]
+
+
+def common(X, rate, centers, sds):
+    Xa = np.zeros((len(centers),) + X.shape, dtype='float32')
+    for level, bands, Za in multirate_filter_bank(X, rate, centers, sds,
+                                                  analytic=True):
+        Xa[bands] = abs(upsample(Za, 2**level, X.shape[-1]))
+    return Xa
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=600.)
+    parser.add_argument('--rate', type=float, default=400.)
+    args = parser.parse_args()
+
+    centers, sds = chang_lab['cfs'], chang_lab['sds']
+    n_time = int(args.duration * args.rate)
+    X = 1e6 * np.random.RandomState(0).randn(args.channels, n_time)
+    levels = band_levels(args.rate, centers, sds)
+    print('levels: {}'.format(', '.join(
+        '{} bands at {:g} Hz'.format(np.sum(levels == level),
+                                     args.rate / 2**level)
+        for level in np.unique(levels))))
+
+    start = time.time()
+    expected = full(X, args.rate, centers, sds)
+    t_full = time.time() - start
+    scale = abs(expected).max(axis=(1, 2))
+
+    print('{:>8} {:>9} {:>9} {:>10}'.format('mode', 'time', 'MB',
+                                            'max diff'))
+    print('{:>8} {:>8.2f}s {:>9.0f} {:>10}'.format(
+        'full', t_full, expected.nbytes / 2**20, '-'))
+
+    start = time.time()
+    out = native(X, args.rate, centers, sds)
+    elapsed = time.time() - start
+    diff = max((abs(Xa - expected[bands][..., ::2**level]).max(axis=(1, 2)) /
+                scale[bands]).max() for level, bands, Xa in out)
+    size = sum(Xa.nbytes for _, _, Xa in out)
+    print('{:>8} {:>8.2f}s {:>9.0f} {:>10.1e}'.format(
+        'native', elapsed, size / 2**20, diff))
+
+    start = time.time()
+    Xa = common(X, args.rate, centers, sds)
+    elapsed = time.time() - start
+    diff = (abs(Xa - expected).max(axis=(1, 2)) / scale).max()
+    print('{:>8} {:>8.2f}s {:>9.0f} {:>10.1e}'.format(
+        'common', elapsed, Xa.nbytes / 2**20, diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Per-channel notch filtering loop (as previously done in
+`preprocess_raw_data`) against the batched notch engine.
+
+Usage: python bench_notch.py --channels 256 --duration 600 --workers 4
+"""
+import argparse
+import time
+
+import numpy as np
+from process_nwb.linenoise_notch import apply_linenoise_notch as notch_channel
+
+from ecogvis.signal_processing.linenoise_notch import apply_linenoise_notch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=600.)
+    parser.add_argument('--rate', type=float, default=400.)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    n_time = int(args.duration * args.rate)
+    X = np.random.RandomState(0).randn(args.channels, n_time)
+
+    start = time.time()
+    Xloop = np.empty_like(X)
+    for ch in range(args.channels):
+        Xloop[ch] = notch_channel(X[ch].reshape(-1, 1), args.rate)[:, 0]
+    loop = time.time() - start
+    print('{:>10} {:>8.2f} s'.format('loop', loop))
+
+    start = time.time()
+    Xbatch = apply_linenoise_notch(X.T, args.rate, workers=args.workers).T
+    batch = time.time() - start
+    print('{:>10} {:>8.2f} s  (speedup {:.1f}x, max abs diff {:.1e})'.format(
+        'batched', batch, loop / batch, np.abs(Xbatch - Xloop).max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Spectral decomposition in the Chang lab bands stored at the LFP rate (400 Hz)
+against decimated output rates (see `output_rate` of
+`spectral_decomposition`), computed at the LFP rate or with the multirate
+filter bank: run time, size of the DecompositionSeries, and read time of
+viewer windows (2 s by 16 channels, all bands) and of ERP epochs (2 s of one
+channel and one band around each event), each on a newly opened file.
+
+Usage: python bench_output_rate.py --channels 64 --duration 300
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.processing_data import preprocess_raw_data, \
+    spectral_decomposition
+from synthetic import make_raw_nwb
+
+
+def read_viewer(path, windows, window):
+    with h5py.File(path, 'r') as f:
+        dset = f['processing/ecephys/DecompositionSeries/data']
+        rate = f['processing/ecephys/DecompositionSeries/starting_time'].attrs[
+            'rate']
+        n_win = int(window * rate)
+        start = time.time()
+        for t, c0 in windows:
+            t0 = int(t * rate)
+            dset[t0:t0 + n_win, c0:c0 + 16, :]
+        return time.time() - start
+
+
+def read_erp(path, events, half_window, n_channels):
+    with h5py.File(path, 'r') as f:
+        dset = f['processing/ecephys/DecompositionSeries/data']
+        rate = f['processing/ecephys/DecompositionSeries/starting_time'].attrs[
+            'rate']
+        n_half = int(half_window * rate)
+        start = time.time()
+        for ch in range(n_channels):
+            for t in events:
+                t0 = int(t * rate)
+                dset[t0 - n_half:t0 + n_half, ch, -1]
+        return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=300.)
+    parser.add_argument('--rates', type=float, nargs='+',
+                        default=[200., 100.])
+    parser.add_argument('--windows', type=int, default=100)
+    parser.add_argument('--events', type=int, default=20)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    raw = os.path.join(folder, 'bench_raw.nwb')
+    make_raw_nwb(raw, args.channels, args.duration)
+    preprocess_raw_data(raw, {'referencing': ('CAR', 16), 'Notch': 60,
+                              'Downsample': 400.})
+    raw_size = os.path.getsize(raw)
+    bands_vals = np.array([chang_lab['cfs'], chang_lab['sds']])
+
+    rng = np.random.RandomState(0)
+    windows = list(zip(rng.uniform(0, args.duration - 2., args.windows),
+                       16 * rng.randint(0, args.channels // 16, args.windows)))
+    events = np.sort(rng.uniform(1., args.duration - 1., args.events))
+
+    runs = [(None, None)] + [(rate, multirate) for rate in args.rates
+                             for multirate in [None, 'common']]
+    results = []
+    for output_rate, multirate in runs:
+        path = os.path.join(folder, 'bench_output_rate.nwb')
+        shutil.copy(raw, path)
+        start = time.time()
+        spectral_decomposition(path, bands_vals, dtype='complex64',
+                               multirate=multirate, output_rate=output_rate)
+        elapsed = time.time() - start
+        size = os.path.getsize(path) - raw_size
+        viewer = read_viewer(path, windows, 2.)
+        erp = read_erp(path, events, 1., args.channels)
+        results.append((output_rate, multirate, elapsed, size, viewer, erp))
+        os.remove(path)
+    os.remove(raw)
+
+    print('{:>8} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'rate', 'multirate', 'time', 'MB', 'viewer', 'ERP'))
+    for output_rate, multirate, elapsed, size, viewer, erp in results:
+        print('{:>8} {:>10} {:>8.2f}s {:>9.0f} {:>8.2f}s {:>8.2f}s'.format(
+            'LFP' if output_rate is None else '{:g} Hz'.format(output_rate),
+            str(multirate), elapsed, size / 2**20, viewer, erp))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Scaling of the channel-parallel downsampling of `preprocess_raw_data` with
+the number of processes.
+
+Usage: python bench_parallel_resample.py --channels 64 --duration 300
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from ecogvis.signal_processing.processing_data import _resample_parallel
+from process_nwb.resample import resample
+from synthetic import make_raw_nwb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=300.)
+    parser.add_argument('--rate', type=float, default=400.)
+    parser.add_argument('--max-jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench_raw.nwb')
+    make_raw_nwb(path, n_channels=args.channels, duration=args.duration)
+
+    with NWBHDF5IO(path, 'r') as io:
+        source = io.read().acquisition['raw']
+        T = int(np.ceil(source.data.shape[0] * args.rate / source.rate))
+        X = np.zeros((source.data.shape[1], T))
+
+        start = time.time()
+        for ch in range(source.data.shape[1]):
+            X[ch, :] = resample(source.data[:, ch] * 1e6, args.rate,
+                                source.rate)
+        serial = time.time() - start
+        print('{:>8} {:>10.2f} s'.format('serial', serial))
+
+        n_jobs = 1
+        while n_jobs <= args.max_jobs:
+            start = time.time()
+            _resample_parallel(source, X, args.rate, n_jobs)
+            elapsed = time.time() - start
+            print('{:>8} {:>10.2f} s  (speedup {:.1f}x)'.format(
+                n_jobs, elapsed, serial / elapsed))
+            n_jobs *= 2
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
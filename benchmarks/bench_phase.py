@@ -0,0 +1,79 @@
+"""
+Phase of the spectral decomposition in the Chang lab bands: run time and
+size of the DecompositionSeries alone and with its int16 phase (see `phase`
+of `spectral_decomposition`), against the phase of ERP epochs (2 s of all
+channels in a few bands around each event) computed on demand with
+`phase.LazyPhase`, without and with the FFTs of the time blocks in cache.
+
+Usage: python bench_phase.py --channels 64 --duration 300
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.phase import LazyPhase
+from ecogvis.signal_processing.processing_data import preprocess_raw_data, \
+    spectral_decomposition
+from synthetic import make_raw_nwb
+
+
+def read_epochs(phase, events, half_window, bands):
+    n_half = int(half_window * phase.rate)
+    start = time.time()
+    for t in events:
+        t0 = int(t * phase.rate)
+        phase[t0 - n_half:t0 + n_half, :, bands]
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=300.)
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--block_size', type=float, default=None)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    raw = os.path.join(folder, 'bench_raw.nwb')
+    make_raw_nwb(raw, args.channels, args.duration)
+    preprocess_raw_data(raw, {'referencing': ('CAR', 16), 'Notch': 60,
+                              'Downsample': 400.})
+    raw_size = os.path.getsize(raw)
+    bands_vals = np.array([chang_lab['cfs'], chang_lab['sds']])
+
+    results = []
+    for phase in [False, True]:
+        path = os.path.join(folder, 'bench_phase.nwb')
+        shutil.copy(raw, path)
+        start = time.time()
+        spectral_decomposition(path, bands_vals, dtype='complex64',
+                               block_size=args.block_size, phase=phase)
+        elapsed = time.time() - start
+        results.append((phase, elapsed, os.path.getsize(path) - raw_size))
+        os.remove(path)
+
+    rng = np.random.RandomState(0)
+    events = np.sort(rng.uniform(1., args.duration - 1., args.events))
+    lazy = LazyPhase(raw, bands_vals)
+    # theta and high gamma bands, then beta bands on the same epochs
+    first = read_epochs(lazy, events, 1., [10, 30, 33])
+    cached = read_epochs(lazy, events, 1., [20, 22])
+    os.remove(raw)
+
+    print('{:>22} {:>9} {:>9}'.format('decomposition', 'time', 'MB'))
+    for phase, elapsed, size in results:
+        print('{:>22} {:>8.2f}s {:>9.0f}'.format(
+            'amplitude and phase' if phase else 'amplitude', elapsed,
+            size / 2**20))
+    print('{:>22} {:>8.2f}s {:>9}'.format('lazy epochs', first, '-'))
+    print('{:>22} {:>8.2f}s {:>9}'.format('lazy epochs, cached', cached, '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Time and peak memory of `preprocess_raw_data` in float64 and float32
+precision, with the differences of the LFP.
+
+Usage: python bench_precision.py --channels 64 --duration 300 --resample poly
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from ecogvis.signal_processing.processing_data import preprocess_raw_data
+from synthetic import make_raw_nwb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=300.)
+    parser.add_argument('--resample', default='fft')
+    parser.add_argument('--block-size', type=float, default=None)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    raw_path = os.path.join(folder, 'bench_raw.nwb')
+    make_raw_nwb(raw_path, n_channels=args.channels, duration=args.duration)
+    config = {'referencing': ('CAR', 16), 'Notch': 60., 'Downsample': 400.,
+              'resample': args.resample, 'block_size': args.block_size}
+
+    lfp = {}
+    for precision in ['float64', 'float32']:
+        path = os.path.join(folder, precision + '.nwb')
+        shutil.copy(raw_path, path)
+        tracemalloc.start()
+        start = time.time()
+        preprocess_raw_data(path, dict(config, precision=precision))
+        elapsed = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with NWBHDF5IO(path, 'r') as io:
+            lfp[precision] = io.read().processing['ecephys'].data_interfaces[
+                'LFP'].electrical_series['preprocessed'].data[:]
+        print('{:>8} {:>8.2f} s {:>8.0f} MB'.format(precision, elapsed,
+                                                    peak / 2**20))
+    diff = np.abs(lfp['float32'] - lfp['float64']).max()
+    print('max abs diff {:.1e} (std {:.1e})'.format(diff,
+                                                    np.std(lfp['float64'])))
+    shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
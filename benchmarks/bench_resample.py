@@ -0,0 +1,47 @@
+"""
+Accuracy and time of polyphase resampling against FFT resampling
+(`process_nwb.resample`), for ECoG (3051.76 Hz to 400 Hz) and audio
+(decimation by 30) rates. Accuracy is measured on a sum of sinusoids below
+the new Nyquist frequency, away from the edges of the signal.
+
+Usage: python bench_resample.py --channels 64 --duration 60
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ecogvis.signal_processing.resample import resample
+
+
+def sinusoids(t, freqs):
+    return sum(np.sin(2 * np.pi * f * t + f) for f in freqs)[:, None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=60.)
+    args = parser.parse_args()
+
+    cases = [('ECoG', 3051.7578125, 400., args.channels),
+             ('audio', 24414.0625, 24414.0625 / 30, 1)]
+    for name, fs, new_rate, n_channels in cases:
+        t = np.arange(int(args.duration * fs)) / fs
+        freqs = [f * new_rate / 2 for f in (0.05, 0.2, 0.5, 0.8)]
+        X = np.tile(sinusoids(t, freqs), (1, n_channels))
+        print('{}: {:.2f} Hz to {:.2f} Hz, {} channels'.format(
+            name, fs, new_rate, n_channels))
+        for method in ['fft', 'poly']:
+            start = time.time()
+            Y = resample(X, new_rate, fs, method=method)
+            elapsed = time.time() - start
+            t_new = np.arange(len(Y)) / new_rate
+            interior = slice(int(new_rate), len(Y) - int(new_rate))
+            error = np.abs(Y[interior, :1] - sinusoids(t_new, freqs)[interior])
+            print('{:>8} {:>8.2f} s  (max abs error {:.1e})'.format(
+                method, elapsed, error.max()))
+
+
+if __name__ == '__main__':
+    main()
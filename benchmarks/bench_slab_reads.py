@@ -0,0 +1,57 @@
+"""
+Column by column reads (`data[:, ch]`) against chunk-aligned slab reads
+(`channel_blocks`) of a gzip compressed (n_time, n_channels) dataset, with
+the default chunking of h5py (as in files written by chang2nwb).
+
+Usage: python bench_slab_reads.py --channels 256 --duration 300
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from ecogvis.signal_processing.streaming import channel_blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=300.)
+    parser.add_argument('--rate', type=float, default=3051.7578125)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench_slabs.h5')
+    n_time = int(args.duration * args.rate)
+    rng = np.random.RandomState(0)
+    with h5py.File(path, 'w') as f:
+        dset = f.create_dataset('data', shape=(n_time, args.channels),
+                                dtype='float32', compression='gzip')
+        for t0 in range(0, n_time, 2**16):
+            t1 = min(t0 + 2**16, n_time)
+            dset[t0:t1] = rng.randn(t1 - t0, args.channels)
+        print('dataset {}, chunks {}'.format(dset.shape, dset.chunks))
+
+    with h5py.File(path, 'r') as f:
+        dset = f['data']
+        start = time.time()
+        total = 0.
+        for ch in range(dset.shape[1]):
+            total += dset[:, ch].sum()
+        columns = time.time() - start
+        print('{:>10} {:>8.2f} s'.format('columns', columns))
+
+        start = time.time()
+        total = 0.
+        for c0, c1, Xs in channel_blocks(dset):
+            total += Xs.sum()
+        slabs = time.time() - start
+        print('{:>10} {:>8.2f} s  (speedup {:.1f}x)'.format(
+            'slabs', slabs, columns / slabs))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
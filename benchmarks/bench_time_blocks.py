@@ -0,0 +1,85 @@
+"""
+Time and peak memory of the spectral decomposition of whole recordings
+(one FFT of the full, arbitrary length per channel) against overlap-save
+time blocks (FFTs of a fixed fast length, see `block_filter_bank`), for
+increasing recording durations, with the maximum difference of amplitude
+relative to the maximum amplitude of each band. The amplitude of the blocks
+is discarded, as it is written to the file block by block by
+`spectral_decomposition`.
+
+Usage: python bench_time_blocks.py --channels 16 --durations 300 600 1200
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.fft import next_fast_len
+
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.hilbert_transform import block_filter_bank, \
+    gaussian_filter_bank, hilbert_context, hilbert_filter_bank
+from ecogvis.signal_processing.streaming import circular_blocks
+
+
+def whole(X, rate, centers, sds):
+    filters = gaussian_filter_bank(X.shape[0], rate, centers, sds)
+    return hilbert_filter_bank(X.T, rate, filters, use_rfft=True)
+
+
+def blocks(X, rate, centers, sds, block_size, out=None):
+    n_time = X.shape[0]
+    context = hilbert_context(rate, sds)
+    n_fft = next_fast_len(int(block_size * rate) + 2 * context)
+    filters = block_filter_bank(n_fft, n_time, rate, centers, sds)
+    for start, stop, Xb in circular_blocks(X, n_fft - 2 * context, context):
+        Xa = hilbert_filter_bank(Xb.T, rate, filters, use_rfft=True)
+        if out is not None:
+            out[..., start:stop] = Xa[..., context:context + stop - start]
+    return out
+
+
+def measure(func, *args, **kwargs):
+    tracemalloc.start()
+    start = time.time()
+    Y = func(*args, **kwargs)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return Y, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--durations', type=float, nargs='+',
+                        default=[300., 600., 1200.])
+    parser.add_argument('--rate', type=float, default=400.)
+    parser.add_argument('--block-size', type=float, default=30.)
+    parser.add_argument('--bands', type=int, default=10,
+                        help='Number of Chang lab bands (every 4th band).')
+    args = parser.parse_args()
+
+    centers = chang_lab['cfs'][::4][:args.bands]
+    sds = chang_lab['sds'][::4][:args.bands]
+    print('{:>10} {:>9} {:>10} {:>9} {:>10} {:>9} {:>10}'.format(
+        'duration', 'samples', 'whole', 'MB', 'blocks', 'MB', 'max diff'))
+    for duration in args.durations:
+        # lengths of real recordings are arbitrary, e.g. a prime factor
+        n_time = int(duration * args.rate) + 7
+        X = (1e6 * np.random.RandomState(0).randn(n_time, args.channels)
+             ).astype('float32')
+        expected, t_whole, m_whole = measure(whole, X, args.rate, centers, sds)
+        _, t_blocks, m_blocks = measure(blocks, X, args.rate, centers, sds,
+                                        args.block_size)
+        Xa = blocks(X, args.rate, centers, sds, args.block_size,
+                    out=np.zeros_like(expected))
+        diff = (abs(Xa - expected).max(axis=(1, 2)) /
+                abs(expected).max(axis=(1, 2))).max()
+        print('{:>9.0f}s {:>9} {:>9.2f}s {:>9.0f} {:>9.2f}s {:>9.0f} '
+              '{:>10.1e}'.format(duration, n_time, t_whole, m_whole / 2**20,
+                                 t_blocks, m_blocks / 2**20, diff))
+
+
+if __name__ == '__main__':
+    main()
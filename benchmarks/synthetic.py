@@ -0,0 +1,97 @@
+"""
+Synthetic NWB files for the benchmarks.
+"""
+import os
+from datetime import datetime
+
+import numpy as np
+from dateutil.tz import tzlocal
+from pynwb import NWBHDF5IO, NWBFile
+from pynwb.ecephys import ElectricalSeries
+
+
+def make_raw_nwb(path, n_channels=64, duration=60., rate=3051.7578125,
+                 seed=0):
+    """
+    Writes a nwb file with a synthetic raw ElectricalSeries in acquisition.
+
+    Parameters
+    ----------
+    path : str
+        Path of the new nwb file.
+    n_channels : int
+        Number of channels.
+    duration : float
+        Duration of the recording, in seconds.
+    rate : float
+        Sampling rate, in Hz.
+    seed : int
+        Seed of the random number generator.
+    """
+    rng = np.random.RandomState(seed)
+
+    # 1/f noise plus 60 Hz line noise
+    n_time = int(duration * rate)
+    t = np.arange(n_time) / rate
+    data = np.empty((n_time, n_channels), dtype='float32')
+    for c0 in range(0, n_channels, 16):
+        c1 = min(c0 + 16, n_channels)
+        noise = np.fft.rfft(rng.randn(n_time, c1 - c0), axis=0)
+        noise /= np.maximum(np.fft.rfftfreq(n_time, 1. / rate), 1.)[:, None]
+        data[:, c0:c1] = 1e-4 * np.fft.irfft(noise, n=n_time, axis=0)
+    data += 1e-5 * np.sin(2 * np.pi * 60. * t)[:, np.newaxis]
+
+    write_raw_nwb(path, data, rate)
+
+
+def scale_example_nwb(path, n_channels=64, duration=60.):
+    """
+    Writes a nwb file with the raw signals of the example file of the tests
+    (ecogvis/signal_processing/tests/example_ecephys.nwb), tiled in time and
+    channels.
+
+    Parameters
+    ----------
+    path : str
+        Path of the new nwb file.
+    n_channels : int
+        Number of channels.
+    duration : float
+        Duration of the recording, in seconds.
+    """
+    example = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'ecogvis', 'signal_processing', 'tests',
+                           'example_ecephys.nwb')
+    with NWBHDF5IO(example, 'r') as io:
+        raw = io.read().acquisition['raw']
+        rate = raw.rate
+        data = raw.data[:]
+    n_time = int(duration * rate)
+    reps = (int(np.ceil(n_time / data.shape[0])),
+            int(np.ceil(n_channels / data.shape[1])))
+    data = np.tile(data, reps)[:n_time, :n_channels]
+    write_raw_nwb(path, data, rate)
+
+
+def write_raw_nwb(path, data, rate):
+    """
+    Writes a nwb file with `data` (n_time, n_channels) as raw ElectricalSeries
+    in acquisition.
+    """
+    n_channels = data.shape[1]
+    nwbfile = NWBFile(session_description='synthetic', identifier='synthetic',
+                      session_start_time=datetime.now(tzlocal()))
+    device = nwbfile.create_device(name='device')
+    group = nwbfile.create_electrode_group(name='grid', description='',
+                                           location='grid', device=device)
+    nwbfile.add_electrode_column(name='bad', description='bad channel')
+    for i in range(n_channels):
+        nwbfile.add_electrode(x=1., y=2., z=3., imp=np.nan, location='grid',
+                              filtering='none', group=group, bad=False)
+    electrodes = nwbfile.create_electrode_table_region(
+        list(range(n_channels)), 'all')
+
+    nwbfile.add_acquisition(ElectricalSeries(name='raw', data=data,
+                                             electrodes=electrodes, rate=rate))
+    with NWBHDF5IO(path, 'w') as io:
+        io.write(nwbfile)
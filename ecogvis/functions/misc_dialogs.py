@@ -20,6 +20,7 @@ from ecogvis.signal_processing import bands as default_bands
 from ecogvis.signal_processing.detect_events import detect_events
 from ecogvis.signal_processing.periodogram import psd_estimate
 from ecogvis.signal_processing.processing_data import processing_data
+from ecogvis.signal_processing.provenance import parse_comments
 from pynwb import NWBHDF5IO
 from pynwb.epoch import TimeIntervals
 from ndx_bipolar_scheme.bipolar_scheme import BipolarSchemeTable
@@ -1244,17 +1245,19 @@ class PreprocessingDialog(QtGui.QDialog, Ui_Preprocessing):
             if 'LFP' in parent.model.nwb.processing['ecephys'].data_interfaces:
                 self.disable_all()
                 aux = parent.model.nwb.processing['ecephys'].data_interfaces['LFP'].electrical_series['preprocessed']
-                car, notch, downs = aux.comments.split(',')
-                _, car = car.split(':')
-                _, notch = notch.split(':')
-                _, downs = downs.split(':')
-                if car == 'None':
+                provenance = parse_comments(aux.comments) or {'config': {}}
+                car = provenance['config'].get('referencing')
+                notch = provenance['config'].get('Notch')
+                downs = provenance['config'].get('Downsample')
+                if car is None:
                     self.checkBox_1.setChecked(False)
-                self.lineEdit_1.setText(car)
-                if notch == 'None':
+                elif isinstance(car, (list, tuple)):
+                    car = car[1]
+                self.lineEdit_1.setText(str(car))
+                if notch is None:
                     self.checkBox_2.setChecked(False)
-                self.lineEdit_2.setText(notch)
-                if downs == 'No':
+                self.lineEdit_2.setText(str(notch))
+                if downs is None:
                     self.checkBox_3.setChecked(False)
                 self.lineEdit_3.setText(str(aux.rate))
                 self.pushButton_1.setEnabled(True)
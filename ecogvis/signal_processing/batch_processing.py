@@ -0,0 +1,410 @@
+"""
+Headless processing of many blocks (e.g. all the `EC###_B##.nwb` files of a
+subject) in a pool of processes, with one job per block.
+
+Example, from the command line:
+
+    ecogvis-batch /data/EC100 EC100 --blocks 1 2 3 --modes preprocess high_gamma
+                  --config config.yml --workers 8 --max-memory 16G
+
+where config.yml holds the configuration of each mode, e.g.:
+
+    preprocess:
+      referencing: [CAR, 16]
+      Notch: 60
+      Downsample: 400
+    high_gamma: default
+"""
+from __future__ import print_function, division
+
+import glob
+import multiprocessing
+import os
+import re
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.fft_backends import backend_info
+from ecogvis.signal_processing.provenance import stage_status
+
+__all__ = ['Job',
+           'default_configs',
+           'format_report',
+           'is_done',
+           'run_batch']
+
+Job = namedtuple('Job', ['path', 'subject', 'block', 'modes', 'configs',
+                         'skip_done', 'max_memory', 'fft_workers',
+                         'fft_backend'])
+
+# Outputs of each mode, in /processing/ecephys of the block file
+_outputs = {'preprocess': ['LFP'],
+            'decomposition': ['DecompositionSeries'],
+            'high_gamma': ['high_gamma'],
+            'preprocess_high_gamma': ['LFP', 'high_gamma']}
+
+
+def default_configs():
+    """
+    Default configuration of each processing mode: CAR by groups of 16
+    channels, 60 Hz notch and downsampling to 400 Hz for preprocessing, all
+    Chang lab bands for spectral decomposition and the 8 bands between 70
+    and 150 Hz for High Gamma.
+    """
+    hg_bands = np.array([chang_lab['cfs'][29:37], chang_lab['sds'][29:37]])
+    preprocess = {'referencing': ('CAR', 16), 'Notch': 60, 'Downsample': 400.}
+    return {'preprocess': preprocess,
+            'decomposition': np.array([chang_lab['cfs'], chang_lab['sds']]),
+            'high_gamma': hg_bands,
+            'preprocess_high_gamma': preprocess}
+
+
+def is_done(block_path, mode, config=None, configs=None):
+    """
+    Whether the outputs of `mode` already exist in the block file, and are
+    up to date with `config` (see `provenance`). Outputs without provenance,
+    written by older versions, are considered done.
+
+    Parameters
+    ----------
+    block_path : str
+        Path of the NWB file.
+    mode : str
+        'preprocess', 'decomposition', 'high_gamma' or 'preprocess_high_gamma'.
+    config : dict, ndarray or None
+        Configuration of the mode, `default_configs` if None, or the
+        configuration of a `memory_plan`.
+    configs : dict or None
+        Configuration of each mode, where 'preprocess_high_gamma' takes the
+        bands of High Gamma ('high_gamma'). Missing modes use
+        `default_configs`.
+    """
+    from ecogvis.signal_processing.processing_data import _bands_config
+
+    all_configs = default_configs()
+    all_configs.update(configs or {})
+    if config is None:
+        config = all_configs[mode]
+    if mode == 'preprocess_high_gamma':
+        # High Gamma in the time blocks of the preprocessing, if any
+        stages = [('preprocess', config),
+                  ('high_gamma', {'bands_vals': all_configs['high_gamma'],
+                                  'block_size': config.get('block_size')})]
+    else:
+        stages = [(mode, config)]
+    for stage, stage_config in stages:
+        if stage != 'preprocess':
+            # bands_vals, or the keyword arguments planned by `memory_plan`
+            options = dict(stage_config) if isinstance(stage_config, dict) \
+                else {'bands_vals': stage_config}
+            options.setdefault('dtype', 'complex128')
+            stage_config = _bands_config(**options)
+        status, _ = stage_status(block_path, stage, stage_config)
+        if status not in ('current', 'unknown'):
+            return False
+    return True
+
+
+def run_batch(path, subject, blocks=None, modes=('preprocess', 'high_gamma'),
+              configs=None, n_workers=None, max_memory=None, retries=1,
+              skip_done=True, fft_workers=1):
+    """
+    Run `processing_data` on many blocks, in a pool of processes.
+
+    Each block is a job, which runs the `modes` in order. Each job runs in a
+    new process, so memory is released between blocks, and failed jobs
+    (e.g. out of memory) are retried in a new process.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the block files.
+    subject : str
+        Subject name, block files are named '{subject}_B{block}.nwb'.
+    blocks : list or None
+        Blocks to process. If None, all the block files of the subject.
+    modes : list of str
+        Processing stages of each block, in order, see `processing_data`.
+    configs : dict or None
+        Configuration of each mode (the `config` argument of
+        `processing_data`). Missing modes use `default_configs`.
+    n_workers : int or None
+        Number of processes. If None, the number of CPUs, limited so that
+        `n_workers * max_memory` fits in the physical memory.
+    max_memory : float or None
+        Memory limit of each job, in GB (address space limit, Unix only).
+        The block and slab sizes (and the precision of the decomposition
+        stages) are chosen to fit in it (see `memory_plan`), and stages that
+        cannot fit fail without running.
+    retries : int
+        Number of times a failed job is retried (default=1).
+    skip_done : bool
+        Skip the stages whose outputs are up to date in the block file
+        (default=True). Stale outputs are recomputed by the stages.
+    fft_workers : int
+        Number of threads of the FFTs of each job (default=1). The jobs use
+        the FFT backend selected with `fft_backends.set_backend`.
+
+    Returns
+    -------
+    results : list of dict
+        Result of each job: 'block', 'status' ('done', 'skipped' or
+        'failed'), 'stages' (wall time of each stage, in seconds),
+        'attempts' and 'error'.
+    """
+    if blocks is None:
+        blocks = _find_blocks(path, subject)
+    all_configs = default_configs()
+    all_configs.update(configs or {})
+    n_workers = _n_workers(n_workers, max_memory, len(blocks))
+
+    jobs = [Job(path, subject, block, tuple(modes), all_configs, skip_done,
+                max_memory, fft_workers, backend_info()) for block in blocks]
+    results = {}
+    attempts = {job.block: 0 for job in jobs}
+    print('Processing {} blocks with {} workers'.format(len(jobs), n_workers))
+    while jobs:
+        lost = _run_jobs(jobs, n_workers, results)
+        if len(lost) > 1:
+            # the job whose worker died is unknown: run them one at a time,
+            # without charging an attempt to the others
+            for job in lost:
+                _run_jobs([job], 1, results)
+        for job in jobs:
+            result = results.get(job.block)
+            if result is None:
+                # its worker was killed, e.g. by the OOM killer
+                result = {'block': job.block, 'status': 'failed',
+                          'stages': {},
+                          'error': 'BrokenProcessPool: the worker process '
+                                   'running the job died.'}
+            attempts[job.block] += 1
+            result['attempts'] = attempts[job.block]
+            results[job.block] = result
+            print('Block {}: {}'.format(job.block, result['status']))
+        jobs = [job for job in jobs if results[job.block]['status'] == 'failed'
+                and attempts[job.block] <= retries]
+
+    return [results[block] for block in blocks]
+
+
+def format_report(results):
+    """Table of the status and wall time of each stage of each block."""
+    modes = []
+    for result in results:
+        modes += [mode for mode in result['stages'] if mode not in modes]
+    header = ['block', 'status', 'attempts'] + modes + ['total']
+    rows = [header]
+    for result in results:
+        stages = result['stages']
+        rows.append([str(result['block']), result['status'],
+                     str(result['attempts'])]
+                    + ['{:.1f}'.format(stages[mode]) if mode in stages else '-'
+                       for mode in modes]
+                    + ['{:.1f}'.format(sum(stages.values()))])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = ['  '.join(cell.rjust(w) for cell, w in zip(row, widths))
+             for row in rows]
+    for result in results:
+        if result['error'] is not None:
+            lines.append('Block {} failed:\n{}'.format(result['block'],
+                                                       result['error']))
+    return '\n'.join(lines)
+
+
+def _run_jobs(jobs, n_workers, results):
+    """
+    Run jobs in a pool of n_workers processes, and store their results by
+    block (replacing those of previous attempts). Returns the jobs lost when
+    a worker died, which have no result.
+    """
+    lost = []
+    with _executor(n_workers) as executor:
+        futures = {executor.submit(_run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results[job.block] = future.result()
+            except BrokenProcessPool:
+                # the pool is broken, the other jobs in flight are lost
+                results.pop(job.block, None)
+                lost.append(job)
+    return lost
+
+
+def _run_job(job):
+    """Run all the stages of one block, in a worker process."""
+    from ecogvis.signal_processing.fft_backends import set_backend
+    from ecogvis.signal_processing.memory_plan import plan_memory
+    from ecogvis.signal_processing.processing_data import processing_data
+
+    if job.max_memory is not None:
+        _limit_memory(job.max_memory)
+    # backend of the parent process, with the FFT threads of the job
+    options = dict(job.fft_backend)
+    name = options.pop('name')
+    options['workers'] = job.fft_workers
+    set_backend(name, **options)
+
+    block_path = os.path.join(job.path, '{}_B{}.nwb'.format(job.subject,
+                                                            job.block))
+    result = {'block': job.block, 'status': 'skipped', 'stages': {},
+              'error': None}
+    try:
+        for mode in job.modes:
+            config, max_bytes = job.configs[mode], 2**28
+            if job.skip_done and is_done(block_path, mode, config,
+                                         job.configs):
+                continue
+            if job.max_memory is not None:
+                # block and slab sizes that fit in the memory limit
+                plan = plan_memory(block_path, mode, config, job.max_memory)
+                config, max_bytes = plan.config, plan.max_bytes
+                if job.skip_done and is_done(block_path, mode, config,
+                                             job.configs):
+                    continue
+            options = {}
+            if isinstance(config, dict) and 'bands_vals' in config:
+                # planned block size and precision of the decomposition
+                options = dict(config)
+                config = options.pop('bands_vals')
+            start = time.time()
+            processing_data(job.path, job.subject, [job.block], mode=mode,
+                            config=config, max_bytes=max_bytes,
+                            bands_vals=job.configs.get('high_gamma'),
+                            **options)
+            result['stages'][mode] = time.time() - start
+            result['status'] = 'done'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    return result
+
+
+def _executor(n_workers):
+    """Pool of processes, forked where possible as with multiprocessing.Pool
+    (spawned processes import the whole ecogvis package)."""
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(n_workers,
+                                   mp_context=multiprocessing.get_context(
+                                       'fork'))
+    return ProcessPoolExecutor(n_workers)
+
+
+def _limit_memory(max_memory):
+    """Limit the address space of the current process to max_memory GB."""
+    try:
+        import resource
+    except ImportError:     # not available on Windows
+        return
+    limit = int(max_memory * 2**30)
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _n_workers(n_workers, max_memory, n_jobs):
+    """Number of processes, limited by the CPUs, the memory and the jobs."""
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+        if max_memory is not None:
+            try:
+                total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+                n_workers = min(n_workers, int(total // (max_memory * 2**30)))
+            except (ValueError, OSError, AttributeError):
+                pass
+    return max(min(n_workers, n_jobs), 1)
+
+
+def _find_blocks(path, subject):
+    """Blocks of all the '{subject}_B{block}.nwb' files in path."""
+    blocks = []
+    for name in sorted(glob.glob(os.path.join(path, subject + '_B*.nwb'))):
+        match = re.match(re.escape(subject) + r'_B(.+)\.nwb$',
+                         os.path.basename(name))
+        if match:
+            blocks.append(match.group(1))
+    return blocks
+
+
+def _memory_size(value):
+    """Memory size in GB, from a number of GB or a string like '512M'."""
+    units = {'K': 2**-20, 'M': 2**-10, 'G': 1., 'T': 2**10}
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def _read_configs(config_file):
+    """Configuration of each mode from a YAML (or JSON) file."""
+    import yaml
+
+    with open(config_file, 'r') as f:
+        configs = yaml.safe_load(f) or {}
+    defaults = default_configs()
+    for mode, config in list(configs.items()):
+        if config == 'default':
+            configs[mode] = defaults[mode]
+        elif mode in ['decomposition', 'high_gamma']:
+            configs[mode] = np.array(config, dtype=float)
+        else:
+            if config.get('referencing') is not None:
+                config['referencing'] = tuple(config['referencing'])
+            if config.get('Downsample') is not None:
+                config['Downsample'] = float(config['Downsample'])
+    return configs
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Processing of many blocks of a subject, in parallel.'
+    )
+    parser.add_argument("path", help="Folder of the block files.")
+    parser.add_argument("subject", help="Subject name, e.g. EC100.")
+    parser.add_argument(
+        "--blocks", nargs='+', default=None,
+        help="Blocks to process (default: all the blocks of the subject)."
+    )
+    parser.add_argument(
+        "--modes", nargs='+', default=['preprocess', 'high_gamma'],
+        choices=sorted(_outputs), help="Processing stages, in order."
+    )
+    parser.add_argument(
+        "--config", default=None,
+        help="YAML file with the configuration of each mode."
+    )
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes.")
+    parser.add_argument("--max-memory", type=_memory_size, default=None,
+                        help="Memory limit of each job, in GB or with a "
+                             "unit (e.g. 16G, 512M).")
+    parser.add_argument("--retries", type=int, default=1,
+                        help="Number of retries of failed jobs.")
+    parser.add_argument("--fft-workers", type=int, default=1,
+                        help="Number of FFT threads of each job.")
+    return parser.parse_args()
+
+
+def cmd_line_shortcut():
+    args = parse_arguments()
+    configs = None if args.config is None else _read_configs(args.config)
+    results = run_batch(args.path, args.subject, blocks=args.blocks,
+                        modes=args.modes, configs=configs,
+                        n_workers=args.workers, max_memory=args.max_memory,
+                        retries=args.retries,
+                        fft_workers=args.fft_workers)
+    print(format_report(results))
+
+
+if __name__ == '__main__':
+    cmd_line_shortcut()
@@ -2,68 +2,289 @@ from __future__ import division
 
 import numpy as np
 
-__all__ = ['subtract_CAR',
+__all__ = ['bipolar_pairs',
+           'bipolar_reference',
+           'device_groups',
+           'subtract_CAR',
            'subtract_CAR_by_device',
-           'subtract_common_median_reference']
+           'subtract_CMR',
+           'subtract_common_median_reference',
+           'subtract_group_reference']
 
 
-def subtract_CAR(X, b_size=16, elec_info=None, exclude_bad_channels=None):
+def subtract_CAR(X, b_size=16, elec_info=None, exclude_bad_channels=None,
+                 out=None, max_bytes=2**26):
     """
-    Compute and subtract common average reference in `b_size` channel 
+    Compute and subtract common average reference in `b_size` channel
     blocks.
-    X of shape (electrodes, time).
-    """
 
-    X_car = X.copy()
+    The reference of each block is the nan-aware mean of its channels (bad
+    channels are left out if `exclude_bad_channels` is
+    'exclude_bad_channels'). It is computed and subtracted over segments of
+    `max_bytes` of samples, so the only temporary arrays are the size of one
+    segment.
 
-    if exclude_bad_channels is not None and exclude_bad_channels ==  \
-            'exclude_bad_channels':
-        # If excluding bad channels, then NaN out those electrodes.
-        bc_idx = np.where(elec_info.bad.values)[0]
-        X_car[bc_idx, :] = np.nan
+    Parameters
+    ----------
+    X : ndarray (electrodes, time)
+        Signals, or any array-like that can be sliced (e.g. h5py dataset).
+    b_size : int
+        Number of channels of each block. The last block has the remaining
+        channels.
+    elec_info : DataFrame
+        Electrodes table, with a 'bad' column if excluding bad channels.
+    exclude_bad_channels : str or None
+        'exclude_bad_channels' to leave bad channels out of the reference.
+    out : ndarray or None
+        Output array (electrodes, time), can be X to reference in place, or
+        any array-like that can be assigned by slices (e.g. h5py dataset).
+        If None, a new array is returned.
+    max_bytes : int
+        Size of the segments of samples processed at once.
 
+    Returns
+    -------
+    out : ndarray (electrodes, time)
+        Referenced signals.
+    """
     channels, time_points = X.shape
-    s = channels // b_size
-    r = channels % b_size
+    if out is None:
+        out = np.empty(X.shape, dtype=X.dtype)
+
+    good = np.ones(channels, dtype=bool)
+    if exclude_bad_channels is not None and exclude_bad_channels == \
+            'exclude_bad_channels':
+        good[elec_info.bad.values.astype(bool)] = False
 
-    X_1 = X[:channels - r].copy()
-    X_1car = X_car[:channels - r].copy()
+    groups = [(c0, min(c0 + b_size, channels))
+              for c0 in range(0, channels, b_size)]
+    itemsize = np.dtype(X.dtype).itemsize
+    # at least 64 samples per segment: numpy sums single columns in a
+    # different order, which would change the last bits of the means
+    step = max(int(max_bytes // (channels * itemsize)), 64)
+    in_place = out is X and isinstance(X, np.ndarray)
+    for t0 in range(0, time_points, step):
+        t1 = min(t0 + step, time_points)
+        Xs = X[:, t0:t1]
+        for c0, c1 in groups:
+            if good[c0:c1].all():
+                ref = np.nanmean(Xs[c0:c1], axis=0)
+            else:
+                ref = np.nanmean(Xs[c0:c1][good[c0:c1]], axis=0)
+            if in_place:
+                Xs[c0:c1] -= ref
+            else:
+                out[c0:c1, t0:t1] = Xs[c0:c1] - ref
+    return out
+
+
+def subtract_CAR_by_device(X, elec_info=None, method='mean', out=None,
+                           max_bytes=2**20):
+    """
+    Compute and subtract common average (or median) reference by electrode
+    device as defined in the electrode table. Channels of 'null' devices are
+    not referenced.
+
+    Parameters
+    ----------
+    X : ndarray (electrodes, time)
+        Signals.
+    elec_info : DataFrame
+        Electrodes table, with a 'group_name' column.
+    method : str
+        'mean' or 'median'.
+    out : ndarray or None
+        Output array, can be X to reference in place. If None, a new array is
+        returned.
+    max_bytes : int
+        Size of the segments of samples processed at once.
+
+    Returns
+    -------
+    out : ndarray (electrodes, time)
+        Referenced signals.
+    """
+    return subtract_group_reference(X, device_groups(elec_info),
+                                    method=method, out=out,
+                                    max_bytes=max_bytes)
 
-    X_1 = X_1.reshape((s, b_size, time_points))
-    X_1car = X_1car.reshape((s, b_size, time_points))
-    X_1 -= np.nanmean(X_1car, axis=1, keepdims=True)
 
-    if r > 0:
-        X_2 = X[channels - r:].copy()
-        X_2car = X_car[channels - r:].copy()
-        X_2 -= np.nanmean(X_2car, axis=0, keepdims=True)
-        X = np.vstack([X_1.reshape((s * b_size, time_points)), X_2])
-        return X
-    else:
-        return X_1.reshape((s * b_size, time_points))
+def device_groups(elec_info, skip='null'):
+    """
+    Group index of each channel, from the devices ('group_name' column) of
+    the electrodes table.
 
+    Parameters
+    ----------
+    elec_info : DataFrame
+        Electrodes table, one row per channel.
+    skip : str
+        Devices starting with `skip` get the group -1 (not referenced).
 
-def subtract_CAR_by_device(X, elec_info=None):
+    Returns
+    -------
+    groups : ndarray (electrodes,)
+        Group of each channel, from 0 to n_groups - 1, or -1.
     """
-    Compute and subtract common average reference by electrode device as
-    defined in the electrode table.
-    TODO: NEED TO VERIFY THIS, THIS IS UNTESTED.
+    names = np.asarray(elec_info.group_name.values).astype(str)
+    unique, groups = np.unique(names, return_inverse=True)
+    skipped = np.char.startswith(unique, skip)
+    # number the groups that are kept consecutively
+    new_index = np.cumsum(~skipped) - 1
+    new_index[skipped] = -1
+    return new_index[groups]
+
+
+def subtract_group_reference(X, groups, method='mean', exclude=None,
+                             out=None, max_bytes=2**20):
     """
-    new_X = np.copy(X)
+    Compute and subtract the nan-aware mean (or median) of groups of
+    channels.
+
+    All the group references of a segment of samples are computed with a
+    single reduction over the channels sorted by group, so the function can
+    be applied to time blocks of the signals.
 
-    for elec_device in elec_info.group_name.unique():
+    Parameters
+    ----------
+    X : ndarray (electrodes, time)
+        Signals.
+    groups : array-like (electrodes,)
+        Group of each channel (integers), channels of negative groups are not
+        referenced.
+    method : str
+        'mean' or 'median'.
+    exclude : array-like (electrodes,) of bool or None
+        Channels left out of the references (e.g. bad channels), they are
+        still referenced.
+    out : ndarray or None
+        Output array, can be X to reference in place. If None, a new array is
+        returned.
+    max_bytes : int
+        Size of the segments of samples processed at once. Small segments
+        keep the temporary arrays in the CPU caches.
 
-        if elec_device.startswith('null'):
-            continue
+    Returns
+    -------
+    out : ndarray (electrodes, time)
+        Referenced signals.
+    """
+    if method not in ('mean', 'median'):
+        raise ValueError("method should be 'mean' or 'median', not "
+                         "{}".format(method))
+    groups = np.asarray(groups)
+    channels, time_points = X.shape
+    if out is None:
+        out = np.empty(X.shape, dtype=X.dtype)
+
+    # row of the reference of each channel, the last row is zero
+    kept = groups >= 0
+    labels = np.unique(groups[kept])
+    ref_index = np.full(channels, len(labels))
+    ref_index[kept] = np.searchsorted(labels, groups[kept])
 
-        elec_idx = elec_info.loc[
-            elec_info.group_name == elec_device].index.values
+    # channels of the references sorted by group, and first channel of each
+    # group (groups without channels get a nan reference)
+    included = kept if exclude is None else kept & ~np.asarray(exclude, bool)
+    order = np.flatnonzero(included)
+    order = order[np.argsort(ref_index[order], kind='stable')]
+    rows, starts = np.unique(ref_index[order], return_index=True)
+    bounds = np.append(starts, len(order))
+    missing = np.setdiff1d(np.arange(len(labels)), rows)
 
-        cur_X = np.copy(X[elec_idx, :])
-        cur_X -= np.nanmean(cur_X, axis=1, keepdims=True)
-        new_X[elec_idx, :] = cur_X
+    itemsize = np.dtype(X.dtype).itemsize
+    step = max(int(max_bytes // (channels * itemsize)), 64)
+    in_place = out is X and isinstance(X, np.ndarray)
+    for t0 in range(0, time_points, step):
+        t1 = min(t0 + step, time_points)
+        Xs = X[:, t0:t1]
+        ref = np.zeros((len(labels) + 1, t1 - t0), dtype=X.dtype)
+        ref[missing] = np.nan
+        Xg = Xs[order]
+        if method == 'mean' and len(order) > 0:
+            nans = np.isnan(Xg)
+            if nans.any():
+                Xg[nans] = 0
+                counts = np.add.reduceat(~nans, starts, axis=0)
+            else:
+                counts = np.diff(bounds)[:, np.newaxis]
+            ref[rows] = np.add.reduceat(Xg, starts, axis=0)
+            ref[rows] /= counts
+        elif method == 'median':
+            for row, g0, g1 in zip(rows, bounds[:-1], bounds[1:]):
+                ref[row] = _nanmedian(Xg[g0:g1])
+        if in_place:
+            Xs -= ref[ref_index]
+        else:
+            out[:, t0:t1] = Xs - ref[ref_index]
+    return out
 
-    return new_X
+
+def subtract_CMR(X, b_size=16, elec_info=None, exclude_bad_channels=None,
+                 out=None, max_bytes=2**20):
+    """
+    Compute and subtract common median reference in `b_size` channel
+    blocks, with the same options as `subtract_CAR`.
+
+    Parameters
+    ----------
+    X : ndarray (electrodes, time)
+        Signals.
+    b_size : int
+        Number of channels of each block. The last block has the remaining
+        channels.
+    elec_info : DataFrame
+        Electrodes table, with a 'bad' column if excluding bad channels.
+    exclude_bad_channels : str or None
+        'exclude_bad_channels' to leave bad channels out of the reference.
+    out : ndarray or None
+        Output array, can be X to reference in place. If None, a new array is
+        returned.
+    max_bytes : int
+        Size of the segments of samples processed at once.
+
+    Returns
+    -------
+    out : ndarray (electrodes, time)
+        Referenced signals.
+    """
+    exclude = None
+    if exclude_bad_channels is not None and exclude_bad_channels == \
+            'exclude_bad_channels':
+        exclude = elec_info.bad.values.astype(bool)
+    groups = np.arange(X.shape[0]) // b_size
+    return subtract_group_reference(X, groups, method='median',
+                                    exclude=exclude, out=out,
+                                    max_bytes=max_bytes)
+
+
+def _nanmedian(X):
+    """
+    Median of X (channels, time) across channels, ignoring NaNs, with
+    partitions instead of the (slow) masked arrays of np.nanmedian. Only the
+    columns (time samples) with NaNs are sorted.
+    """
+    n = X.shape[0]
+    kth = sorted({(n - 1) // 2, n // 2})
+    nans = np.isnan(X)
+    with_nans = nans.any(axis=0)
+    if not with_nans.any():
+        part = np.partition(X, kth, axis=0)
+        return np.mean(part[kth], axis=0)
+    median = np.empty(X.shape[1], dtype=X.dtype)
+    if not with_nans.all():
+        part = np.partition(X[:, ~with_nans], kth, axis=0)
+        median[~with_nans] = np.mean(part[kth], axis=0)
+    # NaNs are sorted last, so the valid values of each column come first
+    counts = n - nans[:, with_nans].sum(axis=0)
+    part = np.sort(X[:, with_nans], axis=0)
+    cols = np.arange(part.shape[1])
+    low = part[np.maximum((counts - 1) // 2, 0), cols]
+    high = part[counts // 2, cols]
+    median_nans = (low + high) / 2
+    median_nans[counts == 0] = np.nan
+    median[with_nans] = median_nans
+    return median
 
 
 def subtract_common_median_reference(X, channel_axis=-2):
@@ -86,3 +307,76 @@ def subtract_common_median_reference(X, channel_axis=-2):
     Xp = X - median
 
     return Xp
+
+
+def bipolar_pairs(grid_size, grid_step=1):
+    """
+    Anode and cathode electrodes of the bipolar referenced channels of a
+    grid, following the scheme of Dr. John Burke: each electrode (except at
+    the edges) yields two channels, with its "right" and "below" neighbors.
+
+    Electrodes are numbered as in the Chang lab grids, from the last to the
+    first, by columns.
+
+    Parameters
+    ----------
+    grid_size : array-like (2,)
+        Number of rows and columns of the grid.
+    grid_step : int
+        Step between the electrodes used, to skip rows and columns.
+
+    Returns
+    -------
+    anodes, cathodes : ndarray (n_pairs,)
+        Electrodes of each bipolar channel. A n x m grid (with grid_step=1)
+        yields 2 * n * m - n - m channels.
+    """
+    grid_size = tuple(int(n) for n in grid_size)
+    layout = np.arange(np.prod(grid_size) - 1, -1, -1).reshape(grid_size).T
+    layout = layout[::grid_step, ::grid_step]
+
+    # neighbors to the "right" and "below" of each electrode, -1 at the edges
+    right = np.full(layout.shape, -1)
+    right[:, :-1] = layout[:, 1:]
+    below = np.full(layout.shape, -1)
+    below[:-1, :] = layout[1:, :]
+
+    # pairs of each electrode are consecutive
+    anodes = np.stack([layout, layout], axis=-1).ravel()
+    cathodes = np.stack([right, below], axis=-1).ravel()
+    valid = cathodes >= 0
+    return anodes[valid], cathodes[valid]
+
+
+def bipolar_reference(X, pairs, out=None, max_bytes=2**26):
+    """
+    Differences between the anode and cathode electrodes of each bipolar
+    channel. It can be applied to time blocks of the signals.
+
+    Parameters
+    ----------
+    X : ndarray (electrodes, time)
+        Signals.
+    pairs : tuple of ndarray
+        Anodes and cathodes of each channel, see `bipolar_pairs`.
+    out : ndarray or None
+        Output array (n_pairs, time). If None, a new array is returned.
+    max_bytes : int
+        Maximum size of the gathered cathodes, the channels are referenced
+        in slabs of this size.
+
+    Returns
+    -------
+    out : ndarray (n_pairs, time)
+        Bipolar referenced signals.
+    """
+    anodes, cathodes = (np.asarray(p) for p in pairs)
+    if out is None:
+        out = np.empty((len(anodes), X.shape[1]), dtype=X.dtype)
+    slab = max(int(max_bytes // max(X.shape[1] * X.itemsize, 1)), 1)
+    for p0 in range(0, len(anodes), slab):
+        p1 = min(p0 + slab, len(anodes))
+        # Anodes gathered into the output, cathodes through a slab buffer
+        np.take(X, anodes[p0:p1], axis=0, out=out[p0:p1])
+        out[p0:p1] -= np.take(X, cathodes[p0:p1], axis=0)
+    return out
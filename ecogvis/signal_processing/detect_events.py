@@ -6,12 +6,12 @@ Detect CV (consonant-vowel) pair events in speaker and microphone channels.
 # Third party libraries
 import numpy as np
 import scipy.signal as sgn
-from process_nwb.resample import resample
+from ecogvis.signal_processing.resample import resample
 
 
 def detect_events(speaker_data, mic_data=None, interval=None, dfact=30,
                   smooth_width=0.4, speaker_threshold=0.05, mic_threshold=0.05,
-                  direction='both'):
+                  direction='both', resample_method='fft'):
     """
     Automatically detects events in audio signals.
 
@@ -36,6 +36,9 @@ def detect_events(speaker_data, mic_data=None, interval=None, dfact=30,
         'Up' detects events start times. 'Down' detects events stop times.
         'Both'
         detects both start and stop times.
+    resample_method : str
+        'fft' (default), or 'auto' for polyphase decimation when `dfact` is
+        an integer, which is faster and does not pad the signals.
 
     Returns
     -------
@@ -65,16 +68,7 @@ def detect_events(speaker_data, mic_data=None, interval=None, dfact=30,
         fs = speaker_data.rate  # sampling rate
         ds = fs / dfact
 
-        # Pad zeros to make signal length a power of 2, improves performance
-        nBins = X.shape[0]
-        extraBins = 2 ** (np.ceil(np.log2(nBins)).astype('int')) - nBins
-        extraZeros = np.zeros(extraBins)
-        X = np.append(X, extraZeros)
-        speakerDS = resample(X, ds, fs)
-
-        # Remove excess bins (because of zero padding on previous step)
-        excessBins = int(np.ceil(extraBins * ds / fs))
-        speakerDS = speakerDS[0:-excessBins]
+        speakerDS = _downsample(X, ds, fs, resample_method)
 
         # Kernel size must be an odd number
         speakerFilt = sgn.medfilt(
@@ -113,16 +107,7 @@ def detect_events(speaker_data, mic_data=None, interval=None, dfact=30,
         fs = mic_data.rate  # sampling rate
         ds = fs / dfact
 
-        # Pad zeros to make signal length a power of 2, improves performance
-        nBins = X.shape[0]
-        extraBins = 2 ** (np.ceil(np.log2(nBins)).astype('int')) - nBins
-        extraZeros = np.zeros(extraBins)
-        X = np.append(X, extraZeros)
-        micDS = resample(X, ds, fs)
-
-        # Remove excess bins (because of zero padding on previous step)
-        excessBins = int(np.ceil(extraBins * ds / fs))
-        micDS = micDS[0:-excessBins]
+        micDS = _downsample(X, ds, fs, resample_method)
 
         # Remove mic response to speaker
         micDS[np.where(speakerFilt > speaker_threshold)[0]] = 0
@@ -151,6 +136,23 @@ def detect_events(speaker_data, mic_data=None, interval=None, dfact=30,
     return speakerDS, speakerEventDS, speakerFilt, micDS, micEventDS, micFilt
 
 
+def _downsample(X, ds, fs, method):
+    """Downsamples audio X from fs to ds Hz."""
+    if method != 'fft':
+        return resample(X, ds, fs, method=method)
+
+    # Pad zeros to make signal length a power of 2, improves performance
+    nBins = X.shape[0]
+    extraBins = 2 ** (np.ceil(np.log2(nBins)).astype('int')) - nBins
+    extraZeros = np.zeros(extraBins)
+    X = np.append(X, extraZeros)
+    XDS = resample(X, ds, fs, method='fft')
+
+    # Remove excess bins (because of zero padding on previous step)
+    excessBins = int(np.ceil(extraBins * ds / fs))
+    return XDS[0:-excessBins]
+
+
 def threshcross(data, threshold=0, direction='up'):
     """
     Outputs the indices where the signal crossed the threshold.
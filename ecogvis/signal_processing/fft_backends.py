@@ -0,0 +1,253 @@
+"""
+FFT backends used by the signal processing functions (Hilbert transforms,
+line noise notch filters and power spectral densities).
+
+The backend is selected at runtime with `set_backend`:
+
+    from ecogvis.signal_processing import fft_backends
+    fft_backends.set_backend('pyfftw', workers=8, wisdom_file='fftw_wisdom.pkl')
+    print(fft_backends.backend_info())
+
+Available backends are 'scipy' (default, scipy.fft with multiple workers),
+'pyfftw' (FFTW plans are cached and their wisdom can be saved to a file, so
+that new processes do not plan the same transforms again) and 'numpy' (single
+threaded, always computes in double precision).
+"""
+from __future__ import division
+
+import atexit
+import os
+import pickle
+from contextlib import contextmanager
+
+import numpy as np
+from scipy import fft as sp_fft
+
+__all__ = ['FFTBackend',
+           'available_backends',
+           'backend_info',
+           'fft',
+           'get_backend',
+           'ifft',
+           'irfft',
+           'register_backend',
+           'rfft',
+           'set_backend']
+
+
+class FFTBackend(object):
+    """
+    numpy.fft backend, and base class of the other backends.
+
+    Parameters
+    ----------
+    workers : int
+        Number of threads of each transform, -1 for all CPUs (ignored by the
+        numpy backend).
+    """
+    name = 'numpy'
+
+    def __init__(self, workers=1):
+        if workers is not None and workers < 0:
+            workers = os.cpu_count()
+        self.workers = workers or 1
+
+    @staticmethod
+    def available():
+        """Whether the backend can be used (its package is installed)."""
+        return True
+
+    def fft(self, x, n=None, axis=-1, workers=None):
+        return np.fft.fft(x, n=n, axis=axis)
+
+    def ifft(self, x, n=None, axis=-1, workers=None):
+        return np.fft.ifft(x, n=n, axis=axis)
+
+    def rfft(self, x, n=None, axis=-1, workers=None):
+        return np.fft.rfft(x, n=n, axis=axis)
+
+    def irfft(self, x, n=None, axis=-1, workers=None):
+        return np.fft.irfft(x, n=n, axis=axis)
+
+    @contextmanager
+    def context(self):
+        """Context in which scipy functions (e.g. scipy.signal) use this
+        backend."""
+        yield
+
+    def info(self):
+        return {'name': self.name, 'workers': 1}
+
+
+class ScipyBackend(FFTBackend):
+    """scipy.fft backend, with multiple workers."""
+    name = 'scipy'
+
+    def fft(self, x, n=None, axis=-1, workers=None):
+        return sp_fft.fft(x, n=n, axis=axis, workers=workers or self.workers)
+
+    def ifft(self, x, n=None, axis=-1, workers=None):
+        return sp_fft.ifft(x, n=n, axis=axis, workers=workers or self.workers)
+
+    def rfft(self, x, n=None, axis=-1, workers=None):
+        return sp_fft.rfft(x, n=n, axis=axis, workers=workers or self.workers)
+
+    def irfft(self, x, n=None, axis=-1, workers=None):
+        return sp_fft.irfft(x, n=n, axis=axis, workers=workers or self.workers)
+
+    @contextmanager
+    def context(self):
+        with sp_fft.set_workers(self.workers):
+            yield
+
+    def info(self):
+        return {'name': self.name, 'workers': self.workers}
+
+
+class PyFFTWBackend(FFTBackend):
+    """
+    pyFFTW backend. Plans are cached between calls, and the FFTW wisdom is
+    loaded from `wisdom_file` (if it exists) and saved to it at exit.
+    """
+    name = 'pyfftw'
+
+    def __init__(self, workers=1, wisdom_file=None,
+                 planner_effort='FFTW_MEASURE'):
+        import pyfftw
+        import pyfftw.interfaces.scipy_fft
+        super(PyFFTWBackend, self).__init__(workers)
+        self._pyfftw = pyfftw
+        self._fft = pyfftw.interfaces.scipy_fft
+        pyfftw.interfaces.cache.enable()
+        pyfftw.config.NUM_THREADS = self.workers
+        pyfftw.config.PLANNER_EFFORT = planner_effort
+        self.planner_effort = planner_effort
+        self.wisdom_file = None
+        if wisdom_file is not None:
+            self.wisdom_file = os.path.abspath(os.path.expanduser(wisdom_file))
+            self.load_wisdom()
+            atexit.register(self.save_wisdom)
+
+    @staticmethod
+    def available():
+        try:
+            import pyfftw.interfaces.scipy_fft
+        except ImportError:
+            return False
+        return True
+
+    def load_wisdom(self):
+        if self.wisdom_file is not None and os.path.isfile(self.wisdom_file):
+            with open(self.wisdom_file, 'rb') as f:
+                self._pyfftw.import_wisdom(pickle.load(f))
+
+    def save_wisdom(self):
+        if self.wisdom_file is not None:
+            with open(self.wisdom_file, 'wb') as f:
+                pickle.dump(self._pyfftw.export_wisdom(), f)
+
+    def fft(self, x, n=None, axis=-1, workers=None):
+        return self._fft.fft(x, n=n, axis=axis, workers=workers or self.workers)
+
+    def ifft(self, x, n=None, axis=-1, workers=None):
+        return self._fft.ifft(x, n=n, axis=axis, workers=workers or self.workers)
+
+    def rfft(self, x, n=None, axis=-1, workers=None):
+        return self._fft.rfft(x, n=n, axis=axis, workers=workers or self.workers)
+
+    def irfft(self, x, n=None, axis=-1, workers=None):
+        return self._fft.irfft(x, n=n, axis=axis, workers=workers or self.workers)
+
+    @contextmanager
+    def context(self):
+        with sp_fft.set_backend(self._fft):
+            yield
+
+    def info(self):
+        return {'name': self.name, 'workers': self.workers,
+                'wisdom_file': self.wisdom_file,
+                'planner_effort': self.planner_effort}
+
+
+_registry = {'numpy': FFTBackend,
+             'scipy': ScipyBackend,
+             'pyfftw': PyFFTWBackend}
+_backend = ScipyBackend()
+
+
+def register_backend(name, backend_class):
+    """
+    Register a new backend, a subclass of `FFTBackend`.
+
+    Parameters
+    ----------
+    name : str
+        Name of the backend, used by `set_backend`.
+    backend_class : type
+        Backend class. Its constructor takes the keyword arguments given to
+        `set_backend`.
+    """
+    _registry[name] = backend_class
+
+
+def available_backends():
+    """Names of the registered backends that can be imported."""
+    return [name for name, backend_class in _registry.items()
+            if backend_class.available()]
+
+
+def set_backend(name='scipy', workers=1, **kwargs):
+    """
+    Select the FFT backend used by the signal processing functions.
+
+    Parameters
+    ----------
+    name : str
+        'scipy' (default), 'pyfftw', 'numpy' or any registered backend.
+    workers : int
+        Number of threads of each transform, -1 for all CPUs (default=1).
+    kwargs
+        Other backend options, e.g. `wisdom_file` and `planner_effort` for
+        'pyfftw'.
+
+    Returns
+    -------
+    backend : FFTBackend
+        The new backend.
+    """
+    global _backend
+    if name not in _registry:
+        raise ValueError('Unknown FFT backend {}, choose one of {}'.format(
+            name, sorted(_registry)))
+    _backend = _registry[name](workers=workers, **kwargs)
+    return _backend
+
+
+def get_backend():
+    """Current FFT backend."""
+    return _backend
+
+
+def backend_info():
+    """Name and options of the current FFT backend."""
+    return _backend.info()
+
+
+def fft(x, n=None, axis=-1, workers=None):
+    """FFT with the current backend."""
+    return _backend.fft(x, n=n, axis=axis, workers=workers)
+
+
+def ifft(x, n=None, axis=-1, workers=None):
+    """Inverse FFT with the current backend."""
+    return _backend.ifft(x, n=n, axis=axis, workers=workers)
+
+
+def rfft(x, n=None, axis=-1, workers=None):
+    """Real FFT with the current backend."""
+    return _backend.rfft(x, n=n, axis=axis, workers=workers)
+
+
+def irfft(x, n=None, axis=-1, workers=None):
+    """Inverse real FFT with the current backend."""
+    return _backend.irfft(x, n=n, axis=axis, workers=workers)
@@ -1,22 +1,21 @@
 from __future__ import division
-from process_nwb.wavelet_transform import gaussian,hamming
 import numpy as np
 
-from process_nwb.fft import fftfreq, fft, ifft
-try:
-    from accelerate.mkl.fftpack import fft, ifft
-except ImportError:
-    try:
-        from pyfftw.interfaces.numpy_fft import fft, ifft
-    except ImportError:
-        from numpy.fft import fft, ifft
+from ecogvis.signal_processing.fft_backends import fft, ifft, rfft
+from ecogvis.signal_processing.kernel_cache import gaussian_kernels, heaviside
 
 
 __authors__ = "Alex Bujan, Jesse Livezey"
-__all__ = ['hilbert_transform']
+__all__ = ['block_filter_bank',
+           'gaussian_filter_bank',
+           'hilbert_band_mean',
+           'hilbert_context',
+           'hilbert_filter_bank',
+           'hilbert_transform']
 
 
-def hilbert_transform(X, rate, filters=None, phase=None, X_fft_h=None):
+def hilbert_transform(X, rate, filters=None, phase=None, X_fft_h=None,
+                      use_rfft=False, dtype=np.complex128):
     """
     Apply bandpass filtering with Hilbert transform using
     a prespecified set of filters.
@@ -29,6 +28,14 @@ def hilbert_transform(X, rate, filters=None, phase=None, X_fft_h=None):
         Number of samples per second.
     filters : filter or list of filters (optional)
         One or more bandpass filters
+    use_rfft : bool
+        If True, the analytic signal is computed from the real FFT of X (only
+        the non-negative frequencies), and X_fft_h has n_time // 2 + 1
+        frequencies. Default is False.
+    dtype : numpy complex dtype
+        Precision of the analytic signal, only used when use_rfft is True.
+        With np.complex64, the FFTs are done in single precision (except
+        with the numpy FFT backend, see `fft_backends`).
 
     Returns
     -------
@@ -37,19 +44,11 @@ def hilbert_transform(X, rate, filters=None, phase=None, X_fft_h=None):
     """
     if not isinstance(filters, list):
         filters = [filters]
-    time = X.shape[-1]
-    freq = fftfreq(time, 1. / rate)
-
+    if use_rfft:
+        return _hilbert_rfft(X, rate, filters, phase, X_fft_h, dtype)
     Xh = np.zeros((len(filters),) + X.shape, dtype=np.complex)
     if X_fft_h is None:
-        # Heavyside filter
-        h = np.zeros(len(freq))
-        h[freq > 0] = 2.
-        h[0] = 1.
-        h = h[np.newaxis, :]
-        X_fft_h = fft(X) * h
-        if phase is not None:
-            X_fft_h *= phase
+        X_fft_h = _fft_heaviside(X, rate, phase)
     for ii, f in enumerate(filters):
         if f is None:
             Xh[ii] = ifft(X_fft_h)
@@ -60,3 +59,281 @@ def hilbert_transform(X, rate, filters=None, phase=None, X_fft_h=None):
         return Xh[0], X_fft_h
 
     return Xh, X_fft_h
+
+
+def _hilbert_rfft(X, rate, filters, phase, X_fft_h, dtype):
+    """Real FFT version of `hilbert_transform`."""
+    n_time = X.shape[-1]
+    Xh = np.zeros((len(filters),) + X.shape, dtype=dtype)
+    if X_fft_h is None:
+        X_fft_h = _rfft_heaviside(X, rate, phase, dtype)
+    n_freq = X_fft_h.shape[-1]
+    for ii, f in enumerate(filters):
+        if f is None:
+            Xh[ii] = ifft(X_fft_h, n=n_time)
+        else:
+            f = f[:n_freq] / np.linalg.norm(f)
+            Xh[ii] = ifft(X_fft_h * f.astype(X_fft_h.real.dtype),
+                          n=n_time)
+    if Xh.shape[0] == 1:
+        return Xh[0], X_fft_h
+
+    return Xh, X_fft_h
+
+
+def gaussian_filter_bank(n_time, rate, centers, sds, dtype='float64'):
+    """
+    Matrix of normalized Gaussian bandpass filters, one row per band.
+
+    Parameters
+    ----------
+    n_time : int
+        Number of time samples.
+    rate : float
+        Number of samples per second.
+    centers : array-like (n_bands,)
+        Filter centers [Hz].
+    sds : array-like (n_bands,)
+        Filter sigmas [Hz].
+    dtype : str
+        Precision of the filters, 'float64' (default) or 'float32', that of
+        the real FFT of complex64 analytic signals.
+
+    Returns
+    -------
+    filters : ndarray (n_bands, n_time)
+        Filters in the frequency domain, read-only and cached in
+        `kernel_cache`.
+    """
+    return gaussian_kernels(n_time, rate, centers, sds, dtype=dtype)
+
+
+def block_filter_bank(n_block, n_time, rate, centers, sds, block_rate=None,
+                      dtype='float64'):
+    """
+    Gaussian bandpass filters for blocks of `n_block` samples of a signal of
+    `n_time` samples, scaled so that the analytic amplitude of the blocks
+    matches the one of the whole signal filtered by
+    `gaussian_filter_bank(n_time, ...)`. The filters are normalized over
+    their frequencies, which are `n_time / n_block` times denser for the
+    whole signal (for blocks at the same rate).
+
+    Parameters
+    ----------
+    n_block : int
+        Number of time samples of the blocks.
+    n_time : int
+        Number of time samples of the whole signal.
+    rate : float
+        Number of samples per second.
+    centers : array-like (n_bands,)
+        Filter centers [Hz].
+    sds : array-like (n_bands,)
+        Filter sigmas [Hz].
+    block_rate : float or None
+        Sampling rate of the blocks, if they are decimated (see
+        `multirate`). If None, `rate`.
+    dtype : str
+        Precision of the filters, see `gaussian_filter_bank`.
+
+    Returns
+    -------
+    filters : ndarray (n_bands, n_block)
+        Filters in the frequency domain.
+    """
+    block_rate = rate if block_rate is None else block_rate
+    scale = (_gaussian_norms(n_block, block_rate, centers, sds) /
+             _gaussian_norms(n_time, rate, centers, sds))
+    filters = gaussian_filter_bank(n_block, block_rate, centers, sds, dtype)
+    return filters * scale[:, None].astype(dtype)
+
+
+def hilbert_context(rate, sds, tol=1e-6):
+    """
+    Number of samples of signal needed before and after a time block, so that
+    the Gaussian filters of sigmas `sds` have decayed to `tol` times their
+    peak. The impulse response of a Gaussian filter of sigma sd (Hz) has a
+    Gaussian envelope of sigma 1 / (2 pi sd) seconds.
+
+    Parameters
+    ----------
+    rate : float
+        Number of samples per second.
+    sds : array-like (n_bands,)
+        Filter sigmas [Hz].
+    tol : float
+        Relative amplitude of the impulse responses at the block edges.
+
+    Returns
+    -------
+    context : int
+    """
+    t_sd = 1. / (2 * np.pi * np.min(sds))
+    return int(np.ceil(np.sqrt(2 * np.log(1. / tol)) * t_sd * rate))
+
+
+def hilbert_filter_bank(X, rate, filters, phase=None, max_bytes=2**28,
+                        use_rfft=False, dtype=np.complex128, analytic=False):
+    """
+    Analytic amplitude of many channels in many bands. The FFT of each channel
+    is computed once and multiplied by the whole filter bank, and the inverse
+    FFTs are done in batches of bands and channels.
+
+    Parameters
+    ----------
+    X : ndarray (n_channels, n_time)
+        Input data.
+    rate : float
+        Number of samples per second.
+    filters : ndarray (n_bands, n_time)
+        Bandpass filters, e.g. from `gaussian_filter_bank`, preferably in
+        the precision of the real FFT when use_rfft is True (float32 for
+        complex64), which avoids their conversion.
+    phase : ndarray (optional)
+        Phase applied to the FFT of the signal.
+    max_bytes : int
+        Approximate memory limit of the complex analytic signal computed in
+        each batch.
+    use_rfft : bool
+        Compute the analytic signal from the real FFT of X, see
+        `hilbert_transform`.
+    dtype : numpy complex dtype
+        Precision of the analytic signal when use_rfft is True.
+    analytic : bool
+        If True, return the complex analytic signal instead of its amplitude.
+
+    Returns
+    -------
+    Xa : ndarray (n_bands, n_channels, n_time), float32
+        Bandpassed analytic amplitude, or analytic signal (complex, in
+        `dtype` when use_rfft is True) if analytic is True.
+    """
+    filters = np.atleast_2d(filters)
+    out_dtype = 'float32'
+    if analytic:
+        out_dtype = dtype if use_rfft else np.complex128
+    Xa = np.zeros((filters.shape[0],) + X.shape, dtype=out_dtype)
+    for (b0, b1), (c0, c1), Xab in _filter_bank_batches(
+            X, rate, filters, phase, max_bytes, use_rfft, dtype, analytic):
+        Xa[b0:b1, c0:c1] = Xab
+    return Xa
+
+
+def hilbert_band_mean(X, rate, filters, phase=None, max_bytes=2**28,
+                      use_rfft=False, dtype=np.complex128):
+    """
+    Analytic amplitude averaged over the bands of a filter bank, e.g. high
+    gamma. The average is accumulated in float32 as the bands are computed,
+    so memory does not grow with the number of bands.
+
+    Parameters
+    ----------
+    X : ndarray (n_channels, n_time)
+        Input data.
+    rate : float
+        Number of samples per second.
+    filters : ndarray (n_bands, n_time)
+        Bandpass filters, e.g. from `gaussian_filter_bank`, preferably in
+        the precision of the real FFT when use_rfft is True (float32 for
+        complex64), which avoids their conversion.
+    phase : ndarray (optional)
+        Phase applied to the FFT of the signal.
+    max_bytes : int
+        Approximate memory limit of the complex analytic signal computed in
+        each batch.
+    use_rfft : bool
+        Compute the analytic signal from the real FFT of X, see
+        `hilbert_transform`.
+    dtype : numpy complex dtype
+        Precision of the analytic signal when use_rfft is True.
+
+    Returns
+    -------
+    Xm : ndarray (n_channels, n_time), float32
+        Band-averaged analytic amplitude.
+    """
+    filters = np.atleast_2d(filters)
+    Xm = np.zeros(X.shape, dtype='float32')
+    for _, (c0, c1), Xab in _filter_bank_batches(
+            X, rate, filters, phase, max_bytes, use_rfft, dtype):
+        Xm[c0:c1] += Xab.sum(axis=0)
+    Xm /= filters.shape[0]
+    return Xm
+
+
+def _filter_bank_batches(X, rate, filters, phase, max_bytes, use_rfft, dtype,
+                         analytic=False):
+    """
+    Yield the analytic amplitude (or the analytic signal if `analytic`) of
+    `X` in batches of bands and channels, as ((b0, b1), (c0, c1), amplitude).
+    """
+    n_channels, n_time = X.shape
+    if use_rfft:
+        dtype = np.dtype(dtype)
+        X_fft_h = _rfft_heaviside(X, rate, phase, dtype)
+        # no copy for filters in the precision of the FFT (see the dtype of
+        # `gaussian_filter_bank`)
+        filters = filters[:, :X_fft_h.shape[-1]].astype(X_fft_h.real.dtype,
+                                                        copy=False)
+    else:
+        dtype = np.dtype('complex128')
+        X_fft_h = _fft_heaviside(X, rate, phase)
+
+    # complex batches of (bands, channels, time)
+    row_bytes = n_time * dtype.itemsize
+    n_ch = int(min(max(max_bytes // row_bytes, 1), n_channels))
+    n_bands = int(max(max_bytes // (row_bytes * n_ch), 1))
+
+    for c0 in range(0, n_channels, n_ch):
+        c1 = min(c0 + n_ch, n_channels)
+        for b0 in range(0, filters.shape[0], n_bands):
+            b1 = min(b0 + n_bands, filters.shape[0])
+            Xh = ifft(X_fft_h[np.newaxis, c0:c1] * filters[b0:b1, np.newaxis],
+                      n=n_time)
+            if analytic:
+                yield (b0, b1), (c0, c1), Xh
+            else:
+                yield (b0, b1), (c0, c1), abs(Xh).astype('float32')
+
+
+def _gaussian_norms(n_time, rate, centers, sds, width=12.):
+    """
+    L2 norms of the Gaussian filters of `gaussian_filter_bank` before their
+    normalization, computed from the frequencies within `width` sigmas of
+    the centers (the others are below the float64 precision).
+    """
+    df = rate / n_time
+    norms = []
+    for center, sd in zip(np.atleast_1d(centers), np.atleast_1d(sds)):
+        k0 = max(int(np.floor((center - width * sd) / df)), 0)
+        k1 = min(int(np.ceil((center + width * sd) / df)), n_time // 2)
+        k = np.arange(k0, k1 + 1)
+        g2 = np.exp(-(k * df - center) ** 2 / sd ** 2)
+        # positive frequencies 1 to (n_time - 1) // 2, negative frequencies
+        # -1 to -n_time // 2, and DC
+        count = ((k >= 1) & (k <= (n_time - 1) // 2)).astype(float) + \
+            (k >= 1) + (k == 0)
+        norms.append(np.sqrt(np.sum(count * g2)))
+    return np.array(norms)
+
+
+def _fft_heaviside(X, rate, phase=None):
+    """FFT of X along the last axis, times the Heaviside step function."""
+    h = heaviside(X.shape[-1], rate)
+    X_fft_h = fft(X) * h[np.newaxis, :]
+    if phase is not None:
+        X_fft_h *= phase
+    return X_fft_h
+
+
+def _rfft_heaviside(X, rate, phase=None, dtype=np.complex128):
+    """
+    Real FFT of X along the last axis, times the Heaviside step function
+    (the negative frequencies, including Nyquist, are implicitly zero).
+    """
+    real = np.finfo(dtype).dtype
+    X_fft_h = rfft(np.asarray(X, dtype=real), axis=-1)
+    X_fft_h *= heaviside(X.shape[-1], rate)[:X_fft_h.shape[-1]].astype(real)
+    if phase is not None:
+        X_fft_h *= phase
+    return np.atleast_2d(X_fft_h)
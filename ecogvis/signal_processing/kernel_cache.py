@@ -0,0 +1,175 @@
+"""
+Cache of the kernels of the filters (bandpass filters, analytic signal and
+line noise notch masks, resampling filters), shared by all processing
+functions. Kernels only depend on the signal length, sampling rate and
+filter parameters, so they can be reused when processing many blocks of the
+same length.
+"""
+from __future__ import division
+
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+import numpy as np
+from process_nwb.fft import fftfreq
+from process_nwb.wavelet_transform import gaussian
+
+__all__ = ['CacheInfo',
+           'KernelCache',
+           'gaussian_kernels',
+           'heaviside',
+           'kernel_cache']
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'size', 'nbytes',
+                                     'max_bytes'])
+
+
+class KernelCache(object):
+    """
+    Least recently used cache of read-only arrays, limited by their total
+    size in bytes.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Memory cap of the cache. Arrays larger than the cap are not cached.
+    """
+
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._nbytes = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, build):
+        """
+        Return the array stored for `key`, or build, store and return it.
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the array, e.g. ('gaussian', n_time, rate, centers, sds).
+        build : callable
+            Function without arguments that builds the array.
+
+        Returns
+        -------
+        value : ndarray
+            Cached (read-only) array.
+        """
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return self._items[key]
+            self.misses += 1
+
+        value = np.asarray(build())
+        value.setflags(write=False)
+        if value.nbytes > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = value
+                self._nbytes += value.nbytes
+            while self._nbytes > self.max_bytes:
+                _, old = self._items.popitem(last=False)
+                self._nbytes -= old.nbytes
+        return value
+
+    def cache_info(self):
+        """Hits, misses, number of arrays and bytes used by the cache."""
+        return CacheInfo(self.hits, self.misses, len(self._items),
+                         self._nbytes, self.max_bytes)
+
+    def clear(self):
+        """Remove all arrays and reset the counters."""
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+# cache shared by the decomposition functions
+kernel_cache = KernelCache()
+
+
+def gaussian_kernels(n_time, rate, centers, sds, cache=None,
+                     dtype='float64'):
+    """
+    Normalized Gaussian bandpass filters, one row per band.
+
+    Parameters
+    ----------
+    n_time : int
+        Number of time samples.
+    rate : float
+        Number of samples per second.
+    centers : array-like (n_bands,)
+        Filter centers [Hz].
+    sds : array-like (n_bands,)
+        Filter sigmas [Hz].
+    cache : KernelCache or None
+        Cache to use, `kernel_cache` by default.
+    dtype : str
+        Precision of the filters, 'float64' (default) or 'float32' (for
+        complex64 analytic signals), cached separately.
+
+    Returns
+    -------
+    filters : ndarray (n_bands, n_time)
+        Filters in the frequency domain (read-only).
+    """
+    cache = kernel_cache if cache is None else cache
+    dtype = np.dtype(dtype)
+    centers = tuple(np.atleast_1d(centers).astype(float).tolist())
+    sds = tuple(np.atleast_1d(sds).astype(float).tolist())
+
+    def build():
+        if dtype != np.float64:
+            return gaussian_kernels(n_time, rate, centers, sds,
+                                    cache).astype(dtype)
+        filters = np.zeros((len(centers), n_time))
+        for ii, (center, sd) in enumerate(zip(centers, sds)):
+            f = gaussian(n_time, rate, center, sd)
+            filters[ii] = f / np.linalg.norm(f)
+        return filters
+
+    return cache.get(('gaussian', int(n_time), float(rate), centers, sds,
+                      dtype.str), build)
+
+
+def heaviside(n_time, rate, cache=None):
+    """
+    Heaviside step function in the frequency domain (2 for positive
+    frequencies, 1 at DC and 0 for negative frequencies), which turns the FFT
+    of a real signal into the FFT of its analytic signal.
+
+    Parameters
+    ----------
+    n_time : int
+        Number of time samples.
+    rate : float
+        Number of samples per second.
+    cache : KernelCache or None
+        Cache to use, `kernel_cache` by default.
+
+    Returns
+    -------
+    h : ndarray (n_time,)
+        Analytic signal mask (read-only).
+    """
+    cache = kernel_cache if cache is None else cache
+
+    def build():
+        freq = fftfreq(n_time, 1. / rate)
+        h = np.zeros(len(freq))
+        h[freq > 0] = 2.
+        h[0] = 1.
+        return h
+
+    return cache.get(('heaviside', int(n_time), float(rate)), build)
@@ -0,0 +1,108 @@
+"""
+Line noise removal with notch filters applied in the frequency domain, to
+all channels of a signal at once.
+"""
+from __future__ import division
+
+import numpy as np
+
+from ecogvis.signal_processing.fft_backends import irfft, rfft
+from ecogvis.signal_processing.kernel_cache import kernel_cache
+
+__all__ = ['apply_linenoise_notch',
+           'notch_mask']
+
+
+def apply_linenoise_notch(X, rate, line_freq=60., harmonics=None,
+                          workers=None):
+    """
+    Apply notch filters at the line noise frequency and its harmonics.
+
+    All channels are filtered with one FFT call, and the notch mask is cached
+    (in `kernel_cache`) for each signal length, so it is only built once per
+    block size.
+
+    Parameters
+    ----------
+    X : ndarray (n_time, n_channels)
+        Input data.
+    rate : float
+        Number of samples per second.
+    line_freq : float
+        Line noise frequency (Hz, default=60).
+    harmonics : int or None
+        Number of notches, starting from `line_freq`. If None (default), all
+        harmonics below the Nyquist frequency are removed.
+    workers : int or None
+        Number of threads used by the FFTs. If None, the number of workers of
+        the FFT backend (see `fft_backends`).
+
+    Returns
+    -------
+    Xp : ndarray (n_time, n_channels)
+        Denoised data.
+    """
+    if rate / 2. < line_freq:
+        return X
+    n_time = X.shape[0]
+    npad = int(round(rate))
+    Xp = _pad(X, npad)
+
+    mask = notch_mask(Xp.shape[0], rate, line_freq, harmonics)
+    X_fft = rfft(Xp, axis=0, workers=workers)
+    X_fft *= mask.reshape((-1,) + (1,) * (X.ndim - 1))
+    Xp = irfft(X_fft, n=Xp.shape[0], axis=0, workers=workers)
+
+    return Xp[npad:npad + n_time]
+
+
+def notch_mask(n_time, rate, line_freq=60., harmonics=None, cache=None):
+    """
+    Gain of the notch filters at the frequencies of a real FFT of length
+    `n_time`. Each notch is a 2 Hz wide inverted Hamming window.
+
+    Parameters
+    ----------
+    n_time : int
+        Number of time samples.
+    rate : float
+        Number of samples per second.
+    line_freq : float
+        Line noise frequency (Hz).
+    harmonics : int or None
+        Number of notches. If None, all harmonics below Nyquist.
+    cache : KernelCache or None
+        Cache to use, `kernel_cache` by default.
+
+    Returns
+    -------
+    mask : ndarray (n_time // 2 + 1,)
+        Gain at each frequency (read-only).
+    """
+    cache = kernel_cache if cache is None else cache
+
+    def build():
+        delta = 1.
+        fs = np.fft.rfftfreq(n_time, 1. / rate)
+        notches = np.arange(line_freq, rate / 2., line_freq)
+        if harmonics is not None:
+            notches = notches[:harmonics]
+
+        mask = np.ones(len(fs))
+        for notch in notches:
+            window_mask = np.logical_and(fs > notch - delta,
+                                         fs < notch + delta)
+            mask[window_mask] *= 1. - np.hamming(window_mask.sum())
+        return mask
+
+    return cache.get(('notch', int(n_time), float(rate), float(line_freq),
+                      None if harmonics is None else int(harmonics)), build)
+
+
+def _pad(X, npad):
+    """Odd reflection padding of `npad` samples on both ends of axis 0."""
+    other_shape = X.shape[1:]
+    # need to pad with zeros if len(X) <= npad
+    z_pad = np.zeros((max(npad - len(X) + 1, 0),) + other_shape, dtype=X.dtype)
+    return np.concatenate([z_pad, 2 * X[[0]] - X[npad:0:-1], X,
+                           2 * X[[-1]] - X[-2:-npad - 2:-1], z_pad], axis=0)
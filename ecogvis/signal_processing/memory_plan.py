@@ -0,0 +1,480 @@
+"""
+Memory planning of the processing stages: estimates of the peak memory of
+each stage, from the shape, data type and chunks of its source data and
+from its configuration, and choice of the block and slab sizes that fit in
+a memory budget.
+
+Memory options of each stage:
+
+    'preprocess'             config['block_size'] (time blocks, in seconds)
+                             and config['max_bytes'] (channel slabs)
+    'preprocess_high_gamma'  config['block_size'], config['max_bytes'] and
+                             `max_bytes` (channel slabs and filter bank of
+                             High Gamma)
+    'decomposition'          `max_bytes` (channel slabs and filter bank),
+                             config['block_size'] (time blocks, in
+                             seconds) and config['dtype'] ('complex64')
+    'high_gamma'             as 'decomposition'
+    'psd'                    `max_bytes` (channel slabs)
+
+The estimates count the arrays allocated by the stages, not the buffers of
+HDF5 and of the FFT libraries, which are covered by a safety margin.
+
+Example:
+
+    >>> plan = plan_memory('EC100_B1.nwb', 'preprocess', config, max_memory=16)
+    >>> preprocess_raw_data('EC100_B1.nwb', plan.config)
+    >>> plan = plan_memory('EC100_B1.nwb', 'high_gamma', bands_vals, 16)
+    >>> high_gamma_estimation('EC100_B1.nwb', max_bytes=plan.max_bytes,
+    ...                       **plan.config)
+"""
+from __future__ import division
+
+import os
+from collections import namedtuple
+
+import h5py
+import numpy as np
+from scipy.fft import next_fast_len
+
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.hilbert_transform import hilbert_context
+from ecogvis.signal_processing.provenance import _attr_str
+from ecogvis.signal_processing.resample import resample_ratio
+from ecogvis.signal_processing.streaming import channel_bounds, \
+    rational_period
+
+__all__ = ['MemoryPlan',
+           'SourceInfo',
+           'estimate_memory',
+           'format_plan',
+           'plan_memory',
+           'process_memory',
+           'source_info']
+
+SourceInfo = namedtuple('SourceInfo', ['shape', 'dtype', 'chunks', 'rate'])
+
+MemoryPlan = namedtuple('MemoryPlan', ['stage', 'config', 'max_bytes', 'peak',
+                                       'budget'])
+
+# fraction of the budget used by the estimated peak
+_margin = 0.8
+# slab sizes tried by the planner, from the default down
+_slab_sizes = [2**k for k in range(28, 19, -1)]
+# shortest time block (seconds) of the streaming preprocessing
+_min_block_size = 1.
+
+
+def source_info(block_path, stage, config=None):
+    """
+    Shape, data type, chunks and rate of the source data of a stage: raw
+    signals for 'preprocess', 'preprocess_high_gamma' and 'psd' of type
+    'raw' (config={'type': 'raw'}), and LFP for the other stages.
+
+    Returns
+    -------
+    info : SourceInfo
+        Namedtuple with 'shape' (n_time, n_channels), 'dtype', 'chunks' (None
+        if not chunked) and 'rate' (Hz).
+    """
+    raw = stage in ('preprocess', 'preprocess_high_gamma') or (
+        stage == 'psd' and (config or {}).get('type', 'raw') == 'raw')
+    with h5py.File(block_path, 'r') as f:
+        series = None
+        if raw:
+            for obj in f['acquisition'].values():
+                if _attr_str(obj, 'neurodata_type') == 'ElectricalSeries':
+                    series = obj
+                    break
+        else:
+            series = f.get('processing/ecephys/LFP/preprocessed')
+        if series is None:
+            raise ValueError('No {} signals for {} in {}'.format(
+                'raw' if raw else 'preprocessed', stage, block_path))
+        data = series['data']
+        rate = series['starting_time'].attrs['rate']
+        return SourceInfo(tuple(data.shape), data.dtype, data.chunks,
+                          float(rate))
+
+
+def estimate_memory(info, stage, config, max_bytes=2**28):
+    """
+    Estimated peak memory of a stage, in bytes.
+
+    Parameters
+    ----------
+    info : SourceInfo
+        Source data of the stage, see `source_info`.
+    stage : str
+        'preprocess', 'preprocess_high_gamma', 'decomposition', 'high_gamma'
+        or 'psd'.
+    config : dict or ndarray
+        Configuration of the stage: the `config` of `preprocess_raw_data`,
+        the bands_vals array (2, nBands) of the decomposition stages (or a
+        dict of their keyword arguments, with 'bands_vals' and e.g.
+        'block_size', 'dtype' and 'output_rate'), or {'type': ...} for
+        'psd'.
+    max_bytes : int
+        `max_bytes` argument of the decomposition stages and of 'psd'.
+
+    Returns
+    -------
+    peak : int
+        Estimated peak memory (bytes).
+    """
+    if stage == 'preprocess':
+        return int(_preprocess_peak(info, config))
+    if stage == 'preprocess_high_gamma':
+        # High Gamma of the 8 default bands
+        lfp = SourceInfo(_lfp_shape(info, config), np.dtype('float32'), None,
+                         config.get('Downsample') or info.rate)
+        if config.get('block_size') is None:
+            # LFP kept in memory
+            return int(max(_preprocess_peak(info, config),
+                           np.prod(lfp.shape) * 4
+                           + _hilbert_peak(lfp, 8, max_bytes, 'high_gamma')))
+        # LFP blocks, and High Gamma time blocks of the same size read from
+        # them, with the samples kept for the first and last blocks
+        bands_vals = np.array([chang_lab['cfs'][29:37],
+                               chang_lab['sds'][29:37]])
+        n_fft = next_fast_len(int(round(config['block_size'] * lfp.rate))
+                              + 2 * hilbert_context(lfp.rate, bands_vals[1]))
+        return int(max(_preprocess_peak(info, config),
+                       _hilbert_block_peak(lfp, bands_vals, max_bytes,
+                                           'high_gamma', 'complex128',
+                                           config['block_size'], None, None))
+                   + 3 * n_fft * lfp.shape[1] * 4)
+    if stage in ('decomposition', 'high_gamma'):
+        options = _bands_options(config)
+        bands_vals = options['bands_vals']
+        dtype = options.get('dtype', 'complex128')
+        output_rate = options.get('output_rate')
+        if options.get('block_size') is None:
+            return int(_hilbert_peak(info, bands_vals.shape[1], max_bytes,
+                                     stage, dtype, output_rate))
+        return int(_hilbert_block_peak(info, bands_vals, max_bytes, stage,
+                                       dtype, options['block_size'],
+                                       options.get('block_context'),
+                                       output_rate))
+    if stage == 'psd':
+        return int(_psd_peak(info, max_bytes))
+    raise ValueError('Unknown stage {}'.format(stage))
+
+
+def plan_memory(block_path, stage, config, max_memory, overhead=None,
+                verbose=True):
+    """
+    Choose the block and slab sizes of a stage so that its estimated peak
+    memory fits in `max_memory`.
+
+    Slabs of channels are halved from 256 MB down to 1 MB. If the whole
+    recording does not fit in memory, preprocessing streams it in time
+    blocks (the 'block_size' of the configuration, if any, is reduced if
+    needed). The decomposition stages first try complex64 analytic signals,
+    then time blocks.
+
+    Parameters
+    ----------
+    block_path : str
+        Path of the NWB file.
+    stage : str
+        'preprocess', 'preprocess_high_gamma', 'decomposition', 'high_gamma'
+        or 'psd'.
+    config : dict or ndarray
+        Configuration of the stage, see `estimate_memory`.
+    max_memory : float
+        Memory limit of the process, in GB.
+    overhead : int or None
+        Memory already used by the process (bytes). If None, the current
+        size of the process, see `process_memory`.
+    verbose : bool
+        Print the plan (default=True).
+
+    Returns
+    -------
+    plan : MemoryPlan
+        Namedtuple with 'stage', 'config' (configuration with the memory
+        options, a dict of keyword arguments with 'bands_vals' for the
+        decomposition stages), 'max_bytes' (argument of the decomposition
+        stages and of 'psd'), 'peak' (estimated, bytes) and 'budget'
+        (bytes).
+
+    Raises
+    ------
+    MemoryError
+        If the stage does not fit in the budget with the smallest sizes.
+    """
+    info = source_info(block_path, stage, config)
+    if overhead is None:
+        overhead = process_memory()
+    budget = int((max_memory * 2**30 - overhead) * _margin)
+
+    plan = None
+    for config_, max_bytes in _candidates(info, stage, config):
+        peak = estimate_memory(info, stage, config_, max_bytes)
+        plan = MemoryPlan(stage, config_, max_bytes, peak, budget)
+        if peak <= budget:
+            break
+    else:
+        raise MemoryError(
+            '{} of {} needs about {:.2f} GB, more than the {:.2f} GB '
+            'available.'.format(stage, block_path, plan.peak / 2**30,
+                                max(budget, 0) / 2**30))
+    if verbose:
+        print(format_plan(plan))
+    return plan
+
+
+def format_plan(plan):
+    """One line description of a MemoryPlan."""
+    options = ['max_bytes={} MB'.format(plan.max_bytes // 2**20)]
+    if plan.stage in ('preprocess', 'preprocess_high_gamma'):
+        options = ['slabs={} MB'.format(plan.config.get('max_bytes', 2**28)
+                                        // 2**20)]
+        if plan.config.get('block_size') is not None:
+            options.append('block_size={} s'.format(plan.config['block_size']))
+        if plan.stage == 'preprocess_high_gamma':
+            options.append('max_bytes={} MB'.format(plan.max_bytes // 2**20))
+    elif plan.stage in ('decomposition', 'high_gamma'):
+        options.append('dtype={}'.format(plan.config['dtype']))
+        if plan.config.get('block_size') is not None:
+            options.append('block_size={} s'.format(plan.config['block_size']))
+    return 'Memory plan for {}: {}, peak ~{:.2f} GB of {:.2f} GB.'.format(
+        plan.stage, ', '.join(options), plan.peak / 2**30,
+        plan.budget / 2**30)
+
+
+def process_memory():
+    """Address space of the current process (bytes, 0 if not available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return 0
+
+
+def _candidates(info, stage, config):
+    """(config, max_bytes) tried by the planner, from the largest."""
+    if stage in ('preprocess', 'preprocess_high_gamma'):
+        if config.get('block_size') is None:
+            for slab in _slab_sizes:
+                yield dict(config, max_bytes=slab), \
+                    slab if stage == 'preprocess_high_gamma' else 2**28
+            if config.get('Downsample') is not None and resample_ratio(
+                    config['Downsample'], info.rate)[0] is None:
+                return      # no exact resampling period to stream
+            block_size = info.shape[0] / info.rate / 2
+        else:
+            block_size = config['block_size']
+        # streaming: time blocks of the whole recording at most
+        while block_size >= _min_block_size:
+            yield dict(config, block_size=float(np.floor(block_size))), 2**28
+            block_size /= 2
+    elif stage in ('decomposition', 'high_gamma'):
+        options = _bands_options(config)
+        dtypes = [str(np.dtype(options.get('dtype', 'complex128')))]
+        if dtypes[0] != 'complex64':
+            dtypes.append('complex64')
+        block_sizes = []
+        if options.get('block_size') is None:
+            block_sizes.append(None)
+            block_size = info.shape[0] / info.rate / 2
+        else:
+            block_size = options['block_size']
+        # then time blocks of the whole recording at most
+        while block_size >= _min_block_size:
+            block_sizes.append(float(np.floor(block_size)))
+            block_size /= 2
+        for block_size in block_sizes:
+            for dtype in dtypes:
+                for slab in _slab_sizes:
+                    yield dict(options, block_size=block_size,
+                               dtype=dtype), slab
+    else:
+        for slab in _slab_sizes:
+            yield config, slab
+
+
+def _bands_options(config):
+    """Keyword arguments of the decomposition stages, from their bands_vals
+    array or a dict of them."""
+    if isinstance(config, dict):
+        options = dict(config)
+    else:
+        options = {'bands_vals': config}
+    options['bands_vals'] = np.asarray(options['bands_vals'], dtype=float)
+    return options
+
+
+def _lfp_shape(info, config):
+    """Shape of the LFP computed from the raw signals."""
+    rate = config.get('Downsample') or info.rate
+    n_time = int(np.ceil(info.shape[0] * rate / info.rate))
+    n_channels = info.shape[1]
+    referencing = config.get('referencing')
+    if referencing is not None and referencing[0] == 'bipolar':
+        n_channels *= 2
+    return n_time, n_channels
+
+
+def _slab_channels(info, n_channels, n_time, itemsize, max_bytes):
+    """Channels of the first slab of `channel_blocks`."""
+    c0, c1 = channel_bounds(info, max_bytes // max(n_time * itemsize, 1))[0]
+    return min(c1 - c0, n_channels)
+
+
+def _preprocess_peak(info, config):
+    """Peak memory of `preprocess_raw_data`."""
+    n_in, n_channels = info.shape
+    s_in = np.dtype(info.dtype).itemsize
+    s = np.dtype(config.get('precision', 'float64')).itemsize
+    n_out, n_lfp = _lfp_shape(info, config)
+    ratio = n_out / n_in
+    max_bytes = config.get('max_bytes', 2**28)
+    downsample = config.get('Downsample') is not None
+    fft = config.get('resample', 'fft') == 'fft'
+    block_size = config.get('block_size')
+
+    def resampling(n):
+        """Temporary arrays of the resampling of n input samples."""
+        if not fft:
+            return 3 * s * n
+        # padded float64 signals, their FFT and the inverse FFT
+        npad = rational_period(info.rate, config['Downsample'])[0] \
+            if block_size is not None else int(info.rate)
+        return 24 * (n + 2 * npad)
+
+    if block_size is None:
+        X = n_channels * n_out * s
+        if downsample:
+            c = _slab_channels(info, n_channels, n_in, s, max_bytes)
+            read = X + c * (n_in * (s_in + s) + resampling(n_in)
+                            + n_out * 8)
+        else:
+            read = n_in * n_channels * (s_in + s)
+        referencing = X + _referencing_bytes(config, n_channels, n_out, s)
+        X = n_lfp * n_out * s
+        notch = X + 3 * min(max_bytes, X)
+        # float32 LFP, and its contiguous copy written by h5py
+        output = n_lfp * n_out * 4 * (2 if s == 4 else 3)
+        return max(read, referencing, notch, output)
+
+    context = config.get('block_context', 4.)
+    rate = info.rate * ratio
+    n_block = int(np.ceil(block_size * rate))
+    B = n_block + 2 * int(np.ceil(context * rate))
+    b_in = int(np.ceil(B / ratio))
+    read = b_in * n_channels * (s_in + s)
+    if downsample:
+        read += n_channels * (resampling(b_in) + B * 8)
+    block = B * n_channels * s
+    referencing = block + _referencing_bytes(config, n_channels, B, s)
+    block = B * n_lfp * s
+    # padded signals, their FFT and the inverse FFT
+    notch = block + 3 * (B + 2 * int(rate)) * n_lfp * s
+    output = block + n_block * n_lfp * 4 * 2
+    # chunk cache of the source (see `with_chunk_cache`)
+    cache = min(max(2 * (B - n_block) / ratio * n_channels * s_in, 2**20),
+                2**29) if info.chunks is not None else 0
+    return max(read, referencing, notch, output) + cache
+
+
+def _referencing_bytes(config, n_channels, n_time, s):
+    """Temporary arrays of the referencing of (n_channels, n_time) signals."""
+    referencing = config.get('referencing')
+    if referencing is None:
+        return 0
+    if referencing[0] == 'bipolar':
+        return 2 * n_channels * n_time * s
+    if referencing[0] == 'CAR' and referencing[1] != 'device':
+        return min(2**26, n_channels * n_time * s)
+    return min(2**21, n_channels * n_time * s)
+
+
+def _hilbert_peak(info, n_bands, max_bytes, stage, dtype='complex128',
+                  output_rate=None):
+    """Peak memory of `spectral_decomposition` and `high_gamma_estimation`."""
+    n_time, n_channels = info.shape
+    n_freq = n_time // 2 + 1
+    n_out = _output_samples(n_time, info.rate, output_rate)
+    s = np.dtype(dtype).itemsize
+    c = _slab_channels(info, n_channels, n_time, 4, max_bytes)
+    # float32 slab read and scaled, its FFT, and the filters (float64 and in
+    # the precision of the FFT, see `kernel_cache.gaussian_kernels`)
+    fixed = n_time * c * (8 + s) + n_bands * n_freq * (8 + s // 2)
+    batch = _batch_bytes(n_time, c, n_bands, s, max_bytes)
+    if stage == 'decomposition':
+        # power of all bands, and its copy written by h5py
+        power = n_bands * n_out * n_channels * s // 2
+        # float32 power of a slab, and its copy decimated to output_rate
+        slab = n_bands * n_time * c * 4
+        decimation = slab if output_rate is not None else 0
+        return max(power + slab + fixed + max(batch, decimation), 2 * power)
+    # High Gamma and its accumulator
+    return n_channels * n_out * 4 + c * n_time * 4 + fixed + batch
+
+
+def _hilbert_block_peak(info, bands_vals, max_bytes, stage, dtype,
+                        block_size, block_context, output_rate):
+    """Peak memory of the decomposition stages in time blocks (see
+    `processing_data._hilbert_time_blocks`)."""
+    n_time, n_channels = info.shape
+    n_bands = bands_vals.shape[1]
+    s = np.dtype(dtype).itemsize
+    if block_context is None:
+        context = hilbert_context(info.rate, bands_vals[1, :])
+    else:
+        context = int(np.ceil(block_context * info.rate))
+    n_fft = next_fast_len(int(round(block_size * info.rate)) + 2 * context)
+    if n_fft >= n_time:
+        n_fft, context = n_time, 0
+    n_block = n_fft - 2 * context
+    n_freq = n_fft // 2 + 1
+    # all channels of a block read, scaled and transformed, and the filters
+    fixed = n_fft * n_channels * (8 + s) + n_bands * n_freq * (8 + s // 2)
+    batch = _batch_bytes(n_fft, n_channels, n_bands, s, max_bytes)
+    if stage == 'decomposition':
+        # float32 power of the blocks (the next one is computed before the
+        # previous one is released), the block in the precision of dtype,
+        # and its copy written by h5py or decimated to output_rate
+        amplitude = n_bands * n_channels * n_fft * 4
+        block = n_bands * n_channels * n_block * s // 2
+        if output_rate is not None:
+            output = amplitude + 3 * block + block * output_rate // info.rate
+        else:
+            output = amplitude + 2 * block
+        peak = max(2 * amplitude + batch, output)
+    else:
+        peak = n_channels * (3 * n_fft + n_block) * 4 + batch
+    # chunk cache of the LFP (see `with_chunk_cache`)
+    cache = min(max(n_fft * n_channels * 4, 2**20), 2**29) \
+        if info.chunks is not None else 0
+    return fixed + peak + cache
+
+
+def _batch_bytes(n_time, n_channels, n_bands, s, max_bytes):
+    """Complex analytic signals of a batch of bands and channels (see
+    `hilbert_transform._filter_bank_batches`), and their amplitude."""
+    batch_channels = int(min(max(max_bytes // (n_time * s), 1), n_channels))
+    batch_bands = min(max(max_bytes // (n_time * s * batch_channels), 1),
+                      n_bands)
+    return 2 * batch_bands * batch_channels * n_time * s
+
+
+def _output_samples(n_time, rate, output_rate):
+    """Samples of the outputs stored at output_rate."""
+    if output_rate is None:
+        return n_time
+    return int(np.ceil(n_time * output_rate / rate))
+
+
+def _psd_peak(info, max_bytes):
+    """Peak memory of `psd_estimate`."""
+    n_time, n_channels = info.shape
+    s_in = np.dtype(info.dtype).itemsize
+    c = _slab_channels(info, n_channels, n_time, 8, max_bytes)
+    # Welch and periodogram spectra below 200 Hz
+    n_welch = 200. / info.rate * 2**np.ceil(np.log2(info.rate / .05))
+    n_fft = 200. / info.rate * 2**np.floor(np.log2(n_time))
+    # slab, Welch segments, their FFTs and the periodogram FFT
+    return n_time * c * (s_in + 20) + (n_welch + n_fft) * n_channels * 8
@@ -0,0 +1,208 @@
+"""
+Multirate filter bank: each band of a decomposition is computed at the
+lowest rate of an octave pyramid (the LFP rate halved 0, 1, 2... times)
+that holds it, e.g. at 400 Hz the Chang lab bands below 20 Hz are computed
+at 50 Hz, with 8 times fewer samples than at the LFP rate.
+
+A band is held by a pyramid level if its filter vanishes (below 1e-8 of its
+peak) under `passband` times the level rate, where the lowpass filter of the
+halvings is flat (to 1e-4) and the aliases of the higher frequencies are
+attenuated (below 1e-4). The frequencies of the filters are the same at all
+levels, so the amplitude of the bands matches the one computed at the LFP
+rate (see `hilbert_transform.block_filter_bank`), within 1e-4 of its
+maximum, except within 0.5 s of the ends of recordings whose number of
+samples is not a multiple of 2**level, where the FFT of the whole recording
+wraps around.
+
+The analytic signal of a band is held by its level too, so it can be
+upsampled back to the LFP rate (see `upsample`) with the same accuracy. Its
+amplitude is not band limited and cannot be upsampled accurately.
+
+On 16 channels, 10 min at 400 Hz, the 40 Chang lab bands are computed 1.8x
+faster than at the LFP rate and take 1.9x less space. Upsampling them back
+to the LFP rate costs more than the FFTs it saves (1.8x slower than at the
+LFP rate). See benchmarks/bench_multirate.py.
+"""
+from __future__ import division
+
+import numpy as np
+from scipy.signal import upfirdn
+
+from ecogvis.signal_processing.hilbert_transform import block_filter_bank, \
+    hilbert_filter_bank
+from ecogvis.signal_processing.resample import polyphase_filter
+
+__all__ = ['band_levels',
+           'halve',
+           'multirate_filter_bank',
+           'upsample']
+
+# filter of the halvings and of the upsampling, see `resample.polyphase_filter`
+_half_width = 16
+_beta = 8.
+
+
+def band_levels(rate, centers, sds, width=6., passband=.4, max_level=None):
+    """
+    Pyramid level of each band: the number of halvings of `rate` after which
+    centers + width * sds is still below `passband` times the rate.
+
+    Parameters
+    ----------
+    rate : float
+        Sampling rate of the signals (Hz).
+    centers : array-like (n_bands,)
+        Filter centers [Hz].
+    sds : array-like (n_bands,)
+        Filter sigmas [Hz].
+    width : float
+        Number of sigmas above the center that should be held by a level.
+    passband : float
+        Highest frequency held by a level, in units of its rate.
+    max_level : int or None
+        Largest number of halvings.
+
+    Returns
+    -------
+    levels : ndarray (n_bands,) of int
+    """
+    top = np.asarray(centers, dtype=float) + \
+        width * np.asarray(sds, dtype=float)
+    levels = np.floor(np.log2(passband * rate / top))
+    levels = np.maximum(levels, 0).astype(int)
+    if max_level is not None:
+        levels = np.minimum(levels, max_level)
+    return levels
+
+
+def halve(X, dtype=None):
+    """
+    Decimate signals by 2 along their last axis, with a lowpass FIR filter
+    (see `resample.polyphase_filter`). The signals are taken as periodic, as
+    in the FFT of the whole signals.
+
+    Parameters
+    ----------
+    X : ndarray (..., n_time)
+        Signals.
+    dtype : numpy float dtype or None
+        Precision of the computations and of the output, X.dtype if None.
+
+    Returns
+    -------
+    Xh : ndarray (..., ceil(n_time / 2))
+        Sample m is at the time of sample 2 * m of X.
+    """
+    dtype = X.dtype if dtype is None else dtype
+    return _periodic_resample(X, 1, 2, dtype)
+
+
+def upsample(X, factor, n_time=None):
+    """
+    Upsample periodic signals (e.g. the analytic signal of a pyramid level)
+    by an integer factor along their last axis.
+
+    Parameters
+    ----------
+    X : ndarray (..., n), real or complex
+        Signals.
+    factor : int
+        Upsampling factor.
+    n_time : int or None
+        Number of output samples (at most n * factor).
+
+    Returns
+    -------
+    Xu : ndarray (..., n_time), in the dtype of X.
+    """
+    if factor == 1:
+        return X[..., :n_time]
+    if np.iscomplexobj(X):
+        real = np.finfo(X.dtype).dtype
+        n_time = X.shape[-1] * factor if n_time is None else n_time
+        Xu = np.empty(X.shape[:-1] + (n_time,), dtype=X.dtype)
+        Xu.real = _periodic_resample(X.real, factor, 1, real)[..., :n_time]
+        Xu.imag = _periodic_resample(X.imag, factor, 1, real)[..., :n_time]
+        return Xu
+    return _periodic_resample(X, factor, 1, X.dtype)[..., :n_time]
+
+
+def _periodic_resample(X, up, down, dtype):
+    """
+    Polyphase resampling of periodic signals along their last axis (the
+    contiguous one, where `upfirdn` is the fastest).
+    """
+    h = polyphase_filter(up, down, _half_width, _beta).astype(dtype)
+    half = (len(h) - 1) // 2
+    # delay the filter so that output m is at input m * down / up
+    shift = -half % down
+    h = np.concatenate([np.zeros(shift, dtype=dtype), h])
+    # wrapped samples before and after the signals, a multiple of down
+    n_edge = -(-half // up)
+    n_edge = -(-n_edge // down) * down
+    n_time = X.shape[-1]
+    Xp = np.concatenate([X[..., n_time - n_edge:], X, X[..., :n_edge]],
+                        axis=-1).astype(dtype, copy=False)
+    start = (half + shift) // down + n_edge * up // down
+    Y = upfirdn(h, Xp, up, down, axis=-1)
+    return Y[..., start:start - (-n_time * up // down)]
+
+
+def multirate_filter_bank(X, rate, centers, sds, levels=None,
+                          max_bytes=2**28, dtype=np.complex128,
+                          analytic=False):
+    """
+    Analytic amplitude of many channels in many bands, each band computed at
+    its pyramid level (see `band_levels`).
+
+    Parameters
+    ----------
+    X : ndarray (n_channels, n_time)
+        Input data.
+    rate : float
+        Number of samples per second.
+    centers : array-like (n_bands,)
+        Filter centers [Hz].
+    sds : array-like (n_bands,)
+        Filter sigmas [Hz].
+    levels : array-like (n_bands,) or None
+        Pyramid level of each band, `band_levels` if None.
+    max_bytes : int
+        Approximate memory limit of the complex analytic signal computed in
+        each batch, see `hilbert_filter_bank`.
+    dtype : numpy complex dtype
+        Precision of the analytic signal.
+    analytic : bool
+        If True, yield the complex analytic signal instead of its amplitude.
+
+    Yields
+    ------
+    level : int
+        Pyramid level, from the highest rate to the lowest one.
+    bands : ndarray of int
+        Indices of the bands of the level.
+    Xa : ndarray (len(bands), n_channels, ceil(n_time / 2**level)), float32
+        Bandpassed analytic amplitude (or analytic signal, in `dtype`), at
+        rate / 2**level.
+    """
+    centers = np.asarray(centers, dtype=float)
+    sds = np.asarray(sds, dtype=float)
+    if levels is None:
+        levels = band_levels(rate, centers, sds)
+    levels = np.asarray(levels)
+    n_time = X.shape[-1]
+    Xl = X
+    for level in range(levels.max() + 1):
+        if level > 0:
+            Xl = halve(Xl)
+        bands = np.flatnonzero(levels == level)
+        if len(bands) == 0:
+            continue
+        level_rate = rate / 2**level
+        filters = block_filter_bank(Xl.shape[-1], n_time, rate, centers[bands],
+                                    sds[bands], block_rate=level_rate,
+                                    dtype=np.finfo(np.dtype(dtype)).dtype)
+        yield level, bands, hilbert_filter_bank(Xl, level_rate, filters,
+                                                max_bytes=max_bytes,
+                                                use_rfft=True, dtype=dtype,
+                                                analytic=analytic)
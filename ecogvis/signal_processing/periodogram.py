@@ -4,8 +4,13 @@ from pynwb import NWBHDF5IO, ProcessingModule
 from pynwb.ecephys import ElectricalSeries
 from ndx_spectrum import Spectrum
 
+from ecogvis.signal_processing.fft_backends import get_backend
+from ecogvis.signal_processing.provenance import stage_status, \
+    stamp_provenance
+from ecogvis.signal_processing.streaming import channel_blocks
 
-def psd_estimate(src_file, type):
+
+def psd_estimate(src_file, type, max_bytes=2**28):
     """
     Estimates Power Spectral Density from signals.
 
@@ -15,7 +20,21 @@ def psd_estimate(src_file, type):
         Full path to the current NWB file.
     type : str
         ElectricalSeries source. 'raw' or 'preprocessed'.
+    max_bytes : int
+        Approximate memory limit of the slabs of channels transformed at
+        once (default=256 MB), see `memory_plan`.
+
+    Returns
+    -------
+    Saves the Welch and FFT spectra in the current NWB file, with their
+    provenance. Spectra up to date with their source are not recomputed.
     """
+    from ecogvis.signal_processing.processing_data import _check_stage
+
+    stage, config = 'psd_' + type, {'type': type}
+    if not _check_stage(src_file, stage, config, 'Spectrum_*_' + type):
+        return
+    _, provenance = stage_status(src_file, stage, config)
 
     # Open file
     with NWBHDF5IO(src_file, mode='r+', load_namespaces=True) as io:
@@ -39,21 +58,21 @@ def psd_estimate(src_file, type):
         # FFT - using a power of 2 number of samples improves performance
         nfft = int(2**(np.floor(np.log2(nSamples)).astype('int')))
         fx_lim = 200.
-        for ch in np.arange(nChannels):  # Iterate over channels
-            trace = data_obj.data[:, ch]
-            fx_w, py_w = sgn.welch(trace, fs=fs, nperseg=win_len_welch)
-            fx_f, py_f = sgn.periodogram(trace, fs=fs, nfft=nfft)
-            # saves PSD up to 200 Hz
-            py_w = py_w[fx_w < fx_lim]
-            fx_w = fx_w[fx_w < fx_lim]
-            py_f = py_f[fx_f < fx_lim]
-            fx_f = fx_f[fx_f < fx_lim]
-            if ch == 0:
-                PY_welch = py_w.reshape(-1, 1)
-                PY_fft = py_f.reshape(-1, 1)
-            else:
-                PY_welch = np.append(PY_welch, py_w.reshape(-1, 1), axis=1)
-                PY_fft = np.append(PY_fft, py_f.reshape(-1, 1), axis=1)
+        # Iterate over slabs of channels, all channels of a slab are
+        # transformed at once by the FFT backend
+        PY_welch, PY_fft = None, None
+        with get_backend().context():
+            for c0, c1, traces in channel_blocks(data_obj.data, max_bytes=max_bytes):
+                fx_w, py_w = sgn.welch(traces, fs=fs, nperseg=win_len_welch, axis=0)
+                fx_f, py_f = sgn.periodogram(traces, fs=fs, nfft=nfft, axis=0)
+                # saves PSD up to 200 Hz
+                if PY_welch is None:
+                    PY_welch = np.zeros((np.sum(fx_w < fx_lim), nChannels), dtype=py_w.dtype)
+                    PY_fft = np.zeros((np.sum(fx_f < fx_lim), nChannels), dtype=py_f.dtype)
+                PY_welch[:, c0:c1] = py_w[fx_w < fx_lim]
+                PY_fft[:, c0:c1] = py_f[fx_f < fx_lim]
+        fx_w = fx_w[fx_w < fx_lim]
+        fx_f = fx_f[fx_f < fx_lim]
 
         # vElectrodes
         elecs_region = nwb.electrodes.create_region(name='electrodes',
@@ -86,5 +105,7 @@ def psd_estimate(src_file, type):
         ecephys_module.add_data_interface(spectrum_module_fft)
 
         io.write(nwb)
-        print('Spectrum_welch_' + type + ' added to file.')
-        print('Spectrum_fft_' + type + ' added to file.')
+    stamp_provenance(src_file, ['Spectrum_welch_' + type,
+                                'Spectrum_fft_' + type], provenance)
+    print('Spectrum_welch_' + type + ' added to file.')
+    print('Spectrum_fft_' + type + ' added to file.')
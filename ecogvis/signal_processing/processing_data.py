@@ -2,24 +2,48 @@ from __future__ import print_function, division
 
 import time
 import os
+import json
 import numpy as np
 import warnings
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
 
+import h5py
+from hdmf.backends.hdf5 import H5DataIO
 from pynwb import NWBHDF5IO, ProcessingModule
 from pynwb.ecephys import LFP, ElectricalSeries
-from pynwb.core import DynamicTable, VectorData
+from pynwb.core import DynamicTable, ElementIdentifiers, VectorData
 from pynwb.misc import DecompositionSeries
 
-from ecogvis.signal_processing.hilbert_transform import hilbert_transform
-from process_nwb.wavelet_transform import gaussian
-from process_nwb.resample import resample
-from process_nwb.linenoise_notch import apply_linenoise_notch
-from ecogvis.signal_processing.common_referencing import subtract_CAR, \
-    subtract_CAR_by_device
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.fft_backends import backend_info
+from ecogvis.signal_processing.hilbert_transform import block_filter_bank, \
+    gaussian_filter_bank, hilbert_band_mean, hilbert_context, \
+    hilbert_filter_bank
+from process_nwb.resample import resample_func
+from scipy.fft import next_fast_len
+from ecogvis.signal_processing.common_referencing import bipolar_pairs, \
+    bipolar_reference, subtract_CAR, subtract_CAR_by_device, subtract_CMR
+from ecogvis.signal_processing.linenoise_notch import apply_linenoise_notch
+from ecogvis.signal_processing.multirate import band_levels, \
+    multirate_filter_bank, upsample
+from ecogvis.signal_processing.phase import phase_conversion, \
+    quantize_phase
+from ecogvis.signal_processing.provenance import pending_comments, \
+    remove_outputs, stage_provenance, stage_status, stamp_provenance
+from ecogvis.signal_processing.resample import Resampler, resample, \
+    resample_ratio
+from ecogvis.signal_processing.storage import data_io
+from ecogvis.signal_processing.streaming import BlockIterator, \
+    BlockReader, channel_blocks, channel_bounds, circular_blocks, time_blocks, \
+    with_chunk_cache
 from ecogvis.functions.nwb_copy_file import nwb_copy_file
 
 
-def processing_data(path, subject, blocks, mode=None, config=None, new_file=''):
+def processing_data(path, subject, blocks, mode=None, config=None, new_file='',
+                    max_bytes=2**28, storage=None, block_size=None,
+                    multirate=None, output_rate=None, phase=False,
+                    bands_vals=None, dtype='complex128'):
     for block in blocks:
         block_path = os.path.join(path, '{}_B{}.nwb'.format(subject, block))
         if new_file != '':
@@ -27,10 +51,22 @@ def processing_data(path, subject, blocks, mode=None, config=None, new_file=''):
 
         if mode == 'preprocess':
             preprocess_raw_data(block_path, config=config)
+        elif mode == 'preprocess_high_gamma':
+            preprocess_high_gamma(block_path, config=config,
+                                  bands_vals=bands_vals,
+                                  max_bytes=max_bytes, dtype=dtype,
+                                  storage=storage, output_rate=output_rate)
         elif mode == 'decomposition':
-            spectral_decomposition(block_path, bands_vals=config)
+            spectral_decomposition(block_path, bands_vals=config,
+                                   max_bytes=max_bytes, dtype=dtype,
+                                   storage=storage, block_size=block_size,
+                                   multirate=multirate,
+                                   output_rate=output_rate, phase=phase)
         elif mode == 'high_gamma':
-            high_gamma_estimation(block_path, bands_vals=config, new_file=new_file)
+            high_gamma_estimation(block_path, bands_vals=config, new_file=new_file,
+                                  max_bytes=max_bytes, dtype=dtype,
+                                  storage=storage, block_size=block_size,
+                                  output_rate=output_rate)
 
 
 def make_new_nwb(old_file, new_file, cp_objs=None):
@@ -108,156 +144,965 @@ def preprocess_raw_data(block_path, config):
     config : dictionary
         'referencing' - tuple specifying electrode referencing (type, options)
             ('CAR', N_channels_per_group)
-            ('CMR', N_channels_per_group)
+            ('CAR', 'device') - one reference per device of the electrodes
+            ('CMR', N_channels_per_group) - common median reference
+            ('CMR', 'device')
             ('bipolar', INCLUDE_OBLIQUE_NBHD)
+            CAR and CMR by channel groups take an optional third element,
+            'exclude_bad_channels', to leave bad channels out of the
+            references.
         'Notch' - Main frequency (Hz) for notch filters (default=60)
         'Downsample' - Downsampling frequency (Hz, default= 400)
+        'block_size' - (optional) Length (seconds) of the time blocks used to
+            stream the signals. If None (default), the whole recording is
+            processed at once. Streaming needs a rational ratio of the
+            sampling rates (see `resample.resample_ratio`).
+        'block_context' - (optional) Length (seconds) of signal read before
+            and after each time block, to avoid edge effects from
+            resampling and notch filtering (default=4).
+        'n_jobs' - (optional) Number of processes used to downsample
+            channels in parallel when the whole recording is processed at
+            once, and of threads used by the notch filter FFTs (default=1).
+        'resample' - (optional) Downsampling method, 'fft' (default),
+            'poly' (polyphase FIR, for rational ratios of rates) or 'auto'
+            ('poly' if possible, else 'fft'), see `resample.resample`.
+        'precision' - (optional) Floating point type of the signals during
+            preprocessing, 'float64' (default) or 'float32', which halves
+            the memory of the buffers. The LFP is stored in float32 in both
+            cases.
+        'max_bytes' - (optional) Approximate memory limit of the slabs of
+            channels downsampled and notch filtered at once (default=256 MB),
+            see `memory_plan`.
+        'storage' - (optional) HDF5 chunk shape and compression of the LFP,
+            see `storage.storage_options` (default: chunks of 1 s by 16
+            channels, uncompressed).
 
     Returns
     -------
-    Saves preprocessed signals (LFP) in the current NWB file.
-    Only if containers for these data do not exist in the current file.
+    Saves preprocessed signals (LFP) in the current NWB file, with the
+    provenance of the LFP (hash of the source data, config and code version)
+    as comments, stored once the LFP is fully written. It is skipped if the
+    LFP exists with the same provenance, and recomputed if its provenance
+    changed or its write was interrupted (see `provenance`).
     """
-    subj_path, block_name = os.path.split(block_path)
     block_name = os.path.splitext(block_path)[0]
-    start = time.time()
+
+    if not _check_stage(block_path, 'preprocess', config, 'LFP'):
+        return
+    _, provenance = stage_status(block_path, 'preprocess', config)
 
     with NWBHDF5IO(block_path, 'r+', load_namespaces=True) as io:
         nwb = io.read()
-
-        # Storage of processed signals on NWB file ----------------------------
-        if 'ecephys' in nwb.processing:
-            ecephys_module = nwb.processing['ecephys']
-        else:   # creates ecephys ProcessingModule
-            ecephys_module = ProcessingModule(
-                name='ecephys',
-                description='Extracellular electrophysiology data.'
-            )
-            # Add module to NWB file
-            nwb.add_processing_module(ecephys_module)
-            print('Created ecephys')
+        ecephys_module = _get_ecephys_module(nwb)
 
         # LFP: Downsampled and power line signal removed ----------------------
-        if 'LFP' in nwb.processing['ecephys'].data_interfaces:
-            warnings.warn('LFP data already exists in the nwb file. Skipping preprocessing.')
-        else:  # creates LFP data interface container
-            lfp = LFP()
-
-            # Data source
-            source_list = [acq for acq in nwb.acquisition.values()
-                           if type(acq) == ElectricalSeries]
-            assert len(source_list) == 1, (
-                'Not precisely one ElectricalSeries in acquisition!')
-            source = source_list[0]
-            nChannels = source.data.shape[1]
-
-            # Downsampling
+        source = _get_raw_source(nwb)
+        if config.get('block_size') is None:
+            X, rate, electrodes, bipolarTable = _preprocess_in_memory(
+                source, config, nwb, block_name)
+        else:
+            X, rate, electrodes, bipolarTable, _ = _preprocess_streaming(
+                source, config, nwb, block_name)
+        _add_lfp(ecephys_module, provenance, X, rate, electrodes,
+                 bipolarTable, block_path, config.get('storage'))
+
+        # Write LFP to NWB file
+        io.write(nwb)
+    stamp_provenance(block_path, ['LFP/preprocessed'], provenance)
+    print('LFP saved in ' + block_path)
+
+
+def preprocess_high_gamma(block_path, config, bands_vals=None,
+                          max_bytes=2**28, dtype='complex128', storage=None,
+                          output_rate=None):
+    """
+    Takes raw data and runs preprocessing (see `preprocess_raw_data`) and
+    High Gamma estimation (see `high_gamma_estimation`) in a single pass.
+
+    The High Gamma power is computed from the LFP while it is written, so the
+    LFP is not read back from the file. If config['block_size'] is None, the
+    LFP of the whole recording is kept in memory, and High Gamma is computed
+    one slab of channels at a time. Otherwise, High Gamma is computed in time
+    blocks of the same size (see `high_gamma_estimation`) from the LFP blocks
+    as they are preprocessed, so memory does not depend on the recording
+    length.
+
+    Parameters
+    ----------
+    block_path : str
+        subject file path
+    config : dictionary
+        Preprocessing options, see `preprocess_raw_data`.
+    bands_vals : [2,nBands] numpy array with Gaussian filter parameters, where:
+        bands_vals[0,:] = filter centers [Hz]
+        bands_vals[1,:] = filter sigmas [Hz]
+        If None, the 8 Chang lab bands between 70 and 150 Hz (the default
+        bands of the High Gamma dialog).
+    max_bytes : int
+        Approximate memory limit of the slabs of channels read at once, and
+        of the analytic signals computed at once by the filter bank
+        (default=256 MB), see `memory_plan`.
+    dtype : str
+        Precision of the analytic signals, 'complex128' (default) or
+        'complex64'.
+    storage : dict or None
+        HDF5 chunk shape and compression of High Gamma, see
+        `storage.storage_options`. If None, config['storage'] (the storage
+        of the LFP) or the default storage.
+    output_rate : float or None
+        Rate (Hz) at which High Gamma is stored, the LFP rate if None, see
+        `high_gamma_estimation`.
+
+    Returns
+    -------
+    Saves preprocessed signals (LFP) and High Gamma power in the current NWB
+    file, with their provenance. If the LFP is up to date, only High Gamma
+    is computed (if needed).
+    """
+    block_name = os.path.splitext(block_path)[0]
+    if bands_vals is None:
+        bands_vals = np.array([chang_lab['cfs'][29:37],
+                               chang_lab['sds'][29:37]])
+    if storage is None:
+        storage = config.get('storage')
+    block_size = config.get('block_size')
+
+    if not _check_stage(block_path, 'preprocess', config, 'LFP'):
+        # only High Gamma may need to be computed
+        high_gamma_estimation(block_path, bands_vals, max_bytes=max_bytes,
+                              dtype=dtype, storage=storage,
+                              block_size=block_size, output_rate=output_rate)
+        return
+    _, provenance = stage_status(block_path, 'preprocess', config)
+    hg_config = _bands_config(bands_vals, dtype, block_size,
+                              output_rate=output_rate)
+    hg_provenance = stage_provenance('high_gamma', hg_config,
+                                     {'LFP': provenance['hash']})
+
+    with NWBHDF5IO(block_path, 'r+', load_namespaces=True) as io:
+        nwb = io.read()
+        ecephys_module = _get_ecephys_module(nwb)
+        source = _get_raw_source(nwb)
+        if block_size is None:
+            X, rate, electrodes, bipolarTable = _preprocess_in_memory(
+                source, config, nwb, block_name)
+            hg_blocks = _hilbert_channel_blocks(X, rate, bands_vals,
+                                                max_bytes, dtype, output_rate)
+            lfp_shape, axis = X.shape, 1
+        else:
+            # the LFP blocks are read by the High Gamma time blocks while
+            # they are written, with the samples read around the first and
+            # last High Gamma blocks (see `_hilbert_time_blocks`)
+            rate = source.rate if config['Downsample'] is None \
+                else config['Downsample']
+            context = hilbert_context(rate, bands_vals[1, :])
+            n_fft = next_fast_len(int(round(block_size * rate)) + 2 * context)
+            X, rate, electrodes, bipolarTable, tail = _preprocess_streaming(
+                source, config, nwb, block_name, tail=context)
+            lfp = BlockReader((chunk.data for chunk in X), X.maxshape,
+                              'float32', head=n_fft, tail=tail)
+            X = BlockIterator(lfp.blocks(), maxshape=lfp.shape,
+                              dtype='float32')
+            hg_blocks = _decimated_blocks(
+                _hilbert_time_blocks(lfp, rate, bands_vals, block_size, None,
+                                     max_bytes, dtype, band_mean=True,
+                                     name='High Gamma estimation'),
+                rate, output_rate)
+            lfp_shape, axis = lfp.shape, 0
+        _add_lfp(ecephys_module, provenance, X, rate, electrodes,
+                 bipolarTable, block_path, config.get('storage'))
+
+        elecs_region = electrodes.table.create_region(
+            name='electrodes',
+            region=list(range(lfp_shape[1])),
+            description='all electrodes'
+        )
+        hg_rate = rate if output_rate is None else output_rate
+        hg_shape = (_output_samples(lfp_shape[0], rate, output_rate),
+                    lfp_shape[1])
+        hg = ElectricalSeries(
+            name='high_gamma',
+            data=data_io(BlockIterator(hg_blocks, maxshape=hg_shape,
+                                       dtype='float32', axis=axis),
+                         hg_rate, storage),
+            electrodes=elecs_region,
+            rate=hg_rate,
+            description='',
+            comments=pending_comments(hg_provenance)
+        )
+        ecephys_module.add_data_interface(hg)
+
+        # the LFP and High Gamma blocks are written in turn
+        io.write(nwb, exhaust_dci=False)
+    stamp_provenance(block_path, ['LFP/preprocessed'], provenance)
+    stamp_provenance(block_path, ['high_gamma'], hg_provenance)
+    print('LFP and High Gamma power saved in ' + block_path)
+
+
+def _hilbert_channel_blocks(X, rate, bands_vals, max_bytes, dtype,
+                            output_rate):
+    """
+    High Gamma of the (nSamples, nChannels) LFP in memory, at the output
+    rate. Yields the (nOut, nSlabChannels) High Gamma of each slab of
+    channels.
+    """
+    print('Running High Gamma estimation...')
+    print('FFT backend: {}'.format(backend_info()))
+    start = time.time()
+    filters = gaussian_filter_bank(X.shape[0], rate, bands_vals[0, :],
+                                   bands_vals[1, :],
+                                   np.finfo(np.dtype(dtype)).dtype)
+    for _, _, Xs in channel_blocks(X, max_bytes=max_bytes, dtype='float32'):
+        Xch = Xs.T * 1e6       # 1e6 scaling helps with numerical accuracy
+        Xm = hilbert_band_mean(Xch, rate, filters, max_bytes=max_bytes,
+                               use_rfft=True, dtype=dtype).T
+        yield _decimate(Xm, rate, output_rate)
+    print('High Gamma estimation finished in {} seconds'.format(
+        time.time() - start))
+
+
+def _get_ecephys_module(nwb):
+    """Processing module 'ecephys' of the file, created if needed."""
+    if 'ecephys' in nwb.processing:
+        ecephys_module = nwb.processing['ecephys']
+    else:   # creates ecephys ProcessingModule
+        ecephys_module = ProcessingModule(
+            name='ecephys',
+            description='Extracellular electrophysiology data.'
+        )
+        # Add module to NWB file
+        nwb.add_processing_module(ecephys_module)
+        print('Created ecephys')
+    return ecephys_module
+
+
+def _get_raw_source(nwb):
+    """The ElectricalSeries of raw signals in acquisition."""
+    source_list = [acq for acq in nwb.acquisition.values()
+                   if type(acq) == ElectricalSeries]
+    assert len(source_list) == 1, (
+        'Not precisely one ElectricalSeries in acquisition!')
+    return source_list[0]
+
+
+def _add_lfp(ecephys_module, provenance, X, rate, electrodes, bipolarTable,
+             block_path, storage=None):
+    """Add the preprocessed signals X to an LFP container of the module."""
+    lfp = LFP()
+    if bipolarTable is not None:
+        # add data interface for the metadata for saving
+        ecephys_module.add_data_interface(bipolarTable)
+        print('bipolarElectrodes stored for saving in ' + block_path)
+
+    # create an electrical series for the LFP and store it in lfp, with its
+    # provenance as comments (stamped once the LFP is written)
+    lfp.create_electrical_series(
+        name='preprocessed',
+        data=data_io(X, rate, storage),
+        electrodes=electrodes,
+        rate=rate,
+        description='',
+        comments=pending_comments(provenance)
+    )
+    ecephys_module.add_data_interface(lfp)
+
+
+def _check_stage(block_path, stage, config, name, output_path=None):
+    """
+    Check the provenance of the output of a stage. Returns False if the stage
+    should be skipped (output up to date, or output of an older version), and
+    removes stale outputs (and their downstream outputs) otherwise.
+    """
+    status, _ = stage_status(block_path, stage, config, output_path)
+    if status == 'current':
+        print('{} is up to date in {}, skipping.'.format(
+            name, output_path or block_path))
+        return False
+    if status == 'unknown':
+        warnings.warn('{} data already exists in the nwb file, without '
+                      'provenance. Skipping.'.format(name))
+        return False
+    if status == 'stale':
+        print('Inputs of {} changed, removing it and the data computed from '
+              'it.'.format(name))
+        remove_outputs(output_path or block_path, stage)
+    return True
+
+
+def _precision(config):
+    """Floating point type of the preprocessing, from its configuration."""
+    precision = np.dtype(config.get('precision', 'float64'))
+    if precision not in (np.float32, np.float64):
+        raise ValueError("precision should be 'float32' or 'float64', not "
+                         "{}".format(precision))
+    return precision
+
+
+def _scaled(X, dtype):
+    """X * 1e6 as `dtype` (the scaling helps with numerical accuracy)."""
+    return np.multiply(X, 1e6, dtype=dtype)
+
+
+def _bands_config(bands_vals, dtype, block_size=None, block_context=None,
+                  multirate=None, output_rate=None, phase=False):
+    """Configuration of the decomposition stages, for their provenance."""
+    config = {'bands_vals': np.asarray(bands_vals, dtype=float),
+              'dtype': str(dtype)}
+    if block_size is not None:
+        config.update(block_size=block_size, block_context=block_context)
+    if multirate is not None:
+        config.update(multirate=multirate)
+    if output_rate is not None:
+        config.update(output_rate=output_rate)
+    if phase:
+        config.update(phase=True)
+    return config
+
+
+def _output_ratio(rate, output_rate):
+    """
+    Resampling factors (up, down) from the LFP rate to the output rate of the
+    amplitude, or None if the amplitude is stored at the LFP rate.
+    """
+    if output_rate is None or output_rate == rate:
+        return None
+    if output_rate > rate:
+        raise ValueError('output_rate should be at most the LFP rate ({} Hz), '
+                         'not {}'.format(rate, output_rate))
+    up, down = resample_ratio(output_rate, rate)
+    if up is None:
+        raise ValueError('The ratio of output_rate ({} Hz) to the LFP rate '
+                         '({} Hz) is not rational.'.format(output_rate, rate))
+    return up, down
+
+
+def _output_samples(nSamples, rate, output_rate):
+    """Number of samples of the amplitude at the output rate."""
+    ratio = _output_ratio(rate, output_rate)
+    if ratio is None:
+        return nSamples
+    return -(-nSamples * ratio[0] // ratio[1])
+
+
+def _decimate(X, rate, output_rate, axis=0):
+    """
+    Analytic amplitude decimated from `rate` to `output_rate` along `axis`,
+    with the anti-aliasing lowpass filter of `Resampler`. The amplitude is
+    smooth, but its lowpass can be slightly negative near its zeros, so it is
+    clipped at 0.
+    """
+    ratio = _output_ratio(rate, output_rate)
+    if ratio is None:
+        return X
+    resampler = Resampler(ratio[0], ratio[1], dtype=X.dtype)
+    Y = resampler.process(np.moveaxis(X, axis, 0), last=True)
+    return np.moveaxis(np.maximum(Y, 0, out=Y), 0, axis)
+
+
+def _decimated_blocks(blocks, rate, output_rate):
+    """
+    Time blocks of analytic amplitude (along their first axis) decimated to
+    `output_rate` while they are computed, see `_decimate`.
+    """
+    ratio = _output_ratio(rate, output_rate)
+    if ratio is None:
+        for Xb in blocks:
+            yield Xb
+        return
+    resampler = None
+    for Xb in blocks:
+        if resampler is None:
+            resampler = Resampler(ratio[0], ratio[1], dtype=Xb.dtype)
+            empty = Xb[:0]
+        Y = resampler.process(Xb)
+        if len(Y) > 0:
+            yield np.maximum(Y, 0, out=Y)
+    if resampler is not None:
+        Y = resampler.process(empty, last=True)
+        if len(Y) > 0:
+            yield np.maximum(Y, 0, out=Y)
+
+
+def _bands_table(band_param_0, band_param_1):
+    """
+    DynamicTable of the filter parameters of a DecompositionSeries, with
+    resizable columns to add bands (see `_append_bands`).
+    """
+    nBands = len(band_param_0)
+    band_param_0V = VectorData(
+        name='filter_param_0',
+        description='frequencies for bandpass filters',
+        data=H5DataIO(np.asarray(band_param_0, dtype=float), maxshape=(None,))
+    )
+    band_param_1V = VectorData(
+        name='filter_param_1',
+        description='frequencies for bandpass filters',
+        data=H5DataIO(np.asarray(band_param_1, dtype=float), maxshape=(None,))
+    )
+    return DynamicTable(
+        name='bands',
+        description='Series of filters used for Hilbert transform.',
+        id=ElementIdentifiers(name='id', data=H5DataIO(np.arange(nBands),
+                                                        maxshape=(None,))),
+        columns=[band_param_0V, band_param_1V],
+        colnames=['filter_param_0', 'filter_param_1']
+    )
+
+
+def _stored_bands(block_path):
+    """
+    Filter parameters of the bands of the DecompositionSeries of the file,
+    as a [2,nBands] array, and whether its data and bands (and those of its
+    phase) can be resized to add bands. None, False if there is no
+    DecompositionSeries.
+    """
+    with h5py.File(block_path, 'r') as f:
+        ecephys = f['processing/ecephys']
+        decs = ecephys.get('DecompositionSeries')
+        if decs is None or 'bands' not in decs:
+            return None, False
+        resizable = True
+        for name in _decomposition_names(True):
+            if name in ecephys:
+                series = ecephys[name]
+                columns = [series['bands/' + col] for col in
+                           ['filter_param_0', 'filter_param_1', 'id']]
+                resizable &= series['data'].maxshape[2] is None and \
+                    all(col.maxshape[0] is None for col in columns)
+        return np.array([decs['bands/filter_param_0'][:],
+                         decs['bands/filter_param_1'][:]]), resizable
+
+
+def _missing_bands(bands_vals, stored):
+    """Bands of bands_vals ([2,nBands]) that are not in stored ([2,n])."""
+    missing = [j for j in range(bands_vals.shape[1])
+               if not np.any(np.isclose(stored[0], bands_vals[0, j]) &
+                             np.isclose(stored[1], bands_vals[1, j]))]
+    return bands_vals[:, missing]
+
+
+def _decomposition_names(phase):
+    """Names of the series of the decomposition, with their phase."""
+    return ['DecompositionSeries'] + (['DecompositionSeries_phase'] if phase
+                                      else [])
+
+
+def _append_bands(block_path, new_bands, provenance, max_bytes, dtype,
+                  block_size, block_context, output_rate, phase=False):
+    """
+    Compute the power (and phase) of `new_bands` from the LFP, and add them
+    to the (resizable) DecompositionSeries (and DecompositionSeries_phase)
+    of the file, with its new provenance once they are written. If the
+    computation fails, the series are resized back to their old bands.
+    """
+    with h5py.File(block_path, 'r+') as f:
+        ecephys = f['processing/ecephys']
+        n0 = ecephys['DecompositionSeries/data'].shape[2]
+        n1 = n0 + new_bands.shape[1]
+        try:
+            _resize_bands(ecephys, n1, phase)
+            for name in _decomposition_names(phase):
+                bands = ecephys[name + '/bands']
+                for ii, col in enumerate(['filter_param_0', 'filter_param_1']):
+                    bands[col][n0:] = new_bands[ii]
+                bands['id'][n0:] = np.arange(n0, n1)
+            _write_decomposition(ecephys, new_bands, max_bytes, dtype,
+                                 block_size, block_context, output_rate, phase,
+                                 b0=n0)
+        except BaseException:
+            _resize_bands(ecephys, n0, phase)
+            raise
+        for name in _decomposition_names(phase):
+            ecephys[name].attrs['comments'] = json.dumps(provenance)
+
+
+def _resize_bands(ecephys, n_bands, phase):
+    """Resize the data and bands of the decomposition to n_bands bands."""
+    for name in _decomposition_names(phase):
+        series = ecephys[name]
+        series['data'].resize(n_bands, axis=2)
+        for col in ['filter_param_0', 'filter_param_1', 'id']:
+            series['bands/' + col].resize((n_bands,))
+
+
+def _write_decomposition(ecephys, bands_vals, max_bytes, dtype, block_size,
+                         block_context, output_rate, phase, b0=0):
+    """
+    Compute the power (and phase) of the bands of `bands_vals` from the LFP
+    of the open h5py group `ecephys`, and write them to the data of its
+    DecompositionSeries (and DecompositionSeries_phase) from band b0 on, one
+    time block at a time as they are computed.
+    """
+    lfp = ecephys['LFP/preprocessed']
+    rate = lfp['starting_time'].attrs['rate']
+    datasets = [ecephys[name + '/data']
+                for name in _decomposition_names(phase)]
+    t0 = 0
+    for Xs in _decomposition_blocks(lfp['data'], rate, bands_vals, max_bytes,
+                                    dtype, block_size, block_context,
+                                    output_rate, phase):
+        Xs = Xs if phase else (Xs,)
+        for data, X in zip(datasets, Xs):
+            data[t0:t0 + X.shape[0], :, b0:b0 + X.shape[2]] = X
+        t0 += Xs[0].shape[0]
+
+
+def _multirate_decomposition(data, rate, bands_vals, multirate, max_bytes,
+                             dtype, output_rate=None):
+    """
+    Spectral power of the (nSamples, nChannels) LFP with the multirate filter
+    bank (see `multirate`), one slab of channels at a time.
+
+    Returns a list of (rate, band indices, (nSamples, nChannels, nBands)
+    power), with one item per pyramid level for 'native', or a single item at
+    the LFP rate for 'common'. With `output_rate`, the pyramid stops at twice
+    the output rate, and the power of all levels is decimated to it (a single
+    item, for both modes).
+    """
+    if multirate not in ('common', 'native'):
+        raise ValueError("multirate should be None, 'common' or 'native', not "
+                         "{}".format(multirate))
+    nSamples, nChannels = data.shape
+    max_level = None
+    if _output_ratio(rate, output_rate) is not None:
+        # at least twice the output rate, for the lowpass of the decimation
+        max_level = max(int(np.floor(np.log2(rate / output_rate))) - 1, 0)
+    levels = band_levels(rate, bands_vals[0, :], bands_vals[1, :],
+                         max_level=max_level)
+    real = np.finfo(np.dtype(dtype)).dtype
+    if max_level is not None:
+        nOut = _output_samples(nSamples, rate, output_rate)
+        power = {0: np.zeros((len(levels), nChannels, nOut), dtype=real)}
+    elif multirate == 'common':
+        power = {0: np.zeros((len(levels), nChannels, nSamples), dtype=real)}
+    else:
+        power = {level: np.zeros((np.sum(levels == level), nChannels,
+                                  -(-nSamples // 2**level)), dtype=real)
+                 for level in np.unique(levels)}
+
+    print('Running Spectral Decomposition (multirate, levels {})...'.format(
+        ', '.join('{:g} Hz'.format(rate / 2**level)
+                  for level in np.unique(levels))))
+    print('FFT backend: {}'.format(backend_info()))
+    start = time.time()
+    for c0, c1, Xs in channel_blocks(data, max_bytes=max_bytes,
+                                     dtype='float32'):
+        Xch = Xs.T * 1e6       # 1e6 scaling helps with numerical accuracy
+        Xch = Xch.astype('float32', copy=False)  # (nChannels,nSamples)
+        for level, bands, Xa in multirate_filter_bank(
+                Xch, rate, bands_vals[0, :], bands_vals[1, :], levels=levels,
+                max_bytes=max_bytes, dtype=dtype,
+                analytic=multirate == 'common' and max_level is None):
+            if max_level is not None:
+                Xa = _decimate(Xa, rate / 2**level, output_rate, axis=-1)
+                power[0][bands, c0:c1] = Xa[..., :power[0].shape[-1]]
+            elif multirate == 'common':
+                # the analytic signal is band limited, not its amplitude
+                power[0][bands, c0:c1] = abs(upsample(Xa, 2**level, nSamples))
+            else:
+                power[level][:, c0:c1] = Xa
+    print('Spectral Decomposition finished in {} seconds'.format(
+        time.time() - start))
+
+    if max_level is not None:
+        return [(output_rate, np.arange(len(levels)),
+                 np.swapaxes(power[0], 0, 2))]
+    if multirate == 'common':
+        return [(rate, np.arange(len(levels)), np.swapaxes(power[0], 0, 2))]
+    return [(rate / 2**level, np.flatnonzero(levels == level),
+             np.swapaxes(power[level], 0, 2)) for level in sorted(power)]
+
+
+def _hilbert_time_blocks(data, rate, bands_vals, block_size, block_context,
+                         max_bytes, dtype, band_mean=False, name='',
+                         analytic=False):
+    """
+    Analytic amplitude of the (nSamples, nChannels) LFP in consecutive time
+    blocks, with overlap-save: each block is transformed together with
+    `block_context` seconds of signal on each side, with FFTs of a fixed fast
+    length, and only the block itself is kept. The filters are scaled to
+    match the transform of the whole recording (see `block_filter_bank`).
+
+    Yields (nBlockSamples, nChannels, nBands) power, or (nBlockSamples,
+    nChannels) float32 band mean if `band_mean`, or (nBlockSamples,
+    nChannels, nBands) analytic signals in dtype if `analytic`.
+    """
+    print('Running {} in blocks of {} seconds...'.format(name, block_size))
+    print('FFT backend: {}'.format(backend_info()))
+    start_time = time.time()
+    n_time = data.shape[0]
+    if block_context is None:
+        context = hilbert_context(rate, bands_vals[1, :])
+    else:
+        context = int(np.ceil(block_context * rate))
+    n_fft = next_fast_len(int(round(block_size * rate)) + 2 * context)
+    if n_fft >= n_time:     # a single block, the whole recording
+        n_fft, context = n_time, 0
+    filters = block_filter_bank(n_fft, n_time, rate, bands_vals[0, :],
+                                bands_vals[1, :],
+                                dtype=np.finfo(np.dtype(dtype)).dtype)
+    out_dtype = 'float32' if band_mean else np.finfo(np.dtype(dtype)).dtype
+    if analytic:
+        out_dtype = dtype
+    for start, stop, Xb in circular_blocks(with_chunk_cache(data, n_fft),
+                                           n_fft - 2 * context, context):
+        Xch = Xb.T * 1e6       # 1e6 scaling helps with numerical accuracy
+        Xch = Xch.astype('float32', copy=False)  # (nChannels,nSamples)
+        if band_mean:
+            Xa = hilbert_band_mean(Xch, rate, filters, max_bytes=max_bytes,
+                                   use_rfft=True, dtype=dtype).T
+        else:
+            Xa = hilbert_filter_bank(Xch, rate, filters, max_bytes=max_bytes,
+                                     use_rfft=True, dtype=dtype,
+                                     analytic=analytic).T
+        yield Xa[context:context + stop - start].astype(out_dtype, copy=False)
+    print('{} finished in {} seconds'.format(name, time.time() - start_time))
+
+
+def _decomposition_blocks(data, rate, bands_vals, max_bytes, dtype,
+                          block_size=None, block_context=None,
+                          output_rate=None, phase=False):
+    """
+    Spectral power of the (nSamples, nChannels) LFP at the output rate, in
+    the precision of dtype.
+
+    Yields (nBlockSamples, nChannels, nBands) time blocks of power if
+    `block_size` (see `_hilbert_time_blocks`), or the power of the whole
+    recording otherwise. With `phase` (at the LFP rate only), yields
+    (power, int16 phase) pairs instead (see `phase.quantize_phase`).
+    """
+    if block_size is not None and phase:
+        for Xa in _hilbert_time_blocks(data, rate, bands_vals, block_size,
+                                       block_context, max_bytes, dtype,
+                                       name='Spectral Decomposition',
+                                       analytic=True):
+            yield abs(Xa), quantize_phase(Xa)
+        return
+    if block_size is not None:
+        for Xp in _decimated_blocks(
+                _hilbert_time_blocks(data, rate, bands_vals, block_size,
+                                     block_context, max_bytes, dtype,
+                                     name='Spectral Decomposition'),
+                rate, output_rate):
+            yield Xp
+        return
+
+    nBands = bands_vals.shape[1]
+    nSamples, nChannels = data.shape
+    nOut = _output_samples(nSamples, rate, output_rate)
+    # power (nBands,nChannels,nOut), in the precision of dtype
+    Xp = np.zeros((nBands, nChannels, nOut),
+                  dtype=np.finfo(np.dtype(dtype)).dtype)
+    if phase:
+        Xq = np.zeros(Xp.shape, dtype='int16')
+
+    # Apply Hilbert transform -----------------------------------------
+    print('Running Spectral Decomposition...')
+    print('FFT backend: {}'.format(backend_info()))
+    start = time.time()
+    # Read slabs of channels, one channel at a time is slow on chunked data
+    filters = gaussian_filter_bank(nSamples, rate, bands_vals[0, :],
+                                   bands_vals[1, :],
+                                   np.finfo(np.dtype(dtype)).dtype)
+    for c0, c1, Xs in channel_blocks(data, max_bytes=max_bytes,
+                                     dtype='float32'):
+        Xch = Xs.T * 1e6       # 1e6 scaling helps with numerical accuracy
+        Xch = Xch.astype('float32', copy=False)  # (nChannels,nSamples)
+        if not phase:
+            Xa = hilbert_filter_bank(Xch, rate, filters, max_bytes=max_bytes,
+                                     use_rfft=True, dtype=dtype)
+            Xp[:, c0:c1, :] = _decimate(Xa, rate, output_rate, axis=-1)
+            continue
+        # analytic signals of a few bands at a time, within max_bytes
+        n_b = max(max_bytes // (Xch.size * np.dtype(dtype).itemsize), 1)
+        for b0 in range(0, nBands, n_b):
+            b1 = min(b0 + n_b, nBands)
+            Xa = hilbert_filter_bank(Xch, rate, filters[b0:b1],
+                                     max_bytes=max_bytes, use_rfft=True,
+                                     dtype=dtype, analytic=True)
+            Xp[b0:b1, c0:c1, :] = abs(Xa)
+            Xq[b0:b1, c0:c1, :] = quantize_phase(Xa)
+    print('Spectral Decomposition finished in {} seconds'.format(
+        time.time() - start))
+
+    # data: (ndarray) dims: num_times * num_channels * num_bands
+    if phase:
+        yield np.swapaxes(Xp, 0, 2), np.swapaxes(Xq, 0, 2)
+    else:
+        yield np.swapaxes(Xp, 0, 2)
+
+
+def _preprocess_in_memory(source, config, nwb, block_name):
+    """
+    Preprocess the whole recording at once.
+
+    Returns the (nSamples, nChannels) float32 LFP, its rate, the electrodes
+    region and the bipolar metadata table (None if not bipolar referencing).
+    """
+    precision = _precision(config)
+    slab_bytes = config.get('max_bytes', 2**28)
+
+    # Downsampling
+    if config['Downsample'] is not None:
+        print("Downsampling signals to " + str(config['Downsample']) + " Hz.")
+        print("Please wait...")
+        start = time.time()
+        # Note: zero padding the signal to make the length
+        # a power of 2 won't help, since resample will further pad it
+        # (breaking the power of 2)
+        nBins = source.data.shape[0]
+        rate = config['Downsample']
+
+        # malloc
+        T = int(np.ceil(nBins * rate / source.rate))
+        X = np.zeros((source.data.shape[1], T), dtype=precision)
+
+        n_jobs = config.get('n_jobs', 1)
+        method = config.get('resample', 'fft')
+        if n_jobs is not None and n_jobs > 1:
+            _resample_parallel(source, X, rate, n_jobs, method)
+        else:
+            # One slab of channels at a time, to improve memory usage for
+            # long signals
+            for c0, c1, Xs in channel_blocks(source.data, max_bytes=slab_bytes,
+                                             dtype=precision):
+                X[c0:c1, :] = resample(_scaled(Xs, precision), rate,
+                                       source.rate, method=method,
+                                       dtype=precision).T
+        print('Downsampling finished in {} seconds'.format(
+            time.time() - start))
+    else:  # No downsample
+        rate = source.rate
+        X = _scaled(source.data[()].T, precision)
+
+    # re-reference the (scaled by 1e6!) data
+    electrodes = source.electrodes
+    bipolarTable = None
+    if config['referencing'] is not None:
+        start = time.time()
+        X, bipolarTable, electrodes = _apply_referencing(
+            X, config['referencing'], nwb, electrodes, rate, verbose=True)
+        if config['referencing'][0] in ['CAR', 'CMR']:
+            print('{} subtract time for {}: {} seconds'.format(
+                config['referencing'][0], block_name, time.time() - start))
+
+    # Apply Notch filters
+    if config['Notch'] is not None:
+        print("Applying notch filtering of " + str(config['Notch']) + " Hz")
+        # Note: zero padding the signal to make the length a power
+        # of 2 won't help, since notch filtering will further pad it
+        start = time.time()
+        # All channels of a slab are filtered at once
+        for c0, c1 in channel_bounds(
+                X.T, slab_bytes // (X.shape[1] * X.itemsize)):
+            X[c0:c1, :] = apply_linenoise_notch(
+                X[c0:c1, :].T, rate, line_freq=config['Notch'],
+                workers=config.get('n_jobs')).T
+        print('Notch filter time for {}: {} seconds'.format(
+            block_name, time.time() - start))
+
+    X = X.astype('float32', copy=False)     # signal (nChannels,nSamples)
+    X /= 1e6                    # Scales signals back to volts
+
+    return X.T, rate, electrodes, bipolarTable
+
+
+def _resample_parallel(source, X, rate, n_jobs, method='fft'):
+    """
+    Downsample the channels of `source` in a pool of `n_jobs` processes,
+    storing the results in X (nChannels, nSamples), in the precision of X.
+
+    The channels are split in slabs of consecutive channels. Each worker reads
+    its own slab from the NWB file, so only the resampled slabs are sent back.
+    """
+    nChannels = source.data.shape[1]
+    n_slabs = min(nChannels, 4 * n_jobs)
+    bounds = channel_bounds(source.data, int(np.ceil(nChannels / n_slabs)))
+    slabs = [(source.data.file.filename, source.data.name, c0, c1,
+              rate, source.rate, method, X.dtype) for c0, c1 in bounds]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        for (_, _, c0, c1, _, _, _, _), Xs in zip(
+                slabs, executor.map(_resample_slab, slabs)):
+            X[c0:c1, :] = Xs.T
+
+
+def _resample_slab(args):
+    """Reads channels [c0, c1) of a dataset and downsamples them."""
+    file_path, dataset_name, c0, c1, new_rate, old_rate, method, dtype = args
+    # The parent process holds the file open for writing
+    os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+    with h5py.File(file_path, 'r') as f:
+        Xs = _scaled(f[dataset_name][:, c0:c1], dtype)
+    return resample(Xs, new_rate, old_rate, method=method, dtype=dtype)
+
+
+def _preprocess_streaming(source, config, nwb, block_name, tail=0):
+    """
+    Preprocess the recording in overlapping time blocks.
+
+    Each block is read with `config['block_context']` seconds of extra
+    signal on both sides, which is discarded after resampling, referencing
+    and notch filtering. Block edges are aligned to the resampling period, so
+    that blocks map to an integer number of input and output samples.
+
+    Returns a BlockIterator over (nSamples, nChannels) float32 LFP blocks, its
+    rate, the electrodes region, the bipolar metadata table (None if not
+    bipolar referencing) and the last `tail` samples of the LFP, computed
+    beforehand (None if tail=0).
+    """
+    nBins = source.data.shape[0]
+    if config['Downsample'] is not None:
+        rate = config['Downsample']
+        # blocks are aligned to the exact resampling period
+        n_out, n_in = resample_ratio(rate, source.rate)
+        if n_in is None:
+            raise ValueError('The ratio of the sampling rates ({} Hz to {} '
+                             'Hz) is not rational with a short period, the '
+                             'recording cannot be streamed. Use '
+                             'block_size=None.'.format(source.rate, rate))
+    else:
+        rate = source.rate
+        n_in, n_out = 1, 1
+    T = int(np.ceil(nBins * rate / source.rate))
+    method = config.get('resample', 'fft')
+    precision = _precision(config)
+
+    # block and context sizes, in output samples, rounded up to the period
+    block_size = int(np.ceil(config['block_size'] * rate / n_out)) * n_out
+    context = config.get('block_context', 4.)
+    context = int(np.ceil(context * rate / n_out)) * n_out
+    if n_out > block_size / 2:
+        warnings.warn('Resampling period ({} samples) is large relative to '
+                      'the block size.'.format(n_out))
+
+    print("Preprocessing signals in blocks of " + str(block_size / rate)
+          + " seconds.")
+    print("Please wait...")
+
+    electrodes = source.electrodes
+    state = {'bipolarTable': None, 'electrodes': electrodes}
+    # consecutive blocks overlap by twice the context
+    data = with_chunk_cache(source.data, n_time=2 * context * n_in // n_out)
+
+    def process_blocks(blocks):
+        for b0, b1, r0, r1 in blocks:
+            i0 = r0 * n_in // n_out
+            i1 = min(int(np.ceil(r1 * n_in / n_out)), nBins)
+
+            Xb = _scaled(data[i0:i1, :], precision)   # (time, channels)
             if config['Downsample'] is not None:
-                print("Downsampling signals to " + str(config['Downsample']) + " Hz.")
-                print("Please wait...")
-                start = time.time()
-                # Note: zero padding the signal to make the length
-                # a power of 2 won't help, since resample will further pad it
-                # (breaking the power of 2)
-                nBins = source.data.shape[0]
-                rate = config['Downsample']
-
-                # malloc
-                T = int(np.ceil(nBins * rate / source.rate))
-                X = np.zeros((source.data.shape[1], T))
-
-                # One channel at a time, to improve memory usage for long signals
-                for ch in np.arange(nChannels):
-                    # 1e6 scaling helps with numerical accuracy
-                    Xch = source.data[:, ch] * 1e6
-                    X[ch, :] = resample(Xch, rate, source.rate)
-                print('Downsampling finished in {} seconds'.format(
-                    time.time() - start))
-            else:  # No downsample
-                rate = source.rate
-                X = source.data[()].T * 1e6
-
-            # re-reference the (scaled by 1e6!) data
-            electrodes = source.electrodes
-            if config['referencing'] is not None:
-                if config['referencing'][0] == 'CAR':
-
-                    if config['referencing'][1] == 'device':
-                        print(
-                            "Computing and subtracting Common Average "
-                            "Reference by device.")
-                        start = time.time()
-                        X = subtract_CAR_by_device(
-                            X,
-                            elec_info=nwb.electrodes.to_dataframe()
-                        )
-                        print('CAR subtract time for {}: {} seconds'.format(
-                            block_name, time.time() - start))
-
-                    else:
-                        print("Computing and subtracting Common Average Reference in "
-                              + str(config['referencing'][1])+" channel blocks.")
-                        start = time.time()
-                        X = subtract_CAR(X, b_size=config['referencing'][1],
-                                         elec_info=nwb.electrodes.to_dataframe(),
-                                         exclude_bad_channels=config[
-                                             'referencing'][2])
-                        print('CAR subtract time for {}: {} seconds'.format(
-                            block_name, time.time() - start))
-                elif config['referencing'][0] == 'bipolar':
-                    X, bipolarTable, electrodes = get_bipolar_referenced_electrodes(
-                        X, electrodes, rate, grid_step=1)
-
-                    # add data interface for the metadata for saving
-                    ecephys_module.add_data_interface(bipolarTable)
-                    print('bipolarElectrodes stored for saving in ' + block_path)
+                # Whole periods keep the resampling ratio exact, so that
+                # consecutive blocks share the same sampling grid
+                extra = -(i1 - i0) % n_in
+                if extra > 0:
+                    Xb = np.pad(Xb, ((0, extra), (0, 0)), mode='reflect',
+                                reflect_type='odd')
+                if method == 'fft':
+                    Xb = resample_func(Xb, Xb.shape[0] * n_out // n_in,
+                                       npad=n_in).astype(precision,
+                                                         copy=False)
                 else:
-                    print('UNRECOGNIZED REFERENCING SCHEME; ', end='')
-                    print('SKIPPING REFERENCING!')
+                    Xb = resample(Xb, rate, source.rate, method=method,
+                                  dtype=precision)
+            Xb = Xb[:r1 - r0].T
+
+            if config['referencing'] is not None:
+                Xb, bipolarTable, elecs = _apply_referencing(
+                    Xb, config['referencing'], nwb, electrodes, rate)
+                if state['bipolarTable'] is None:
+                    state['bipolarTable'] = bipolarTable
+                    state['electrodes'] = elecs
 
-            # Apply Notch filters
             if config['Notch'] is not None:
-                print("Applying notch filtering of " + str(config['Notch']) + " Hz")
-                # Note: zero padding the signal to make the length a power
-                # of 2 won't help, since notch filtering will further pad it
-                start = time.time()
-                for ch in np.arange(nChannels):
-                    # NOTE: apply_linenoise_notch takes a signal that is
-                    # (n_timePoints, n_channels). The documentation may be wrong
-                    Xch = X[ch, :].reshape(-1, 1)
-                    Xch = apply_linenoise_notch(Xch, rate)
-                    X[ch, :] = Xch[:, 0]
-                print('Notch filter time for {}: {} seconds'.format(
-                    block_name, time.time() - start))
-
-            X = X.astype('float32')     # signal (nChannels,nSamples)
-            X /= 1e6                    # Scales signals back to volts
-
-            # Add preprocessed downsampled signals as an electrical_series
-            referencing = 'None' if config['referencing'] is None else config[
-                'referencing']
-            notch = 'None' if config['Notch'] is None else str(config['Notch'])
-            downs = 'No' if config['Downsample'] is None else 'Yes'
-            config_comment = (
-                'referencing:' + str(referencing)
-                + ', Notch:' + notch
-                + ', Downsampled:' + downs
-            )
+                Xb = apply_linenoise_notch(
+                    Xb.T, rate, line_freq=config['Notch'],
+                    workers=config.get('n_jobs')).T
 
-            # create an electrical series for the LFP and store it in lfp
-            lfp.create_electrical_series(
-                name='preprocessed',
-                data=X.T,
-                electrodes=electrodes,
-                rate=rate,
-                description='',
-                comments=config_comment
-            )
-            ecephys_module.add_data_interface(lfp)
+            Xb = Xb[:, b0 - r0:b1 - r0].astype('float32', copy=False)
+            Xb /= 1e6                    # Scales signals back to volts
+            yield Xb.T
 
-            # Write LFP to NWB file
-            io.write(nwb)
-            print('LFP saved in ' + block_path)
+    def all_blocks():
+        start = time.time()
+        for Xb in process_blocks(time_blocks(T, block_size, context)):
+            yield Xb
+        print('Preprocessing time for {}: {} seconds'.format(
+            block_name, time.time() - start))
+
+    X_tail = None
+    if tail > 0:
+        # blocks of the last samples
+        X_tail = np.concatenate(list(process_blocks(
+            [b for b in time_blocks(T, block_size, context)
+             if b[1] > T - tail])))[-tail:]
+
+    # The first block defines the output channels (e.g. bipolar referencing)
+    blocks = all_blocks()
+    first = next(blocks)
+    X = BlockIterator(
+        blocks=chain([first], blocks),
+        maxshape=(T, first.shape[1]),
+        dtype='float32'
+    )
+
+    return X, rate, state['electrodes'], state['bipolarTable'], X_tail
+
+
+def _apply_referencing(X, referencing, nwb, electrodes, rate, verbose=False):
+    """
+    Re-reference signals X (nChannels, nSamples) following the
+    `referencing` scheme of `preprocess_raw_data`.
+
+    Returns the referenced signals, the bipolar metadata table (None if not
+    bipolar referencing) and the electrodes region of the referenced signals.
+    """
+    bipolarTable = None
+    # X is a working copy, referenced in place
+    if referencing[0] == 'CAR':
+        if referencing[1] == 'device':
+            if verbose:
+                print("Computing and subtracting Common Average "
+                      "Reference by device.")
+            X = subtract_CAR_by_device(
+                X,
+                elec_info=nwb.electrodes.to_dataframe(),
+                out=X
+            )
+        else:
+            if verbose:
+                print("Computing and subtracting Common Average Reference in "
+                      + str(referencing[1]) + " channel blocks.")
+            exclude = referencing[2] if len(referencing) > 2 else None
+            X = subtract_CAR(X, b_size=referencing[1],
+                             elec_info=nwb.electrodes.to_dataframe(),
+                             exclude_bad_channels=exclude, out=X)
+    elif referencing[0] == 'CMR':
+        if referencing[1] == 'device':
+            if verbose:
+                print("Computing and subtracting Common Median "
+                      "Reference by device.")
+            X = subtract_CAR_by_device(
+                X,
+                elec_info=nwb.electrodes.to_dataframe(),
+                method='median',
+                out=X
+            )
+        else:
+            if verbose:
+                print("Computing and subtracting Common Median Reference in "
+                      + str(referencing[1]) + " channel blocks.")
+            exclude = referencing[2] if len(referencing) > 2 else None
+            X = subtract_CMR(X, b_size=referencing[1],
+                             elec_info=nwb.electrodes.to_dataframe(),
+                             exclude_bad_channels=exclude, out=X)
+    elif referencing[0] == 'bipolar':
+        X, bipolarTable, electrodes = get_bipolar_referenced_electrodes(
+            X, electrodes, rate, grid_step=1)
+    else:
+        print('UNRECOGNIZED REFERENCING SCHEME; ', end='')
+        print('SKIPPING REFERENCING!')
+
+    return X, bipolarTable, electrodes
 
 
 def get_bipolar_referenced_electrodes(
@@ -280,94 +1125,103 @@ def get_bipolar_referenced_electrodes(
     rate:
         sampling rate of X; for storage in ElectricalSeries
     grid_size:
-        numpy array with the two dimensions of the grid (2, )
+        numpy array with the two dimensions of the grid (2, ). If None, the
+        grid is the first electrode group of the electrodes table, sized from
+        the x and y coordinates of its electrodes (or square).
 
     Returns:
     --------
     bipolarElectrodes:
         ElectricalSeries containing the bipolar-referenced (pseudo) electrodes
-        and associated metadata.  (NB that a, e.g., 16x16 grid yields 960 of
+        and associated metadata.  (NB that a, e.g., 16x16 grid yields 480 of
         these pseudo-electrodes.)
     '''
-
-    # set mutable default argument(s)
     if grid_size is None:
-        grid_size = np.array([16, 16])
+        grid_size = _grid_size(electrodes)
+    pairs = bipolar_pairs(grid_size, grid_step)
+    XX = bipolar_reference(X, pairs)
+    bipolarTable = _bipolar_table(electrodes, *pairs)
+
+    # create one big region for the entire table
+    bipolarTableRegion = bipolarTable.create_region(
+        'electrodes', list(range(len(XX))), 'all bipolar electrodes')
+
+    return XX, bipolarTable, bipolarTableRegion
 
-    # malloc
-    elec_layout = np.arange(np.prod(grid_size) - 1, -1, -1).reshape(grid_size).T
-    elec_layout = elec_layout[::grid_step, ::grid_step]
-    grid_size = elec_layout.T.shape  # in case grid_step > 1
-    Nchannels = 2 * np.prod(grid_size) - np.sum(grid_size)
-    XX = np.zeros((Nchannels, X.shape[1]))
 
-    # create a new dynamic table to hold the metadata
-    column_names = ['x', 'y', 'z', 'imp', 'location', 'label', 'bad']
+def _grid_size(electrodes):
+    """
+    Size of the grid of the first group of the electrodes, from the x and y
+    coordinates of its electrodes when they form a lattice, otherwise the
+    group is taken as a square grid.
+    """
+    table = electrodes.table
+    rows = np.asarray(electrodes.data[:])
+    if 'group_name' in table.colnames:
+        names = np.asarray(table['group_name'].data[:])[rows]
+        rows = rows[names == names[0]]
+    n_grid = len(rows)
+    if n_grid > 1 and 'x' in table.colnames and 'y' in table.colnames:
+        x = np.asarray(table['x'].data[:], dtype=float)[rows]
+        y = np.asarray(table['y'].data[:], dtype=float)[rows]
+        n_x, n_y = len(np.unique(x)), len(np.unique(y))
+        if n_x * n_y == n_grid and not np.any(np.isnan(x + y)):
+            # Consecutive electrodes run along the columns of the grid
+            if y[0] == y[1]:
+                return np.array([n_y, n_x])
+            return np.array([n_x, n_y])
+    side = int(round(np.sqrt(n_grid)))
+    if side * side != n_grid:
+        raise ValueError('The first electrode group has {} electrodes, which '
+                         'neither lie on a lattice nor form a square grid, '
+                         'grid_size should be given.'.format(n_grid))
+    return np.array([side, side])
+
+
+def _bipolar_table(electrodes, anodes, cathodes):
+    """Metadata of the bipolar referenced channels, built column-wise."""
+    table = electrodes.table
+    rows = np.asarray(electrodes.data[:])
+    anodes, cathodes = rows[anodes], rows[cathodes]
+
+    def column(name):
+        return np.asarray(table[name].data[:])
+
+    data = {name: column(name)[anodes] for name in ['x', 'y', 'z', 'imp']
+            if name in table.colnames}
+    if 'location' in table.colnames:
+        loc_a, loc_c = column('location')[anodes], column('location')[cathodes]
+        data['location'] = [a if a == c else a + '_' + c
+                            for a, c in zip(loc_a, loc_c)]
+    if 'label' in table.colnames:
+        data['label'] = [a + '-' + c for a, c in zip(column('label')[anodes],
+                                                     column('label')[cathodes])]
+    if 'bad' in table.colnames:
+        bad = column('bad').astype(bool)
+        data['bad'] = bad[anodes] | bad[cathodes]
+
     columns = [
-        VectorData(
-            name=name,
-            description=electrodes.table[name].description)
-        for name in column_names
+        VectorData(name=name, description=table[name].description,
+                   data=values)
+        for name, values in data.items()
     ]
-    bipolarTable = DynamicTable(
+    return DynamicTable(
         name='bipolar-referenced metadata',
         description=('pseudo-channels derived via John Burke style'
                      ' bipolar referencing'),
-        colnames=column_names,
+        id=list(range(len(anodes))),
         columns=columns,
     )
 
-    # compute bipolar-ref'd channel and add a new row of metadata to table
-    def add_new_channel(iChannel, iElectrode, jElectrode):
-        jElectrode = int(jElectrode)
-
-        # "bipolar referencing": the difference of neighboring electrodes
-        XX[iChannel, :] = X[iElectrode, :] - X[jElectrode, :]
-
-        # add a row to the table for this new pseudo-electrode
-        bipolarTable.add_row(
-            {
-                'location': '_'.join({
-                    electrodes.table['location'][iElectrode],
-                    electrodes.table['location'][jElectrode]
-                }),
-                'label': '-'.join([
-                    electrodes.table['label'][iElectrode],
-                    electrodes.table['label'][jElectrode]
-                ]),
-                'bad': (
-                    electrodes.table['bad'][iElectrode] or
-                    electrodes.table['bad'][jElectrode]
-                ),
-                **{name: electrodes.table[name][iElectrode]
-                   for name in ['x', 'y', 'z', 'imp']},
-            }
-        )
-        return iChannel + 1
-
-    iChannel = 0
-
-    # loop across columns and rows (remembering that grid is transposed)
-    for i in range(grid_size[1]):
-        for j in range(grid_size[0]):
-            if j < grid_size[0] - 1:
-                iChannel = add_new_channel(
-                    iChannel, elec_layout[i, j], elec_layout[i, j + 1])
-            if i < grid_size[1] - 1:
-                iChannel = add_new_channel(
-                    iChannel, elec_layout[i, j], elec_layout[i + 1, j])
-
-    # create one big region for the entire table
-    bipolarTableRegion = bipolarTable.create_region(
-        'electrodes', [i for i in range(Nchannels)], 'all bipolar electrodes')
 
-    return XX, bipolarTable, bipolarTableRegion
-
-
-def spectral_decomposition(block_path, bands_vals):
+def spectral_decomposition(block_path, bands_vals, max_bytes=2**28,
+                           dtype='complex128', storage=None, block_size=None,
+                           block_context=None, multirate=None,
+                           output_rate=None, incremental=False, phase=False):
     """
     Takes preprocessed LFP data and does the standard Hilbert transform on
-    different bands. Takes about 20 minutes to run on 1 10-min block.
+    different bands. Each channel is transformed once and filtered by all
+    bands at once (see `hilbert_filter_bank`).
 
     Parameters
     ----------
@@ -376,17 +1230,127 @@ def spectral_decomposition(block_path, bands_vals):
     bands_vals : [2,nBands] numpy array with Gaussian filter parameters, where:
         bands_vals[0,:] = filter centers [Hz]
         bands_vals[1,:] = filter sigmas [Hz]
+    max_bytes : int
+        Approximate memory limit of the slabs of channels read at once, and
+        of the analytic signals computed at once by the filter bank
+        (default=256 MB), see `memory_plan`.
+    dtype : str
+        Precision of the analytic signals, 'complex128' (default) or
+        'complex64', which halves their memory and is about twice as fast.
+        The spectral power is stored in float64 or float32, respectively.
+    storage : dict or None
+        HDF5 chunk shape and compression of the spectral power, see
+        `storage.storage_options` (default: chunks of 1 s by 16 channels by
+        one band, uncompressed).
+    block_size : float or None
+        If None (default), each channel is transformed over the whole
+        recording at once. Otherwise, length (seconds) of the time blocks
+        transformed at once (overlap-save, with FFTs of a fixed fast length),
+        so that memory does not depend on the recording length and run time
+        is linear in it. Memory is about 12 x nChannels x nBands bytes per sample of the
+        blocks.
+    block_context : float or None
+        Length (seconds) of signal transformed before and after each time
+        block. If None, the length after which the impulse responses of the
+        filters have decayed to 1e-6 (see `hilbert_context`). The amplitude
+        then matches the whole recording transform to float32 precision,
+        except for bands whose filters do not vanish at 0 Hz or at the
+        Nyquist frequency: the relative difference is up to the filter gain
+        there (e.g. 1e-3 for the 4.1 Hz Chang lab band, 0.7 for the 194 Hz
+        band at 400 Hz).
+    multirate : str or None
+        If None (default), all bands are computed at the LFP rate. Otherwise,
+        each band is computed at the lowest rate of an octave pyramid that
+        holds it (see `multirate`), and stored at the LFP rate ('common') or
+        at that rate ('native'). With 'native', the bands of each rate are
+        stored in their own DecompositionSeries: the highest rate in
+        'DecompositionSeries' and the others in 'DecompositionSeries_<rate>Hz'
+        (e.g. 'DecompositionSeries_50Hz'). 'common' is slower than None, as
+        the upsampling costs more than the FFTs saved. Not supported with
+        `block_size`.
+    output_rate : float or None
+        If None (default), the spectral power is stored at the LFP rate.
+        Otherwise, rate (Hz) at which it is stored (e.g. 100 or 200 Hz),
+        decimated with an anti-aliasing lowpass filter (see
+        `resample.Resampler`), and the rate of the DecompositionSeries. With
+        `multirate`, the bands are computed at rates down to twice
+        `output_rate` and all stored at `output_rate`, in a single
+        DecompositionSeries. The amplitude then differs from the one
+        decimated from the LFP rate by up to ~3e-3 of its maximum, as its
+        fast variations (near its zeros) alias at the lower rates.
+    incremental : bool
+        If True and the file has a DecompositionSeries of the same LFP with
+        the same options (except the bands), only the bands of `bands_vals`
+        missing from its `bands` table are computed, and added to it. Its
+        provenance is then the one of its old and new bands. The data of
+        DecompositionSeries written by older versions, or with contiguous
+        `storage`, cannot be resized: all their bands and the new ones are
+        then computed again. Not supported with `multirate`.
+    phase : bool
+        If True, the phase of the analytic signals is computed in the same
+        pass and stored in 'DecompositionSeries_phase', quantized to int16
+        (radians = data * conversion, see `phase.quantize_phase`), which
+        adds half the size of a float32 amplitude. The analytic signals of
+        the bands take 2 (complex64) or 4 (complex128) times the memory of
+        their amplitude. Not supported with `multirate` or `output_rate`.
+        To compute the phase of a few windows instead, see
+        `phase.LazyPhase`.
 
     Returns
     -------
-    Saves spectral power (DecompositionSeries) in the current NWB file.
-    Only if container for this data do not exist in the file.
+    Saves spectral power (DecompositionSeries), and its phase, in the current
+    NWB file, with its provenance. Skipped if it exists with the same
+    provenance.
     """
 
     # Get filter parameters
     band_param_0 = bands_vals[0, :]
     band_param_1 = bands_vals[1, :]
 
+    if multirate is not None and block_size is not None:
+        raise ValueError('multirate is not supported with block_size.')
+    if phase and (multirate is not None or output_rate is not None):
+        raise ValueError('phase is not supported with multirate or '
+                         'output_rate.')
+    if incremental:
+        if multirate is not None:
+            raise ValueError('multirate is not supported with incremental.')
+        stored, resizable = _stored_bands(block_path)
+        if stored is not None and stage_status(
+                block_path, 'decomposition',
+                _bands_config(stored, dtype, block_size, block_context,
+                              output_rate=output_rate,
+                              phase=phase))[0] == 'current':
+            new_bands = _missing_bands(bands_vals, stored)
+            if new_bands.shape[1] == 0:
+                print('DecompositionSeries has all the bands in {}, '
+                      'skipping.'.format(block_path))
+                return
+            # provenance of the old and new bands
+            bands_vals = np.concatenate([stored, new_bands], axis=1)
+            config = _bands_config(bands_vals, dtype, block_size,
+                                   block_context, output_rate=output_rate,
+                                   phase=phase)
+            _, provenance = stage_status(block_path, 'decomposition', config)
+            if resizable:
+                print('Adding {} bands to the DecompositionSeries.'.format(
+                    new_bands.shape[1]))
+                _append_bands(block_path, new_bands, provenance, max_bytes,
+                              dtype, block_size, block_context, output_rate,
+                              phase)
+                print('Spectral decomposition saved in ' + block_path)
+                return
+            print('DecompositionSeries cannot be resized, computing all its '
+                  'bands again.')
+            band_param_0 = bands_vals[0, :]
+            band_param_1 = bands_vals[1, :]
+    config = _bands_config(bands_vals, dtype, block_size, block_context,
+                           multirate, output_rate, phase)
+    if not _check_stage(block_path, 'decomposition', config,
+                        'DecompositionSeries'):
+        return
+    _, provenance = stage_status(block_path, 'decomposition', config)
+
     with NWBHDF5IO(block_path, 'r+', load_namespaces=True) as io:
         nwb = io.read()
         lfp = nwb.processing['ecephys'].data_interfaces['LFP'].electrical_series['preprocessed']
@@ -395,65 +1359,96 @@ def spectral_decomposition(block_path, bands_vals):
         nBands = len(band_param_0)
         nSamples = lfp.data.shape[0]
         nChannels = lfp.data.shape[1]
-        Xp = np.zeros((nBands, nChannels, nSamples))  # power (nBands,nChannels,nSamples)
-
-        # Apply Hilbert transform ---------------------------------------------
-        print('Running Spectral Decomposition...')
-        start = time.time()
-        for ch in np.arange(nChannels):
-            Xch = lfp.data[:, ch] * 1e6       # 1e6 scaling helps with numerical accuracy
-            Xch = Xch.reshape(1, -1)
-            Xch = Xch.astype('float32')     # signal (nChannels,nSamples)
-            X_fft_h = None
-            for ii, (bp0, bp1) in enumerate(zip(band_param_0, band_param_1)):
-                kernel = gaussian(Xch.shape[-1], rate, bp0, bp1)
-                X_analytic, X_fft_h = hilbert_transform(Xch, rate, kernel, phase=None, X_fft_h=X_fft_h)
-                Xp[ii, ch, :] = abs(X_analytic).astype('float32')
-        print('Spectral Decomposition finished in {} seconds'.format(time.time() - start))
-
-        # data: (ndarray) dims: num_times * num_channels * num_bands
-        Xp = np.swapaxes(Xp, 0, 2)
-
-        # Spectral band power
-        # bands: (DynamicTable) frequency bands that signal was decomposed into
-        band_param_0V = VectorData(
-            name='filter_param_0',
-            description='frequencies for bandpass filters',
-            data=band_param_0
-        )
-        band_param_1V = VectorData(
-            name='filter_param_1',
-            description='frequencies for bandpass filters',
-            data=band_param_1
-        )
-        bandsTable = DynamicTable(
-            name='bands',
-            description='Series of filters used for Hilbert transform.',
-            columns=[band_param_0V, band_param_1V],
-            colnames=['filter_param_0', 'filter_param_1']
-        )
-        decs = DecompositionSeries(
-            name='DecompositionSeries',
-            data=Xp,
-            description='Analytic amplitude estimated with Hilbert transform.',
-            metric='amplitude',
-            unit='V',
-            bands=bandsTable,
-            rate=rate,
-            source_timeseries=lfp
-        )
+        # samples of the power, at the output rate
+        nOut = _output_samples(nSamples, rate, output_rate)
+        if multirate is not None:
+            series = _multirate_decomposition(lfp.data, rate, bands_vals,
+                                              multirate, max_bytes, dtype,
+                                              output_rate)
+        else:
+            blocks = _decomposition_blocks(lfp.data, rate, bands_vals,
+                                           max_bytes, dtype, block_size,
+                                           block_context, output_rate, phase)
+            real = np.finfo(np.dtype(dtype)).dtype
+            if block_size is not None and phase:
+                # power and phase are written together once the series exist
+                # (see `_write_decomposition`)
+                Xp = BlockIterator(iter(()),
+                                   maxshape=(nOut, nChannels, nBands),
+                                   dtype=real)
+                Xq = BlockIterator(iter(()), maxshape=Xp.maxshape,
+                                   dtype='int16')
+            elif block_size is not None:
+                # power (nOut,nChannels,nBands), computed while it is written
+                Xp = BlockIterator(blocks, maxshape=(nOut, nChannels, nBands),
+                                   dtype=real)
+            elif phase:
+                Xp, Xq = next(blocks)
+            else:
+                Xp = next(blocks)
+        if multirate is None:
+            series = [(rate if output_rate is None else output_rate,
+                       np.arange(nBands), Xp)]
 
         # Storage of spectral decomposition on NWB file ------------------------
         ecephys_module = nwb.processing['ecephys']
-        ecephys_module.add_data_interface(decs)
+        names = []
+        for ii, (series_rate, bands, Xp) in enumerate(series):
+            shape = Xp.maxshape if isinstance(Xp, BlockIterator) else Xp.shape
+            names.append('DecompositionSeries' if ii == 0 else
+                         'DecompositionSeries_{:g}Hz'.format(series_rate))
+            # Spectral band power
+            # bands: (DynamicTable) frequency bands that signal was decomposed into
+            decs = DecompositionSeries(
+                name=names[-1],
+                data=data_io(Xp, series_rate, storage,
+                             maxshape=shape[:2] + (None,)),
+                description='Analytic amplitude estimated with Hilbert transform.',
+                metric='amplitude',
+                unit='V',
+                bands=_bands_table(band_param_0[bands], band_param_1[bands]),
+                rate=series_rate,
+                source_timeseries=lfp,
+                comments=pending_comments(provenance)
+            )
+            ecephys_module.add_data_interface(decs)
+        if phase:
+            # Phase of the analytic signals, quantized to int16
+            decs_phase = DecompositionSeries(
+                name='DecompositionSeries_phase',
+                data=data_io(Xq, rate, storage, maxshape=(nOut, nChannels,
+                                                          None)),
+                description='Phase of the analytic signal estimated with '
+                            'Hilbert transform, quantized to int16.',
+                metric='phase',
+                unit='radians',
+                conversion=phase_conversion,
+                bands=_bands_table(band_param_0, band_param_1),
+                rate=rate,
+                source_timeseries=lfp,
+                comments=pending_comments(provenance)
+            )
+            ecephys_module.add_data_interface(decs_phase)
+            names.append('DecompositionSeries_phase')
         io.write(nwb)
-        print('Spectral decomposition saved in ' + block_path)
-
-
-def high_gamma_estimation(block_path, bands_vals, new_file=''):
+    if phase and block_size is not None:
+        # the provenance is stamped once the series are filled
+        with h5py.File(block_path, 'r+') as f:
+            _write_decomposition(f['processing/ecephys'], bands_vals,
+                                 max_bytes, dtype, block_size, block_context,
+                                 output_rate, phase)
+    stamp_provenance(block_path, names, provenance)
+    print('Spectral decomposition saved in ' + block_path)
+
+
+def high_gamma_estimation(block_path, bands_vals, new_file='', max_bytes=2**28,
+                          dtype='complex128', storage=None, block_size=None,
+                          block_context=None, output_rate=None):
     """
     Takes preprocessed LFP data and calculates High-Gamma power from the
-    averaged power of standard Hilbert transform on 70~150 Hz bands.
+    averaged power of standard Hilbert transform on 70~150 Hz bands. The
+    average is accumulated in float32 band by band, so memory usage is about
+    one (nSamples, nChannels) array, whatever the number of bands.
 
     Parameters
     ----------
@@ -466,50 +1461,105 @@ def high_gamma_estimation(block_path, bands_vals, new_file=''):
         if this argument is of form 'path/to/new_file.nwb', High Gamma power
         will be saved in a new file. If it is an empty string, '', High Gamma
         power will be saved in the current NWB file.
+    max_bytes : int
+        Approximate memory limit of the slabs of channels read at once, and
+        of the analytic signals computed at once by the filter bank
+        (default=256 MB), see `memory_plan`.
+    dtype : str
+        Precision of the analytic signals, 'complex128' (default) or
+        'complex64', which halves their memory and is about twice as fast.
+    storage : dict or None
+        HDF5 chunk shape and compression of High Gamma, see
+        `storage.storage_options` (default: chunks of 1 s by 16 channels,
+        uncompressed).
+    block_size : float or None
+        If None (default), each channel is transformed over the whole
+        recording at once. Otherwise, length (seconds) of the time blocks
+        transformed at once (overlap-save, with FFTs of a fixed fast length),
+        so that memory does not depend on the recording length and run time
+        is linear in it. Memory is about 12 x nChannels bytes per sample of the
+        blocks.
+    block_context : float or None
+        Length (seconds) of signal transformed before and after each time
+        block. If None, the length after which the impulse responses of the
+        filters have decayed to 1e-6 (see `hilbert_context`). The amplitude
+        then matches the whole recording transform to float32 precision,
+        except for bands whose filters do not vanish at 0 Hz or at the
+        Nyquist frequency: the relative difference is up to the filter gain
+        there (e.g. 1e-3 for the 4.1 Hz Chang lab band, 0.7 for the 194 Hz
+        band at 400 Hz).
+    output_rate : float or None
+        If None (default), High Gamma is stored at the LFP rate. Otherwise,
+        rate (Hz) at which it is stored (e.g. 100 or 200 Hz), decimated with
+        an anti-aliasing lowpass filter (see `resample.Resampler`), and the
+        rate of the series.
 
     Returns
     -------
-    Saves High Gamma power (TimeSeries) in the current or new NWB file.
-    Only if container for this data do not exist in the file.
+    Saves High Gamma power (TimeSeries) in the current or new NWB file, with
+    its provenance. Skipped if it exists with the same provenance.
     """
 
     # Get filter parameters
     band_param_0 = bands_vals[0, :]
     band_param_1 = bands_vals[1, :]
 
+    config = _bands_config(bands_vals, dtype, block_size, block_context,
+                           output_rate=output_rate)
+    output_path = None if new_file == '' or new_file is None else new_file
+    if not _check_stage(block_path, 'high_gamma', config, 'High Gamma',
+                        output_path):
+        return
+    _, provenance = stage_status(block_path, 'high_gamma', config, output_path)
+
     with NWBHDF5IO(block_path, 'r+', load_namespaces=True) as io:
         nwb = io.read()
         lfp = nwb.processing['ecephys'].data_interfaces['LFP'].electrical_series['preprocessed']
         rate = lfp.rate
 
-        nBands = len(band_param_0)
         nSamples = lfp.data.shape[0]
         nChannels = lfp.data.shape[1]
-        Xp = np.zeros((nBands, nChannels, nSamples))  # power (nBands,nChannels,nSamples)
-
-        # Apply Hilbert transform ---------------------------------------------
-        print('Running High Gamma estimation...')
-        start = time.time()
-        for ch in np.arange(nChannels):
-            Xch = lfp.data[:, ch] * 1e6       # 1e6 scaling helps with numerical accuracy
-            Xch = Xch.reshape(1, -1)
-            Xch = Xch.astype('float32')     # signal (nChannels,nSamples)
-            X_fft_h = None
-            for ii, (bp0, bp1) in enumerate(zip(band_param_0, band_param_1)):
-                kernel = gaussian(Xch.shape[-1], rate, bp0, bp1)
-                X_analytic, X_fft_h = hilbert_transform(
-                    Xch, rate, kernel, phase=None, X_fft_h=X_fft_h)
-                Xp[ii, ch, :] = abs(X_analytic).astype('float32')
-        print('High Gamma estimation finished in {} seconds'.format(time.time() - start))
-
-        # data: (ndarray) dims: num_times * num_channels * num_bands
-        Xp = np.swapaxes(Xp, 0, 2)
-        HG = np.mean(Xp, 2)   # average of high gamma bands
+        # samples of High Gamma, at the output rate
+        nOut = _output_samples(nSamples, rate, output_rate)
+        if block_size is not None:
+            # (nOut,nChannels), computed while it is written
+            HG = BlockIterator(
+                _decimated_blocks(
+                    _hilbert_time_blocks(lfp.data, rate, bands_vals,
+                                         block_size, block_context, max_bytes,
+                                         dtype, band_mean=True,
+                                         name='High Gamma estimation'),
+                    rate, output_rate),
+                maxshape=(nOut, nChannels),
+                dtype='float32'
+            )
+        else:
+            HG = np.zeros((nOut, nChannels), dtype='float32')  # (nOut,nChannels)
+
+            # Apply Hilbert transform -----------------------------------------
+            print('Running High Gamma estimation...')
+            print('FFT backend: {}'.format(backend_info()))
+            start = time.time()
+            # Read slabs of channels, one channel at a time is slow on chunked data
+            filters = gaussian_filter_bank(nSamples, rate, band_param_0,
+                                           band_param_1,
+                                           np.finfo(np.dtype(dtype)).dtype)
+            for c0, c1, Xs in channel_blocks(lfp.data, max_bytes=max_bytes,
+                                             dtype='float32'):
+                Xch = Xs.T * 1e6       # 1e6 scaling helps with numerical accuracy
+                Xch = Xch.astype('float32', copy=False)  # (nChannels,nSamples)
+                # average of high gamma bands, accumulated band by band
+                Xm = hilbert_band_mean(Xch, rate, filters, max_bytes=max_bytes,
+                                       use_rfft=True, dtype=dtype).T
+                HG[:, c0:c1] = _decimate(Xm, rate, output_rate)
+            print('High Gamma estimation finished in {} seconds'.format(time.time() - start))
+        if output_rate is not None:
+            rate = output_rate
 
         # Storage of High Gamma on NWB file -----------------------------
         if new_file == '' or new_file is None:  # on current file
             # make electrodes table
-            nElecs = HG.shape[1]
+            nElecs = nChannels
             ecephys_module = nwb.processing['ecephys']
 
             # first check for a table among the file's data_interfaces
@@ -528,10 +1578,11 @@ def high_gamma_estimation(block_path, bands_vals, new_file=''):
             )
             hg = ElectricalSeries(
                 name='high_gamma',
-                data=HG,
+                data=data_io(HG, rate, storage),
                 electrodes=elecs_region,
                 rate=rate,
-                description=''
+                description='',
+                comments=pending_comments(provenance)
             )
 
             ecephys_module.add_data_interface(hg)
@@ -541,7 +1592,7 @@ def high_gamma_estimation(block_path, bands_vals, new_file=''):
             with NWBHDF5IO(new_file, 'r+', load_namespaces=True) as io_new:
                 nwb_new = io_new.read()
                 # make electrodes table
-                nElecs = HG.shape[1]
+                nElecs = nChannels
                 elecs_region = nwb_new.electrodes.create_region(
                     name='electrodes',
                     region=np.arange(nElecs).tolist(),
@@ -549,10 +1600,11 @@ def high_gamma_estimation(block_path, bands_vals, new_file=''):
                 )
                 hg = ElectricalSeries(
                     name='high_gamma',
-                    data=HG,
+                    data=data_io(HG, rate, storage),
                     electrodes=elecs_region,
                     rate=rate,
-                    description=''
+                    description='',
+                    comments=pending_comments(provenance)
                 )
 
                 try:      # if ecephys module already exists
@@ -565,3 +1617,4 @@ def high_gamma_estimation(block_path, bands_vals, new_file=''):
                 ecephys_module.add_data_interface(hg)
                 io_new.write(nwb_new)
                 print('High Gamma power saved in ' + new_file)
+    stamp_provenance(output_path or block_path, ['high_gamma'], provenance)
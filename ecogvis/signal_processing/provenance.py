@@ -0,0 +1,279 @@
+"""
+Provenance of the processing outputs of a block file: each stage stores a
+hash of its inputs (source data identity, configuration and code version) in
+the `comments` of its output, so that reruns with the same inputs can be
+skipped, and outputs computed from changed inputs can be detected and
+recomputed (together with the outputs downstream of them).
+
+Outputs are created with `pending_comments` (their provenance without hash,
+marked incomplete), and `stamp_provenance` stores the provenance once their
+data is fully written: an output whose write was interrupted (e.g. by a
+MemoryError while streaming) is stale, and is recomputed by the next run.
+
+Stages and their outputs, in /processing/ecephys:
+
+    'preprocess'     LFP (source: raw ElectricalSeries in acquisition)
+    'decomposition'  DecompositionSeries, DecompositionSeries_<rate>Hz
+                     with multirate and DecompositionSeries_phase with
+                     phase (source: LFP)
+    'high_gamma'     high_gamma (source: LFP)
+    'psd_raw'        Spectrum_fft_raw, Spectrum_welch_raw (source: raw
+                     ElectricalSeries in acquisition)
+    'psd_preprocessed'
+                     Spectrum_fft_preprocessed, Spectrum_welch_preprocessed
+                     (source: LFP)
+
+Spectrum outputs have no `comments` field: their provenance is stored in
+the `comments` attribute of their group once written.
+"""
+from __future__ import division
+
+import ast
+import fnmatch
+import hashlib
+import json
+import re
+
+import h5py
+import numpy as np
+
+__all__ = ['code_version',
+           'parse_comments',
+           'pending_comments',
+           'remove_outputs',
+           'stage_provenance',
+           'stage_status',
+           'stamp_provenance']
+
+# output of each stage, and outputs that depend on it (removed with it, names
+# or fnmatch patterns)
+_outputs = {'preprocess': 'LFP/preprocessed',
+            'decomposition': 'DecompositionSeries',
+            'high_gamma': 'high_gamma',
+            'psd_raw': 'Spectrum_fft_raw',
+            'psd_preprocessed': 'Spectrum_fft_preprocessed'}
+_downstream = {'preprocess': ['LFP', 'bipolar-referenced metadata',
+                              'DecompositionSeries', 'DecompositionSeries_*',
+                              'high_gamma', 'Spectrum_*_preprocessed'],
+               'decomposition': ['DecompositionSeries', 'DecompositionSeries_*'],
+               'high_gamma': ['high_gamma'],
+               'psd_raw': ['Spectrum_*_raw'],
+               'psd_preprocessed': ['Spectrum_*_preprocessed']}
+# options that do not change the results (e.g. chosen by `memory_plan`), of
+# all the stages and of some stages: the streaming preprocessing matches the
+# preprocessing of the whole recording to within 0.5% of the signal std
+_ignored = {'n_jobs', 'max_bytes', 'storage'}
+_stage_ignored = {'preprocess': {'block_size'}}
+
+
+def code_version():
+    """Installed version of ecogvis ('unknown' if not installed)."""
+    try:
+        from pkg_resources import get_distribution
+        return get_distribution('ecogvis').version
+    except Exception:
+        return 'unknown'
+
+
+def stage_provenance(stage, config, source):
+    """
+    Provenance record of a processing stage.
+
+    Parameters
+    ----------
+    stage : str
+        'preprocess', 'decomposition', 'high_gamma', 'psd_raw' or
+        'psd_preprocessed'.
+    config : dict
+        Configuration of the stage (options that do not change the results,
+        in `_ignored` and `_stage_ignored`, are left out).
+    source : dict
+        Identity of the input data, e.g. {'object_id': ..., 'shape': ...}.
+
+    Returns
+    -------
+    provenance : dict
+        'stage', 'config', 'source', 'version' and 'hash' (sha256 of the
+        others). `json.dumps(provenance)` is stored in the output comments.
+    """
+    ignored = _ignored | _stage_ignored.get(stage, set())
+    provenance = {'stage': stage,
+                  'config': _to_json({k: v for k, v in config.items()
+                                      if k not in ignored}),
+                  'source': _to_json(source),
+                  'version': code_version()}
+    text = json.dumps(provenance, sort_keys=True)
+    provenance['hash'] = hashlib.sha256(text.encode()).hexdigest()
+    return provenance
+
+
+def pending_comments(provenance):
+    """
+    Comments of an output while its data is written: the provenance record
+    without 'hash', marked 'incomplete'.
+    """
+    pending = {k: v for k, v in provenance.items() if k != 'hash'}
+    pending['incomplete'] = True
+    return json.dumps(pending)
+
+
+def stamp_provenance(path, names, provenance):
+    """
+    Store the provenance record in the comments of outputs whose data is
+    fully written.
+
+    Parameters
+    ----------
+    path : str
+        Path of the NWB file of the outputs.
+    names : list of str
+        Names of the outputs in /processing/ecephys, e.g. 'LFP/preprocessed'.
+    provenance : dict
+        Provenance record, see `stage_provenance`.
+    """
+    with h5py.File(path, 'r+') as f:
+        ecephys = f['processing/ecephys']
+        for name in names:
+            ecephys[name].attrs['comments'] = json.dumps(provenance)
+
+
+def parse_comments(comments):
+    """
+    Provenance record stored in the comments of an output.
+
+    Comments of LFP written by older versions ('referencing:..., Notch:...,
+    Downsampled:...') are parsed to a record without 'hash'.
+
+    Returns
+    -------
+    provenance : dict or None
+        None if the comments do not hold a provenance record.
+    """
+    try:
+        provenance = json.loads(comments)
+        if isinstance(provenance, dict) and 'stage' in provenance:
+            return provenance
+    except (TypeError, ValueError):
+        pass
+    match = re.match(r'referencing:(.*?),\s*Notch:(.*?),\s*Downsampled:(.*)$',
+                     str(comments))
+    if match is None:
+        return None
+    referencing, notch, downs = [m.strip() for m in match.groups()]
+    try:
+        referencing = ast.literal_eval(referencing)
+    except (ValueError, SyntaxError):
+        pass
+    config = {'referencing': None if referencing == 'None' else referencing,
+              'Notch': None if notch == 'None' else float(notch),
+              'Downsample': None if downs == 'No' else downs}
+    return {'stage': 'preprocess', 'config': config}
+
+
+def stage_status(block_path, stage, config, output_path=None):
+    """
+    Whether the output of a stage is missing, up to date or stale.
+
+    Parameters
+    ----------
+    block_path : str
+        Path of the NWB file with the source data.
+    stage : str
+        'preprocess', 'decomposition', 'high_gamma', 'psd_raw' or
+        'psd_preprocessed'.
+    config : dict
+        Configuration of the stage.
+    output_path : str or None
+        Path of the NWB file of the output, if not block_path.
+
+    Returns
+    -------
+    status : str
+        'missing', 'current' (same inputs), 'stale' (different inputs, or
+        incomplete output) or 'unknown' (output without provenance, from an
+        older version).
+    provenance : dict or None
+        Provenance record the output should have, None if the source data
+        is missing.
+    """
+    with h5py.File(block_path, 'r') as f:
+        source = _source_identity(f, stage)
+    provenance = None if source is None else stage_provenance(stage, config,
+                                                              source)
+    with h5py.File(output_path or block_path, 'r') as f:
+        ecephys = f.get('processing/ecephys')
+        if ecephys is not None and not _written(ecephys):
+            return 'stale', provenance
+        output = f.get('processing/ecephys/' + _outputs[stage])
+        if output is None:
+            return 'missing', provenance
+        written = _written(output)
+        stored = parse_comments(_attr_str(output, 'comments'))
+    if not written or stored is not None and stored.get('incomplete'):
+        return 'stale', provenance
+    if stored is None or 'hash' not in stored or provenance is None:
+        return 'unknown', provenance
+    if stored['hash'] == provenance['hash']:
+        return 'current', provenance
+    return 'stale', provenance
+
+
+def remove_outputs(path, stage):
+    """
+    Remove the output of a stage and the outputs downstream of it from the
+    file. Note that HDF5 does not reclaim the space of removed data (see
+    h5repack).
+    """
+    with h5py.File(path, 'r+') as f:
+        ecephys = f.get('processing/ecephys')
+        if ecephys is None:
+            return
+        if not _written(ecephys):
+            # created by an interrupted write, with the outputs in it
+            del f['processing/ecephys']
+            return
+        for name in list(ecephys):
+            if any(fnmatch.fnmatchcase(name, pattern)
+                   for pattern in _downstream[stage]):
+                del ecephys[name]
+
+
+def _source_identity(f, stage):
+    """Identity of the input data of a stage, from the open h5py file."""
+    if stage in ('preprocess', 'psd_raw'):
+        for obj in f['acquisition'].values():
+            if _attr_str(obj, 'neurodata_type') == 'ElectricalSeries':
+                return {'object_id': _attr_str(obj, 'object_id'),
+                        'shape': list(obj['data'].shape)}
+        return None
+    lfp = f.get('processing/ecephys/LFP/preprocessed')
+    if lfp is None:
+        return None
+    stored = parse_comments(_attr_str(lfp, 'comments'))
+    if stored is not None and 'hash' in stored:
+        return {'LFP': stored['hash']}
+    return {'LFP': _attr_str(lfp, 'object_id')}
+
+
+def _written(obj):
+    """Whether the write of an h5py group by pynwb completed (it writes the
+    attributes of the group after its data)."""
+    return _attr_str(obj, 'neurodata_type') is not None
+
+
+def _attr_str(obj, name):
+    value = obj.attrs.get(name)
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value
+
+
+def _to_json(value):
+    """Convert numpy arrays, tuples and numpy scalars for json."""
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
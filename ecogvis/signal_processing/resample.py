@@ -0,0 +1,263 @@
+"""
+Resampling engine: polyphase FIR resampling for rational ratios of sampling
+rates (e.g. 3051.7578125 to 400 Hz is 2048/15625, audio decimation by 30 is
+1/30), and FFT resampling (`process_nwb.resample`) for the other ratios.
+
+Polyphase resampling costs O(n) per output sample and works chunk by chunk
+with `Resampler`, which gives the same output as resampling the whole signal
+at once.
+"""
+from __future__ import division
+
+import numpy as np
+from scipy.signal import firwin, upfirdn
+from process_nwb.resample import resample as fft_resample
+
+from ecogvis.signal_processing.kernel_cache import kernel_cache
+from ecogvis.signal_processing.streaming import rational_period
+
+__all__ = ['Resampler',
+           'polyphase_filter',
+           'resample',
+           'resample_ratio']
+
+
+def resample_ratio(new_rate, old_rate, max_factor=2**16):
+    """
+    Upsampling and downsampling factors of a rational resampling ratio.
+
+    Parameters
+    ----------
+    new_rate : float
+        New sampling frequency (Hz).
+    old_rate : float
+        Original sampling frequency (Hz).
+    max_factor : int
+        Largest factor accepted (the polyphase filter has 20 taps per unit of
+        the largest factor).
+
+    Returns
+    -------
+    up, down : int or None
+        Factors, with up / down == new_rate / old_rate, None if the ratio is
+        not rational with factors up to `max_factor`.
+    """
+    down, up = rational_period(old_rate, new_rate)
+    exact = np.isclose(up * old_rate, down * new_rate, rtol=1e-12, atol=0)
+    if not exact or max(up, down) > max_factor:
+        return None, None
+    return up, down
+
+
+def polyphase_filter(up, down, half_width=10, beta=5., cache=None):
+    """
+    Anti-aliasing lowpass FIR filter of polyphase resampling, as designed by
+    `scipy.signal.resample_poly` (Kaiser window, cutoff at the lowest Nyquist
+    frequency), scaled by `up`.
+
+    Parameters
+    ----------
+    up, down : int
+        Upsampling and downsampling factors.
+    half_width : int
+        Half length of the filter, in units of the largest factor.
+    beta : float
+        Shape parameter of the Kaiser window.
+    cache : KernelCache or None
+        Cache to use, `kernel_cache` by default.
+
+    Returns
+    -------
+    h : ndarray (2 * half_width * max(up, down) + 1,)
+        Filter taps (read-only).
+    """
+    cache = kernel_cache if cache is None else cache
+    max_rate = max(up, down)
+
+    def build():
+        h = firwin(2 * half_width * max_rate + 1, 1. / max_rate,
+                   window=('kaiser', beta))
+        return h * up
+
+    return cache.get(('polyphase', int(up), int(down), int(half_width),
+                      float(beta)), build)
+
+
+class Resampler(object):
+    """
+    Polyphase resampling of a signal given chunk by chunk, along the first
+    axis.
+
+    Output sample m is at the time of input sample m * down / up, and the
+    output has ceil(n_samples * up / down) samples, as with
+    `scipy.signal.resample_poly`. The concatenated outputs of the chunks are
+    the same as the output of the whole signal (with 'reflect' padding, the
+    first and last chunks need at least `n_edge` samples).
+
+    Parameters
+    ----------
+    up, down : int
+        Upsampling and downsampling factors.
+    pad : str
+        Signal before the first and after the last sample: 'reflect' (odd
+        reflection, default) or 'constant' (zeros, as
+        `scipy.signal.resample_poly`).
+    half_width, beta :
+        Filter parameters, see `polyphase_filter`.
+    dtype : numpy float dtype
+        Precision of the computations and of the output (default=float64).
+
+    Example
+    -------
+    >>> resampler = Resampler(2048, 15625)
+    >>> for chunk in chunks:
+    ...     out.append(resampler.process(chunk))
+    >>> out.append(resampler.process(last_chunk, last=True))
+    """
+
+    def __init__(self, up, down, pad='reflect', half_width=10, beta=5.,
+                 dtype=np.float64):
+        if pad not in ('reflect', 'constant'):
+            raise ValueError("pad should be 'reflect' or 'constant', not "
+                             "{}".format(pad))
+        self.up = int(up)
+        self.down = int(down)
+        self.pad = pad
+        self.dtype = np.dtype(dtype)
+        self.h = polyphase_filter(self.up, self.down, half_width,
+                                  beta).astype(self.dtype, copy=False)
+        self.half = (len(self.h) - 1) // 2
+        # input samples needed before the first and after the last sample
+        self.n_edge = -(-self.half // self.up)
+        self.n_in = 0       # input samples received
+        self._buffer = None
+        self._start = 0     # input index of the first sample of the buffer
+        self._next = 0      # index of the next output sample
+
+    def process(self, X, last=False):
+        """
+        Resample the next chunk of the signal.
+
+        Parameters
+        ----------
+        X : ndarray (n_time, ...)
+            Next chunk of the signal.
+        last : bool
+            Whether this is the last chunk, all the remaining output samples
+            are returned.
+
+        Returns
+        -------
+        Y : ndarray (n_time_out, ...)
+            Output samples that can be computed with the input received.
+        """
+        X = np.asarray(X, dtype=self.dtype)
+        if self._buffer is None:
+            self._buffer = X[:0]
+        # whole signal in one chunk, reflected at both ends at once
+        reflected = False
+        if self.n_in == 0 and len(X) > 0 and self.pad == 'reflect':
+            self._start = -self.n_edge
+            self.n_in = len(X)
+            reflected = last
+            X = _reflect(X, self.n_edge, self.n_edge if last else 0)
+        else:
+            self.n_in += len(X)
+        if len(self._buffer) == 0:
+            # no copy (e.g. of the transposed view of a whole signal)
+            self._buffer = X
+        else:
+            self._buffer = np.concatenate([self._buffer, X])
+
+        end = self._start + len(self._buffer)
+        if last:
+            stop = -(-self.n_in * self.up // self.down)
+            if self.pad == 'reflect' and len(self._buffer) > 0 and \
+                    not reflected:
+                self._buffer = _reflect(self._buffer, 0, self.n_edge)
+        else:
+            # last output with all its input samples
+            stop = (end * self.up - self.half - 1) // self.down + 1
+        stop = max(stop, self._next)
+
+        Y = self._outputs(self._next, stop)
+        self._next = stop
+        # keep the input samples of the next outputs
+        keep = -(-(stop * self.down - self.half) // self.up)
+        if keep > self._start:
+            self._buffer = self._buffer[keep - self._start:]
+            self._start = keep
+        if not last:
+            # a copy, X may be reused by the caller for the next chunk
+            self._buffer = self._buffer.copy()
+        return Y
+
+    def _outputs(self, m0, m1):
+        """Output samples m0 to m1, from the input samples of the buffer."""
+        shape = (m1 - m0,) + self._buffer.shape[1:]
+        if m1 <= m0 or len(self._buffer) == 0:
+            return np.zeros(shape, dtype=self.dtype)
+        up, down, half = self.up, self.down, self.half
+        i0 = max(-(-(m0 * down - half) // up), self._start)
+        i1 = min(((m1 - 1) * down + half) // up + 1,
+                 self._start + len(self._buffer))
+        # delay the filter so that output m is at input m * down / up
+        shift = (i0 * up - half) % down
+        r0 = m0 + (half + shift - i0 * up) // down
+        h = np.concatenate([np.zeros(shift, dtype=self.dtype), self.h])
+        # upfirdn is faster along the last axis, even of a transposed view
+        X = np.moveaxis(self._buffer[i0 - self._start:i1 - self._start], 0, -1)
+        Y = np.moveaxis(upfirdn(h, X, up, down, axis=-1), -1, 0)
+        return Y[r0:r0 + m1 - m0]
+
+
+def resample(X, new_rate, old_rate, method='auto', axis=0, dtype=None):
+    """
+    Resample signals from `old_rate` to `new_rate`.
+
+    Parameters
+    ----------
+    X : ndarray (n_time, ...)
+        Signals.
+    new_rate : float
+        New sampling frequency (Hz).
+    old_rate : float
+        Original sampling frequency (Hz).
+    method : str
+        'poly' (polyphase FIR, for rational ratios), 'fft'
+        (`process_nwb.resample`) or 'auto' (default), which uses 'poly' if
+        the ratio is rational and 'fft' otherwise.
+    axis : int
+        Time axis.
+    dtype : numpy float dtype or None
+        Precision of the resampled signals. If None, float64. FFT resampling
+        is computed in float64 and cast to `dtype`.
+
+    Returns
+    -------
+    Xds : ndarray
+        Resampled signals. The time axis has ceil(n_time * new_rate /
+        old_rate) samples.
+    """
+    if method not in ('auto', 'poly', 'fft'):
+        raise ValueError("method should be 'auto', 'poly' or 'fft', not "
+                         "{}".format(method))
+    up, down = (None, None) if method == 'fft' else \
+        resample_ratio(new_rate, old_rate)
+    if up is None:
+        if method == 'poly':
+            raise ValueError('Resampling ratio {}/{} is not a rational number '
+                             'with small factors.'.format(new_rate, old_rate))
+        Xds = fft_resample(X, new_rate, old_rate, axis=axis)
+        return Xds if dtype is None else Xds.astype(dtype, copy=False)
+
+    dtype = np.float64 if dtype is None else dtype
+    X = np.moveaxis(X, axis, 0)
+    Xds = Resampler(up, down, dtype=dtype).process(X, last=True)
+    return np.moveaxis(Xds, 0, axis)
+
+
+def _reflect(X, before, after):
+    """Odd reflection of X (n_time, ...) before and after its ends."""
+    pad = [(before, after)] + [(0, 0)] * (X.ndim - 1)
+    return np.pad(X, pad, mode='reflect', reflect_type='odd')
@@ -0,0 +1,138 @@
+"""
+Storage layout of the derived datasets (LFP, DecompositionSeries and
+high_gamma): HDF5 chunk shape and compression, passed to the NWB writer with
+`H5DataIO`.
+
+The datasets are (n_time, n_channels[, n_bands]) and are mostly read as
+short time windows of a few channels: the TimeSeriesPlotter reads windows of
+2 s by 16 channels, and the ERP dialog reads epochs of one channel around
+each event. Chunks of 1 s by 16 channels (one band) keep these reads to a
+few small chunks: on a 128 channels, 10 min LFP, viewer windows are read
+1.3x faster and ERP epochs 2x faster than from a contiguous dataset. The
+signals are noisy float32 values that compress poorly (gzip saves ~15%),
+while decompression makes ERP epochs 3 to 8x slower, so compression is off
+by default. See benchmarks/bench_chunk_layout.py.
+"""
+from __future__ import division
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+
+__all__ = ['data_io',
+           'default_storage',
+           'storage_chunks',
+           'storage_options']
+
+# chunk_duration : time length of the chunks (s), None for contiguous data
+# chunk_channels : number of channels of the chunks
+# compression : None, 'gzip' or 'lzf' (faster, but only available in h5py)
+# compression_opts : gzip level (0-9)
+# shuffle : byte shuffle filter before compression
+default_storage = {'chunk_duration': 1.,
+                   'chunk_channels': 16,
+                   'compression': None,
+                   'compression_opts': 4,
+                   'shuffle': False}
+
+
+def storage_options(storage=None):
+    """
+    Storage options, completed with `default_storage` and checked.
+
+    Parameters
+    ----------
+    storage : dict or None
+        Options to change from `default_storage`, e.g. {'compression':
+        'lzf', 'shuffle': True} for compressed chunks, or {'chunk_duration':
+        None} for contiguous datasets.
+
+    Returns
+    -------
+    options : dict
+    """
+    unknown = set(storage or {}) - set(default_storage)
+    if unknown:
+        raise ValueError('Unknown storage options: {}'.format(
+            ', '.join(sorted(unknown))))
+    options = dict(default_storage, **(storage or {}))
+    compression = options['compression']
+    if compression not in (None, 'gzip', 'lzf'):
+        raise ValueError("compression should be None, 'gzip' or 'lzf', not "
+                         "{}".format(compression))
+    if compression == 'gzip':
+        if options['compression_opts'] not in range(10):
+            raise ValueError('gzip level should be 0 to 9, not {}'.format(
+                options['compression_opts']))
+    else:
+        options['compression_opts'] = None
+    if options['chunk_duration'] is None:
+        if compression is not None or options['shuffle']:
+            raise ValueError('Compression and shuffle need chunked data '
+                             '(chunk_duration is None).')
+    elif options['chunk_duration'] <= 0 or options['chunk_channels'] < 1:
+        raise ValueError('chunk_duration and chunk_channels should be '
+                         'positive.')
+    return options
+
+
+def storage_chunks(shape, rate, storage=None):
+    """
+    HDF5 chunk shape of a (n_time, n_channels[, n_bands]) dataset.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the dataset.
+    rate : float
+        Sampling rate of the dataset (Hz).
+    storage : dict or None
+        Storage options, see `storage_options`.
+
+    Returns
+    -------
+    chunks : tuple or None
+        Chunk shape (one band per chunk), None for contiguous data.
+    """
+    options = storage_options(storage)
+    if options['chunk_duration'] is None:
+        return None
+    n_time = int(np.clip(round(options['chunk_duration'] * rate), 1,
+                         max(shape[0], 1)))
+    n_channels = int(min(options['chunk_channels'], max(shape[1], 1)))
+    return (n_time, n_channels) + (1,) * (len(shape) - 2)
+
+
+def data_io(data, rate, storage=None, maxshape=None):
+    """
+    Wrap the data of a derived dataset in `H5DataIO` with its storage layout.
+
+    Parameters
+    ----------
+    data : ndarray or AbstractDataChunkIterator
+        (n_time, n_channels[, n_bands]) data, or a `BlockIterator` over it.
+    rate : float
+        Sampling rate of the data (Hz).
+    storage : dict or None
+        Storage options, see `storage_options`.
+    maxshape : tuple or None
+        Largest shape of the dataset (None for the unlimited axes), to make
+        it resizable, e.g. (n_time, n_channels, None) to add bands to a
+        DecompositionSeries. Contiguous datasets are not resizable, it is
+        ignored for them.
+
+    Returns
+    -------
+    data : H5DataIO, or `data` itself for contiguous datasets.
+    """
+    options = storage_options(storage)
+    shape = data.maxshape if hasattr(data, 'recommended_data_shape') \
+        else data.shape
+    chunks = storage_chunks(shape, rate, options)
+    if chunks is None:
+        return data
+    return H5DataIO(data=data,
+                    chunks=chunks,
+                    maxshape=maxshape,
+                    compression=options['compression'],
+                    compression_opts=options['compression_opts'],
+                    shuffle=options['shuffle'])
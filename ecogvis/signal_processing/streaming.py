@@ -0,0 +1,391 @@
+"""
+Helpers to process and store signals in blocks, so that memory usage is
+bounded by the block size instead of by the recording length.
+"""
+from __future__ import division
+
+from fractions import Fraction
+
+import h5py
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+__all__ = ['BlockIterator',
+           'BlockReader',
+           'channel_blocks',
+           'channel_bounds',
+           'circular_blocks',
+           'circular_window',
+           'rational_period',
+           'time_blocks',
+           'with_chunk_cache']
+
+
+def rational_period(old_rate, new_rate, max_period=2**16):
+    """
+    Smallest number of input and output samples that span exactly the same
+    time interval when resampling from `old_rate` to `new_rate`.
+
+    Blocks that start at multiples of this period are aligned to the output
+    sampling grid, so they can be resampled independently.
+
+    Parameters
+    ----------
+    old_rate : float
+        Original sampling frequency (Hz).
+    new_rate : float
+        New sampling frequency (Hz).
+    max_period : int
+        The ratio of the rates is approximated by a fraction whose
+        denominator (n_old) is at most max_period.
+
+    Returns
+    -------
+    n_old : int
+        Period in number of samples at `old_rate`.
+    n_new : int
+        Period in number of samples at `new_rate`.
+
+    Notes
+    -----
+    The period is exact only if n_new / n_old == new_rate / old_rate, which
+    `resample.resample_ratio` checks.
+    """
+    ratio = (Fraction(new_rate) / Fraction(old_rate)).limit_denominator(
+        max_period)
+    return ratio.denominator, ratio.numerator
+
+
+def time_blocks(n_samples, block_size, context=0):
+    """
+    Split `n_samples` in consecutive blocks of `block_size` samples, each one
+    extended by `context` samples on both sides (clipped at the edges).
+
+    Parameters
+    ----------
+    n_samples : int
+        Total number of samples.
+    block_size : int
+        Number of samples per block (the last block may be shorter).
+    context : int
+        Number of extra samples read before and after each block.
+
+    Yields
+    ------
+    start, stop : int
+        Samples of the block, [start, stop).
+    read_start, read_stop : int
+        Samples to read, including context, [read_start, read_stop).
+    """
+    block_size = int(block_size)
+    context = int(context)
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        yield start, stop, max(start - context, 0), min(stop + context, n_samples)
+
+
+def circular_blocks(dataset, block_size, context):
+    """
+    Read a (n_time, ...) dataset in consecutive time blocks of `block_size`
+    samples, each one read with `context` samples before and after it. The
+    signal is taken as periodic (the context of the first block is the end of
+    the signal, and the context of the last block its beginning), as in the
+    FFT of the whole signal. All the blocks read have the same length.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or ndarray
+        Dataset of shape (n_time, ...), with n_time >= block_size + 2 *
+        context.
+    block_size : int
+        Number of samples per block (the last block may be shorter).
+    context : int
+        Number of extra samples read before and after each block.
+
+    Yields
+    ------
+    start, stop : int
+        Samples of the block, [start, stop).
+    X : ndarray (block_size + 2 * context, ...)
+        Samples start - context to start + block_size + context (modulo
+        n_time). The block is X[context:context + stop - start].
+    """
+    n_time = dataset.shape[0]
+    block_size = int(block_size)
+    context = int(context)
+    n_read = block_size + 2 * context
+    if n_read > n_time:
+        raise ValueError('Blocks of {} samples with context are longer than '
+                         'the signal ({} samples).'.format(n_read, n_time))
+    for start in range(0, n_time, block_size):
+        stop = min(start + block_size, n_time)
+        yield start, stop, circular_window(dataset, start - context,
+                                           start - context + n_read)
+
+
+def circular_window(dataset, start, stop):
+    """
+    Read samples `start` to `stop` of a (n_time, ...) dataset taken as
+    periodic: negative samples are read from the end of the signal, and
+    samples from n_time on from its beginning.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or ndarray
+        Dataset of shape (n_time, ...).
+    start, stop : int
+        Samples to read, [start, stop), with -n_time <= start <= stop <=
+        start + n_time and stop <= 2 * n_time.
+
+    Returns
+    -------
+    X : ndarray (stop - start, ...)
+    """
+    n_time = dataset.shape[0]
+    parts = []
+    if start < 0:
+        parts.append(dataset[n_time + start:n_time])
+    parts.append(dataset[max(start, 0):min(stop, n_time)])
+    if stop > n_time:
+        parts.append(dataset[0:stop - n_time])
+    return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+
+def channel_bounds(dataset, n_channels):
+    """
+    Split the channels (second axis) of a (n_time, n_channels) dataset in
+    consecutive blocks of about `n_channels` channels, aligned to the HDF5
+    chunks of the dataset, so that each chunk is decompressed by one block
+    only.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or ndarray
+        Dataset of shape (n_time, n_channels).
+    n_channels : int
+        Target number of channels per block. It is rounded down to a multiple
+        of the chunk width (but not below one chunk).
+
+    Returns
+    -------
+    bounds : list of tuples
+        Channels (c0, c1) of each block, [c0, c1).
+    """
+    total = dataset.shape[1]
+    chunks = getattr(dataset, 'chunks', None)
+    width = max(int(n_channels), 1)
+    if chunks is not None:
+        width = max(width // chunks[1], 1) * chunks[1]
+    return [(c0, min(c0 + width, total)) for c0 in range(0, total, width)]
+
+
+def channel_blocks(dataset, max_bytes=2**28, dtype='float64'):
+    """
+    Read a (n_time, n_channels) dataset in slabs of all time samples and
+    consecutive channels, aligned to the HDF5 chunks of the dataset.
+
+    Reading whole slabs decompresses each chunk once per pass, instead of once
+    per channel as with column by column reads (`dataset[:, ch]`).
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or ndarray
+        Dataset of shape (n_time, n_channels).
+    max_bytes : int
+        Approximate memory limit of each slab, once converted to `dtype`.
+    dtype : numpy dtype
+        Data type used for the processing of the slabs.
+
+    Yields
+    ------
+    c0, c1 : int
+        Channels of the slab, [c0, c1).
+    X : ndarray
+        Slab of shape (n_time, c1 - c0).
+    """
+    n_time = dataset.shape[0]
+    n_channels = max_bytes // max(n_time * np.dtype(dtype).itemsize, 1)
+    for c0, c1 in channel_bounds(dataset, n_channels):
+        yield c0, c1, dataset[:, c0:c1]
+
+
+def with_chunk_cache(dataset, n_time=None, max_bytes=2**29):
+    """
+    Re-open a chunked h5py dataset with a chunk cache large enough to hold
+    `n_time` samples of all channels, so that overlapping time blocks (e.g.
+    with context for filtering) do not decompress the same chunks twice.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        Chunked dataset of shape (n_time, ...).
+    n_time : int or None
+        Number of time samples that should fit in the cache. If None, one row
+        of chunks (along time) is cached.
+    max_bytes : int
+        Upper limit of the cache size.
+
+    Returns
+    -------
+    dataset : h5py.Dataset
+        The same dataset, with the new chunk cache. Datasets that are not
+        chunked HDF5 datasets are returned unchanged.
+    """
+    if not isinstance(dataset, h5py.Dataset) or dataset.chunks is None:
+        return dataset
+    chunks = dataset.chunks
+    chunk_bytes = np.prod(chunks) * dataset.dtype.itemsize
+    n_rows = 1 if n_time is None else int(np.ceil(n_time / chunks[0])) + 1
+    n_cols = int(np.prod([np.ceil(s / c) for s, c in
+                          zip(dataset.shape[1:], chunks[1:])]))
+    nbytes = int(min(max(n_rows * n_cols * chunk_bytes, 2**20), max_bytes))
+    # the number of slots should be a prime ~100 times the number of chunks
+    nslots = _next_prime(100 * max(nbytes // chunk_bytes, 1))
+
+    dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    dapl.set_chunk_cache(nslots, nbytes, 1.)
+    dsid = h5py.h5d.open(dataset.file.id, dataset.name.encode(), dapl)
+    return h5py.Dataset(dsid)
+
+
+def _next_prime(n):
+    n = int(n) | 1
+    while any(n % d == 0 for d in range(3, int(n ** .5) + 1, 2)):
+        n += 2
+    return n
+
+
+class BlockIterator(AbstractDataChunkIterator):
+    """
+    Data chunk iterator that writes consecutive blocks along one axis of a
+    dataset, e.g. time blocks of a (n_time, n_channels) ElectricalSeries.
+
+    Parameters
+    ----------
+    blocks : iterable of ndarray
+        Blocks of data, in order. Each block has the full dataset shape,
+        except along `axis`.
+    maxshape : tuple
+        Final shape of the dataset.
+    dtype : numpy dtype
+        Data type of the dataset.
+    axis : int
+        Axis along which the blocks are concatenated (default=0).
+    chunk_shape : tuple or None
+        HDF5 chunk shape to recommend for the dataset.
+    """
+
+    def __init__(self, blocks, maxshape, dtype, axis=0, chunk_shape=None):
+        self._blocks = iter(blocks)
+        self._maxshape = tuple(maxshape)
+        self._dtype = np.dtype(dtype)
+        self._axis = axis
+        self._chunk_shape = chunk_shape
+        self._position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = next(self._blocks)
+        n = data.shape[self._axis]
+        selection = [slice(0, s) for s in data.shape]
+        selection[self._axis] = slice(self._position, self._position + n)
+        self._position += n
+        return DataChunk(data=data, selection=tuple(selection))
+
+    next = __next__
+
+    def recommended_chunk_shape(self):
+        return self._chunk_shape
+
+    def recommended_data_shape(self):
+        return self._maxshape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def maxshape(self):
+        return self._maxshape
+
+
+class BlockReader(object):
+    """
+    (n_time, ...) signal computed in consecutive time blocks, read as a
+    dataset (e.g. by `circular_blocks`) while it is computed. Reads go
+    forward: the blocks are computed as they are needed, and the samples
+    before the start of the last read are released. The first `head`
+    samples are kept, and the last ones can be computed beforehand (`tail`),
+    for the context of the first and last blocks of `circular_blocks`.
+
+    The computed blocks are also yielded by `blocks`, e.g. to write them
+    while the signal is read.
+
+    Parameters
+    ----------
+    blocks : iterable of ndarray
+        Consecutive time blocks of the signal, of shape (n_block, ...).
+    shape : tuple
+        Shape of the whole signal.
+    dtype : numpy dtype
+        Data type of the signal.
+    head : int
+        Number of samples kept from the beginning of the signal.
+    tail : ndarray or None
+        Last samples of the signal.
+    """
+
+    def __init__(self, blocks, shape, dtype, head=0, tail=None):
+        self._blocks = iter(blocks)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._n_head = int(head)
+        self._head = np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+        self._tail = tail
+        self._buffer = self._head
+        self._start = 0     # first sample of the buffer
+        self._pending = []  # blocks not yielded by `blocks` yet
+        self._done = False
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError('Only slices of the time axis can be read.')
+        start, stop, _ = index.indices(self.shape[0])
+        n_tail = 0 if self._tail is None else len(self._tail)
+        if start >= self.shape[0] - n_tail:
+            offset = self.shape[0] - n_tail
+            return self._tail[start - offset:stop - offset]
+        if stop <= len(self._head) and (len(self._head) == self._n_head
+                                        or self._done):
+            return self._head[start:stop]
+        if start < self._start:
+            raise ValueError('Samples {} to {} were released.'.format(
+                start, self._start))
+        while self._start + len(self._buffer) < stop and self._pull():
+            pass
+        self._buffer = self._buffer[start - self._start:]
+        self._start = start
+        return self._buffer[:stop - start]
+
+    def blocks(self):
+        """Yield the blocks computed since the previous block yielded (the
+        next block if there are none)."""
+        while self._pending or self._pull():
+            pending, self._pending = self._pending, []
+            yield np.concatenate(pending) if len(pending) > 1 else pending[0]
+
+    def _pull(self):
+        """Compute the next block, False at the end of the signal."""
+        try:
+            X = next(self._blocks)
+        except StopIteration:
+            self._done = True
+            return False
+        self._pending.append(X)
+        if len(self._head) < self._n_head:
+            self._head = np.concatenate(
+                [self._head, X[:self._n_head - len(self._head)]])
+        self._buffer = np.concatenate([self._buffer, X])
+        return True
@@ -0,0 +1,65 @@
+"""
+Synthetic NWB files of the tests.
+"""
+import numpy as np
+from datetime import datetime
+from dateutil.tz import tzlocal
+from pynwb import NWBHDF5IO, NWBFile
+from pynwb.ecephys import LFP, ElectricalSeries
+
+
+def new_nwb(n_channels):
+    """NWBFile with n_channels electrodes, and the region of all of them."""
+    nwbfile = NWBFile(session_description='synthetic', identifier='synthetic',
+                      session_start_time=datetime.now(tzlocal()))
+    device = nwbfile.create_device(name='device')
+    group = nwbfile.create_electrode_group(name='grid', description='',
+                                           location='grid', device=device)
+    nwbfile.add_electrode_column(name='bad', description='bad channel')
+    for i in range(n_channels):
+        nwbfile.add_electrode(x=1., y=2., z=3., imp=np.nan, location='grid',
+                              filtering='none', group=group, bad=False)
+    electrodes = nwbfile.create_electrode_table_region(
+        list(range(n_channels)), 'all')
+    return nwbfile, electrodes
+
+
+def write_raw_nwb(path, data, rate):
+    """Writes a nwb file with data (n_time, n_channels) as raw signals."""
+    nwbfile, electrodes = new_nwb(data.shape[1])
+    nwbfile.add_acquisition(ElectricalSeries(name='raw', data=data,
+                                             electrodes=electrodes, rate=rate))
+    with NWBHDF5IO(path, 'w') as io:
+        io.write(nwbfile)
+
+
+def make_block(path, n_channels=4, duration=5., rate=1000., seed=0):
+    """Writes a block nwb file with random raw signals."""
+    rng = np.random.RandomState(seed)
+    write_raw_nwb(path, 1e-4 * rng.randn(int(duration * rate), n_channels),
+                  rate)
+
+
+def make_raw_nwb(path, n_channels=4, duration=30., rate=3051.7578125, seed=0):
+    """Writes a nwb file with synthetic raw signals: 1/f noise plus 60 Hz
+    line noise and a slow oscillation."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(duration * rate)) / rate
+    noise = np.fft.rfft(rng.randn(len(t), n_channels), axis=0)
+    noise /= np.maximum(np.fft.rfftfreq(len(t), 1. / rate), 1.)[:, np.newaxis]
+    data = 1e-4 * np.fft.irfft(noise, n=len(t), axis=0)
+    data += 1e-5 * np.sin(2 * np.pi * 60. * t)[:, np.newaxis]
+    data += 2e-5 * np.sin(2 * np.pi * 7. * t[:, np.newaxis] +
+                          rng.rand(n_channels))
+    write_raw_nwb(path, data, rate)
+
+
+def make_lfp_nwb(path, X, rate):
+    """Writes a nwb file with X (n_time, n_channels) as its LFP."""
+    nwbfile, electrodes = new_nwb(X.shape[1])
+    ecephys = nwbfile.create_processing_module(name='ecephys',
+                                               description='')
+    ecephys.add(LFP(electrical_series=ElectricalSeries(
+        name='preprocessed', data=X, electrodes=electrodes, rate=rate)))
+    with NWBHDF5IO(path, 'w') as io:
+        io.write(nwbfile)
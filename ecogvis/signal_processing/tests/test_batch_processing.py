@@ -0,0 +1,127 @@
+from ecogvis.signal_processing import batch_processing, fft_backends
+from ecogvis.signal_processing.batch_processing import Job, run_batch, \
+    format_report, is_done, _memory_size, _run_job
+from unittest import mock
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import signal
+import os
+
+from synthetic_nwb import make_block
+
+
+class BatchProcessingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for block in [1, 2]:
+            make_block(os.path.join(self.path, 'EC1_B{}.nwb'.format(block)),
+                       seed=block)
+        self.configs = {'preprocess': {'referencing': ('CAR', 2),
+                                       'Notch': 60,
+                                       'Downsample': 400.}}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_run_batch(self):
+        results = run_batch(self.path, 'EC1', configs=self.configs,
+                            n_workers=2)
+        assert [r['block'] for r in results] == ['1', '2']
+        for result in results:
+            assert result['status'] == 'done', result['error']
+            assert sorted(result['stages']) == ['high_gamma', 'preprocess']
+            block_path = os.path.join(self.path, 'EC1_B{}.nwb'.format(result['block']))
+            assert is_done(block_path, 'preprocess_high_gamma',
+                           self.configs['preprocess'])
+        assert 'high_gamma' in format_report(results)
+
+        # already done
+        results = run_batch(self.path, 'EC1', blocks=['2'], configs=self.configs)
+        assert results[0]['status'] == 'skipped'
+
+        # changed configuration
+        self.configs['preprocess']['Notch'] = 50
+        results = run_batch(self.path, 'EC1', blocks=['2'], configs=self.configs)
+        assert results[0]['status'] == 'done', results[0]['error']
+        assert sorted(results[0]['stages']) == ['high_gamma', 'preprocess']
+
+    def test_max_memory(self):
+        results = run_batch(self.path, 'EC1', blocks=['1'],
+                            configs=self.configs, max_memory=8.)
+        assert results[0]['status'] == 'done', results[0]['error']
+
+        # the planned configuration is up to date, whatever the memory limit
+        for max_memory in [8., 4.]:
+            results = run_batch(self.path, 'EC1', blocks=['1'],
+                                configs=self.configs, max_memory=max_memory)
+            assert results[0]['status'] == 'skipped'
+
+    def test_retries(self):
+        # block 3 does not exist
+        results = run_batch(self.path, 'EC1', blocks=['1', '3'],
+                            modes=['preprocess'], configs=self.configs,
+                            n_workers=2, retries=2)
+        assert results[0]['status'] == 'done'
+        assert results[1]['status'] == 'failed'
+        assert results[1]['attempts'] == 3
+        assert 'Block 3 failed' in format_report(results)
+
+    @unittest.skipIf(os.name != 'posix', 'SIGKILL is Unix only')
+    def test_killed_worker(self):
+        # the worker of block 1 is killed (as by the OOM killer), which
+        # breaks the pool, and block 2 is not charged for it
+        with mock.patch.object(batch_processing, '_run_job', run_or_die):
+            results = run_batch(self.path, 'EC1', modes=['preprocess'],
+                                configs=self.configs, n_workers=2,
+                                retries=1)
+        assert results[0]['status'] == 'failed'
+        assert results[0]['attempts'] == 2
+        assert 'BrokenProcessPool' in results[0]['error']
+        assert results[1]['status'] == 'done', results[1]['error']
+        assert results[1]['attempts'] == 1
+
+    def test_high_gamma_bands(self):
+        # preprocess_high_gamma uses the High Gamma bands of the configs
+        bands = np.array([[80., 120.], [10., 15.]])
+        configs = dict(self.configs, preprocess_high_gamma=self.configs[
+            'preprocess'], high_gamma=bands)
+        results = run_batch(self.path, 'EC1', blocks=['1'],
+                            modes=['preprocess_high_gamma'], configs=configs)
+        assert results[0]['status'] == 'done', results[0]['error']
+        block_path = os.path.join(self.path, 'EC1_B1.nwb')
+        assert is_done(block_path, 'preprocess_high_gamma',
+                       self.configs['preprocess'], configs)
+        assert not is_done(block_path, 'preprocess_high_gamma',
+                           self.configs['preprocess'])
+        results = run_batch(self.path, 'EC1', blocks=['1'],
+                            modes=['preprocess_high_gamma'], configs=configs)
+        assert results[0]['status'] == 'skipped'
+
+    def test_fft_backend(self):
+        # the jobs keep the backend of the parent, with their FFT threads
+        job = Job(self.path, 'EC1', '1', ('preprocess',), self.configs, True,
+                  None, 2, {'name': 'numpy', 'workers': 1})
+        try:
+            result = _run_job(job)
+            assert result['status'] == 'done', result['error']
+            info = fft_backends.backend_info()
+            assert info['name'] == 'numpy'
+            assert fft_backends.get_backend().workers == 2
+        finally:
+            fft_backends.set_backend('scipy')
+
+
+def run_or_die(job):
+    """Runs the job, or kills its worker for block 1."""
+    if job.block == '1':
+        os.kill(os.getpid(), signal.SIGKILL)
+    return _run_job(job)
+
+
+def test_memory_size():
+    assert _memory_size('16') == _memory_size('16G') == 16.
+    assert _memory_size('512M') == _memory_size('512mb') == 0.5
+    assert _memory_size('2T') == 2048.
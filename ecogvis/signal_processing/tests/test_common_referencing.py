@@ -1,5 +1,8 @@
 import numpy as np
-from ecogvis.signal_processing.common_referencing import subtract_CAR,subtract_common_median_reference
+import pandas as pd
+from ecogvis.signal_processing.common_referencing import subtract_CAR,subtract_common_median_reference, \
+    subtract_CAR_by_device, subtract_CMR, device_groups, _nanmedian, \
+    bipolar_pairs, bipolar_reference
 
 def test_subtract_CAR():
     X = np.array([[ 1.25779548e+00,  2.78352267e+00,  9.18397280e-03,
@@ -26,6 +29,89 @@ def test_subtract_CAR():
     
     np.testing.assert_almost_equal(Xsc,Xsc_expected)
 
+    # in place, in segments of samples
+    Xin = X.copy()
+    Xout = subtract_CAR(Xin, b_size=2, out=Xin, max_bytes=1)
+    assert Xout is Xin
+    np.testing.assert_array_equal(Xin, Xsc)
+
+
+def test_subtract_CAR_bad_channels():
+    rng = np.random.RandomState(0)
+    X = rng.randn(37, 1000)
+    X[5, 10] = np.nan
+    elec_info = pd.DataFrame({'bad': np.arange(37) % 7 == 3})
+
+    Xsc = subtract_CAR(X, b_size=16, elec_info=elec_info,
+                       exclude_bad_channels='exclude_bad_channels',
+                       max_bytes=37 * 8 * 100)
+
+    for c0, c1 in [(0, 16), (16, 32), (32, 37)]:
+        group = X[c0:c1][~elec_info.bad.values[c0:c1]]
+        expected = X[c0:c1] - np.nanmean(group, axis=0)
+        np.testing.assert_array_equal(Xsc[c0:c1], expected)
+
+
+def test_subtract_CMR():
+    rng = np.random.RandomState(0)
+    X = rng.randn(37, 1000)
+    X[rng.rand(37, 1000) < 0.1] = np.nan
+    elec_info = pd.DataFrame({'bad': np.arange(37) % 7 == 3})
+
+    for exclude in [None, 'exclude_bad_channels']:
+        Xsc = subtract_CMR(X, b_size=16, elec_info=elec_info,
+                           exclude_bad_channels=exclude,
+                           max_bytes=37 * 8 * 100)
+        for c0, c1 in [(0, 16), (16, 32), (32, 37)]:
+            group = X[c0:c1]
+            if exclude is not None:
+                group = group[~elec_info.bad.values[c0:c1]]
+            expected = X[c0:c1] - np.nanmedian(group, axis=0)
+            np.testing.assert_array_equal(Xsc[c0:c1], expected)
+
+    # in place
+    Xin = X.copy()
+    subtract_CMR(Xin, b_size=16, out=Xin)
+    np.testing.assert_array_equal(Xin, subtract_CMR(X, b_size=16))
+
+
+def test_nanmedian():
+    rng = np.random.RandomState(0)
+    for n in [15, 16]:
+        X = rng.randn(n, 200)
+        np.testing.assert_array_equal(_nanmedian(X), np.median(X, axis=0))
+        # a few columns with NaNs, one of them all NaN
+        X[rng.randint(n, size=5), [3, 50, 50, 120, 199]] = np.nan
+        X[:, 7] = np.nan
+        with np.errstate(invalid='ignore'):
+            expected = np.nanmedian(X, axis=0)
+        np.testing.assert_array_equal(_nanmedian(X), expected)
+
+
+def test_subtract_CAR_by_device():
+    rng = np.random.RandomState(0)
+    X = rng.randn(10, 500)
+    X[2, 7] = np.nan
+    elec_info = pd.DataFrame({'group_name': ['grid', 'strip', 'grid', 'null0',
+                                             'strip', 'grid', 'grid', 'null0',
+                                             'depth', 'strip']})
+    groups = device_groups(elec_info)
+    assert np.all(groups[[3, 7]] == -1)
+    assert len(np.unique(groups[groups >= 0])) == 3
+
+    for method, func in [('mean', np.nanmean), ('median', np.nanmedian)]:
+        Xsc = subtract_CAR_by_device(X, elec_info, method=method,
+                                     max_bytes=10 * 8 * 100)
+        for name in ['grid', 'strip', 'depth']:
+            idx = np.flatnonzero(elec_info.group_name == name)
+            np.testing.assert_allclose(Xsc[idx], X[idx] - func(X[idx], axis=0))
+        np.testing.assert_array_equal(Xsc[[3, 7]], X[[3, 7]])
+
+        # in place
+        Xin = X.copy()
+        subtract_CAR_by_device(Xin, elec_info, method=method, out=Xin)
+        np.testing.assert_array_equal(Xin, Xsc)
+
 
 def test_subtract_common_median_reference():
     X = np.array([[[-9.42410095e-01, -1.02009301e+00,  3.99282177e-01,
@@ -78,3 +164,16 @@ def test_subtract_common_median_reference():
     
     
     np.testing.assert_almost_equal(Xscmr,Xscmr_expected)
+
+
+def test_bipolar_reference():
+    X = np.random.RandomState(0).randn(12, 50)
+    anodes, cathodes = bipolar_pairs((4, 3))
+    expected = np.array([X[a] - X[c] for a, c in zip(anodes, cathodes)])
+    # whole output at once, and slabs of 3 channels of the cathodes
+    for max_bytes in [2**26, 3 * 50 * 8]:
+        XX = bipolar_reference(X, (anodes, cathodes), max_bytes=max_bytes)
+        np.testing.assert_array_equal(XX, expected)
+    out = np.empty((len(anodes), 50), dtype='float32')
+    bipolar_reference(X, (anodes, cathodes), out=out, max_bytes=1)
+    np.testing.assert_allclose(out, expected, rtol=1e-6, atol=1e-6)
@@ -0,0 +1,52 @@
+import numpy as np
+from ecogvis.signal_processing import fft_backends
+from ecogvis.signal_processing.hilbert_transform import hilbert_transform
+import unittest
+
+
+class FFTBackendsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.X = np.random.RandomState(0).randn(3, 64)
+
+    def tearDown(self):
+        fft_backends.set_backend('scipy')
+
+    def test_backends(self):
+        names = fft_backends.available_backends()
+        self.assertIn('scipy', names)
+        self.assertIn('numpy', names)
+        expected = np.fft.fft(self.X)
+        Xh_expected, _ = hilbert_transform(self.X, 20.)
+        for name in names:
+            backend = fft_backends.set_backend(name, workers=2)
+            self.assertEqual(fft_backends.get_backend(), backend)
+            self.assertEqual(fft_backends.backend_info()['name'], name)
+            np.testing.assert_allclose(fft_backends.fft(self.X), expected,
+                                       atol=1e-12)
+            np.testing.assert_allclose(
+                fft_backends.irfft(fft_backends.rfft(self.X, axis=0), n=3, axis=0),
+                self.X, atol=1e-12)
+            with backend.context():
+                Xh, _ = hilbert_transform(self.X, 20., use_rfft=True)
+            np.testing.assert_allclose(Xh, Xh_expected, atol=1e-12)
+
+    def test_set_backend(self):
+        backend = fft_backends.set_backend('scipy', workers=-1)
+        self.assertGreaterEqual(backend.workers, 1)
+        with self.assertRaises(ValueError):
+            fft_backends.set_backend('not_a_backend')
+
+    def test_register_backend(self):
+        class CountingBackend(fft_backends.FFTBackend):
+            name = 'counting'
+            calls = 0
+
+            def fft(self, x, n=None, axis=-1, workers=None):
+                CountingBackend.calls += 1
+                return np.fft.fft(x, n=n, axis=axis)
+
+        fft_backends.register_backend('counting', CountingBackend)
+        fft_backends.set_backend('counting')
+        hilbert_transform(self.X, 20.)
+        self.assertEqual(CountingBackend.calls, 1)
@@ -1,5 +1,8 @@
 import numpy as np
-from ecogvis.signal_processing.hilbert_transform import hilbert_transform
+from ecogvis.signal_processing.hilbert_transform import hilbert_transform, \
+    block_filter_bank, gaussian_filter_bank, hilbert_band_mean, \
+    hilbert_context, hilbert_filter_bank
+from ecogvis.signal_processing.streaming import circular_blocks
 from process_nwb.wavelet_transform import gaussian, hamming
 import unittest
 
@@ -158,3 +161,82 @@ class HilbertTestCase(unittest.TestCase):
 
         np.testing.assert_almost_equal(Xh[0],Xh_expected[0])
         np.testing.assert_almost_equal(Xh[1],Xh_expected[1])
+
+    def test_hilbert_filter_bank(self):
+        X = np.random.RandomState(0).randn(3, 50)
+        centers, sds = [2., 5., 8.], [1., 1.5, 2.]
+        filters = gaussian_filter_bank(50, self.rate, centers, sds)
+
+        expected = np.zeros((3, 3, 50))
+        for ch in range(3):
+            for ii, (center, sd) in enumerate(zip(centers, sds)):
+                kernel = gaussian(50, self.rate, center, sd)
+                Xh, _ = hilbert_transform(X[[ch]], self.rate, kernel)
+                expected[ii, ch] = abs(Xh)
+
+        Xa = hilbert_filter_bank(X, self.rate, filters)
+        np.testing.assert_allclose(Xa, expected, rtol=1e-6)
+        # small memory budget, one band and one channel per batch
+        Xa = hilbert_filter_bank(X, self.rate, filters, max_bytes=1)
+        np.testing.assert_allclose(Xa, expected, rtol=1e-6)
+
+    def test_hilbert_band_mean(self):
+        X = np.random.RandomState(0).randn(3, 50)
+        filters = gaussian_filter_bank(50, self.rate, [2., 5., 8.], [1., 1.5, 2.])
+
+        expected = hilbert_filter_bank(X, self.rate, filters).mean(axis=0)
+        Xm = hilbert_band_mean(X, self.rate, filters)
+        self.assertEqual(Xm.dtype, np.float32)
+        np.testing.assert_allclose(Xm, expected, rtol=1e-6)
+        Xm = hilbert_band_mean(X, self.rate, filters, max_bytes=1)
+        np.testing.assert_allclose(Xm, expected, rtol=1e-6)
+
+    def test_hilbert_rfft(self):
+        filters = [gaussian(50, self.rate, 5, 2),
+                   hamming(50, self.rate, 3, 6)]
+        Xh, _ = hilbert_transform(self.X, self.rate, filters)
+        Xh_r, X_fft_h = hilbert_transform(self.X, self.rate, filters, use_rfft=True)
+        self.assertEqual(X_fft_h.shape, (1, 26))
+        np.testing.assert_allclose(Xh_r, Xh, atol=1e-12)
+
+        Xh_r, _ = hilbert_transform(self.X, self.rate, filters, use_rfft=True,
+                                    dtype=np.complex64)
+        self.assertEqual(Xh_r.dtype, np.complex64)
+        np.testing.assert_allclose(Xh_r, Xh, atol=1e-6)
+
+        # odd number of samples, no filter
+        Xh, _ = hilbert_transform(self.X[:-1], self.rate)
+        Xh_r, _ = hilbert_transform(self.X[:-1], self.rate, use_rfft=True)
+        np.testing.assert_allclose(Xh_r, Xh, atol=1e-12)
+
+    def test_filter_bank_rfft(self):
+        X = np.random.RandomState(0).randn(3, 50)
+        filters = gaussian_filter_bank(50, self.rate, [2., 5., 8.], [1., 1.5, 2.])
+
+        expected = hilbert_filter_bank(X, self.rate, filters)
+        Xa = hilbert_filter_bank(X, self.rate, filters, use_rfft=True)
+        np.testing.assert_allclose(Xa, expected, rtol=1e-6)
+        Xa = hilbert_filter_bank(X, self.rate, filters, use_rfft=True,
+                                 dtype=np.complex64, max_bytes=1)
+        np.testing.assert_allclose(Xa, expected, atol=1e-5)
+        Xm = hilbert_band_mean(X, self.rate, filters, use_rfft=True,
+                               dtype=np.complex64)
+        np.testing.assert_allclose(Xm, expected.mean(axis=0), atol=1e-5)
+
+    def test_overlap_save(self):
+        rate, n_time = 400., 20000
+        centers, sds = [10., 40., 110.], [2., 4., 8.]
+        X = np.random.RandomState(0).randn(2, n_time)
+        expected = hilbert_filter_bank(
+            X, rate, gaussian_filter_bank(n_time, rate, centers, sds),
+            use_rfft=True)
+
+        context = hilbert_context(rate, sds)
+        filters = block_filter_bank(4096, n_time, rate, centers, sds)
+        Xa = np.zeros_like(expected)
+        for start, stop, Xb in circular_blocks(X.T, 4096 - 2 * context,
+                                               context):
+            Xab = hilbert_filter_bank(Xb.T, rate, filters, use_rfft=True)
+            Xa[..., start:stop] = Xab[..., context:context + stop - start]
+        np.testing.assert_allclose(Xa, expected, rtol=0,
+                                   atol=1e-6 * abs(expected).max())
@@ -0,0 +1,51 @@
+import numpy as np
+from process_nwb.wavelet_transform import gaussian
+from ecogvis.signal_processing.kernel_cache import KernelCache, \
+    gaussian_kernels, heaviside
+import unittest
+
+
+class KernelCacheTestCase(unittest.TestCase):
+
+    def test_gaussian_kernels(self):
+        cache = KernelCache()
+        filters = gaussian_kernels(100, 20., [2., 5.], [1., 1.5], cache=cache)
+        self.assertEqual(filters.shape, (2, 100))
+        self.assertFalse(filters.flags.writeable)
+        np.testing.assert_allclose(filters[1], gaussian(100, 20., 5., 1.5))
+
+        again = gaussian_kernels(100, 20., np.array([2., 5.]), [1., 1.5],
+                                 cache=cache)
+        self.assertIs(again, filters)
+        info = cache.cache_info()
+        self.assertEqual((info.hits, info.misses, info.size), (1, 1, 1))
+
+        gaussian_kernels(101, 20., [2., 5.], [1., 1.5], cache=cache)
+        self.assertEqual(cache.cache_info().misses, 2)
+
+        # float32 filters, cached separately
+        single = gaussian_kernels(100, 20., [2., 5.], [1., 1.5], cache=cache,
+                                  dtype='float32')
+        self.assertEqual(single.dtype, np.float32)
+        np.testing.assert_array_equal(single, filters.astype('float32'))
+        self.assertIs(gaussian_kernels(100, 20., [2., 5.], [1., 1.5],
+                                       cache=cache, dtype='float32'), single)
+
+    def test_heaviside(self):
+        h = heaviside(6, 6., cache=KernelCache())
+        np.testing.assert_array_equal(h, [1., 2., 2., 0., 0., 0.])
+
+    def test_eviction(self):
+        # room for two arrays of 100 float64
+        cache = KernelCache(max_bytes=1600)
+        for key in ['a', 'b', 'a', 'c', 'a', 'b']:
+            cache.get(key, lambda: np.zeros(100))
+        # 'c' evicted 'b' (least recently used), then 'b' evicted 'c'
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        self.assertEqual(cache.cache_info().size, 2)
+        # too large to be cached
+        cache.get('d', lambda: np.zeros(1000))
+        self.assertEqual(cache.cache_info().nbytes, 1600)
+
+        cache.clear()
+        self.assertEqual(cache.cache_info(), (0, 0, 0, 0, 1600))
@@ -0,0 +1,43 @@
+import numpy as np
+from process_nwb.linenoise_notch import apply_linenoise_notch as apply_notch_channel
+from ecogvis.signal_processing.kernel_cache import KernelCache
+from ecogvis.signal_processing.linenoise_notch import apply_linenoise_notch, notch_mask
+
+
+def test_apply_linenoise_notch():
+    rate = 400.
+    t = np.arange(4000) / rate
+    rng = np.random.RandomState(0)
+    X = rng.randn(len(t), 5) + np.sin(2 * np.pi * 60. * t)[:, np.newaxis]
+
+    Xp = apply_linenoise_notch(X, rate, workers=2)
+
+    # Same as filtering one channel at a time
+    for ch in range(X.shape[1]):
+        Xch = apply_notch_channel(X[:, [ch]], rate)
+        np.testing.assert_allclose(Xp[:, ch], Xch[:, 0], atol=1e-10)
+
+    # 60 Hz line noise is removed
+    freqs = np.fft.rfftfreq(len(t), 1. / rate)
+    line = np.isclose(freqs, 60.)
+    power = np.abs(np.fft.rfft(X, axis=0)[line]) ** 2
+    power_notch = np.abs(np.fft.rfft(Xp, axis=0)[line]) ** 2
+    assert np.all(power_notch < 1e-3 * power)
+
+
+def test_notch_mask():
+    cache = KernelCache()
+    mask = notch_mask(1000, 400., 60., None, cache=cache)
+    freqs = np.fft.rfftfreq(1000, 1. / 400.)
+    assert mask.shape == freqs.shape
+    assert np.all(mask[np.abs(freqs - 90.) < 29.] == 1.)
+    assert np.allclose(mask[np.isclose(freqs[:, None], [60., 120., 180.]).any(1)], 0.)
+    assert not mask.flags.writeable
+
+    # Masks are reused for signals of the same length
+    notch_mask(1000, 400., 60., None, cache=cache)
+    assert cache.cache_info().hits == 1
+
+    # Only the first harmonic
+    mask = notch_mask(1000, 400., 60., 1, cache=cache)
+    assert mask[np.isclose(freqs, 120.)] == 1.
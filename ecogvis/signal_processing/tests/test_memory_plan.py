@@ -0,0 +1,122 @@
+import numpy as np
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.memory_plan import estimate_memory, \
+    plan_memory, source_info
+from ecogvis.signal_processing.processing_data import preprocess_raw_data, \
+    high_gamma_estimation, spectral_decomposition
+import unittest
+import tempfile
+import tracemalloc
+import shutil
+import os
+
+from synthetic_nwb import make_block
+
+
+def traced_peak(func, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class MemoryPlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.block_path = os.path.join(self.path, 'EC1_B1.nwb')
+        make_block(self.block_path, n_channels=8, duration=60.,
+                   rate=3051.7578125)
+        self.config = {'referencing': ('CAR', 4), 'Notch': 60,
+                       'Downsample': 400.}
+        self.bands_vals = np.array([[80., 100., 120.], [10., 12., 14.]])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_source_info(self):
+        info = source_info(self.block_path, 'preprocess')
+        assert info.shape == (int(60 * 3051.7578125), 8)
+        assert info.dtype == np.float64
+        assert info.rate == 3051.7578125
+        with self.assertRaises(ValueError):
+            source_info(self.block_path, 'high_gamma')
+
+    def test_estimates(self):
+        info = source_info(self.block_path, 'preprocess')
+        for config in [dict(self.config, max_bytes=2**22),
+                       dict(self.config, block_size=10.)]:
+            estimate = estimate_memory(info, 'preprocess', config)
+            peak = traced_peak(preprocess_raw_data, self.block_path, config)
+            assert 0.7 * peak < estimate < 1.5 * peak, (config, estimate, peak)
+            os.remove(self.block_path)
+            make_block(self.block_path, n_channels=8, duration=60.,
+                       rate=3051.7578125)
+
+        preprocess_raw_data(self.block_path, self.config)
+        info = source_info(self.block_path, 'high_gamma')
+        estimate = estimate_memory(info, 'high_gamma', self.bands_vals, 2**20)
+        peak = traced_peak(high_gamma_estimation, self.block_path,
+                           self.bands_vals, max_bytes=2**20)
+        assert 0.7 * peak < estimate < 1.5 * peak, (estimate, peak)
+
+    def test_plan_memory(self):
+        info = source_info(self.block_path, 'preprocess')
+        whole = estimate_memory(info, 'preprocess', self.config)
+
+        # everything fits
+        plan = plan_memory(self.block_path, 'preprocess', self.config,
+                           max_memory=1., overhead=0)
+        assert plan.config.get('block_size') is None
+        assert plan.config['max_bytes'] == 2**28
+        assert plan.peak == whole <= plan.budget
+
+        # smaller slabs of channels
+        max_memory = 0.5 * whole / 2**30 / 0.8
+        plan = plan_memory(self.block_path, 'preprocess', self.config,
+                           max_memory=max_memory, overhead=0)
+        assert plan.config['max_bytes'] < 2**28
+        assert plan.peak <= plan.budget
+
+        # shorter time blocks
+        config = dict(self.config, block_size=30.)
+        streaming = estimate_memory(info, 'preprocess', config)
+        plan = plan_memory(self.block_path, 'preprocess', config,
+                           max_memory=0.9 * streaming / 2**30 / 0.8,
+                           overhead=0)
+        assert 1. <= plan.config['block_size'] < 30.
+        assert plan.peak <= plan.budget
+
+        with self.assertRaises(MemoryError):
+            plan_memory(self.block_path, 'preprocess', self.config,
+                        max_memory=1e-4, overhead=0)
+
+    def test_plan_time_blocks(self):
+        # the power of all bands of the whole recording does not fit, the
+        # decomposition is computed in time blocks
+        preprocess_raw_data(self.block_path, self.config)
+        bands_vals = np.array([chang_lab['cfs'], chang_lab['sds']])
+        info = source_info(self.block_path, 'decomposition')
+        whole = estimate_memory(info, 'decomposition',
+                                {'bands_vals': bands_vals,
+                                 'dtype': 'complex64'}, 2**20)
+        plan = plan_memory(self.block_path, 'decomposition', bands_vals,
+                           max_memory=0.5 * whole / 2**30 / 0.8, overhead=0)
+        assert plan.config['block_size'] is not None
+        assert plan.peak <= plan.budget
+        options = dict(plan.config)
+        options.pop('bands_vals')
+        peak = traced_peak(spectral_decomposition, self.block_path,
+                           bands_vals, max_bytes=plan.max_bytes, **options)
+        assert peak < whole
+        assert 0.7 * peak < plan.peak < 1.5 * peak, (plan, peak)
+
+        # complex64 analytic signals of the whole recording
+        full = estimate_memory(info, 'decomposition', bands_vals, 2**20)
+        plan = plan_memory(self.block_path, 'decomposition', bands_vals,
+                           max_memory=0.5 * (whole + full) / 2**30 / 0.8,
+                           overhead=0)
+        assert plan.config['block_size'] is None
+        assert plan.config['dtype'] == 'complex64'
@@ -0,0 +1,61 @@
+import numpy as np
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.hilbert_transform import gaussian_filter_bank, \
+    hilbert_filter_bank
+from ecogvis.signal_processing.multirate import band_levels, halve, \
+    multirate_filter_bank, upsample
+
+
+def test_band_levels():
+    levels = band_levels(400., chang_lab['cfs'], chang_lab['sds'])
+    np.testing.assert_array_equal(np.bincount(levels), [13, 9, 9, 9])
+    assert np.all(np.diff(levels) <= 0)
+    levels = band_levels(400., chang_lab['cfs'], chang_lab['sds'],
+                         max_level=1)
+    np.testing.assert_array_equal(np.bincount(levels), [13, 27])
+
+
+def test_halve_upsample():
+    # periodic signals, below the passband of the halvings
+    n_time = 1000
+    t = np.arange(n_time) / n_time
+    X = np.array([np.cos(2 * np.pi * 50 * t), np.sin(2 * np.pi * 130 * t)])
+    Xh = halve(X)
+    assert Xh.shape == (2, 500)
+    np.testing.assert_allclose(Xh, X[:, ::2], atol=1e-4)
+    np.testing.assert_allclose(upsample(Xh, 2), X, atol=1e-4)
+    Z = np.exp(2j * np.pi * 30 * t[::4]).astype('complex64')
+    Zu = upsample(Z, 4, n_time - 3)
+    assert Zu.dtype == np.complex64
+    np.testing.assert_allclose(Zu, np.exp(2j * np.pi * 30 * t[:-3]),
+                               atol=1e-4)
+    # odd lengths
+    assert halve(X[:, :999]).shape == (2, 500)
+
+
+def test_multirate_filter_bank():
+    rate, n_time = 400., 8000
+    centers, sds = chang_lab['cfs'][::4], chang_lab['sds'][::4]
+    X = np.random.RandomState(0).randn(3, n_time)
+    filters = gaussian_filter_bank(n_time, rate, centers, sds)
+    expected = hilbert_filter_bank(X, rate, filters, use_rfft=True)
+    Zexpected = hilbert_filter_bank(X, rate, filters, use_rfft=True,
+                                    analytic=True)
+    np.testing.assert_allclose(abs(Zexpected), expected, rtol=1e-6)
+
+    levels = band_levels(rate, centers, sds)
+    seen = []
+    for level, bands, Xa in multirate_filter_bank(X, rate, centers, sds):
+        np.testing.assert_array_equal(levels[bands], level)
+        assert Xa.shape == (len(bands), 3, n_time // 2**level)
+        ref = expected[bands][..., ::2**level]
+        np.testing.assert_allclose(Xa, ref, rtol=0,
+                                   atol=2e-4 * abs(ref).max())
+        seen.extend(bands)
+    np.testing.assert_array_equal(np.sort(seen), np.arange(len(centers)))
+
+    for level, bands, Za in multirate_filter_bank(X, rate, centers, sds,
+                                                  analytic=True):
+        Xa = abs(upsample(Za, 2**level, n_time))
+        np.testing.assert_allclose(Xa, expected[bands], rtol=0,
+                                   atol=2e-4 * abs(expected[bands]).max())
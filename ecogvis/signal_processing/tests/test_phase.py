@@ -0,0 +1,71 @@
+import numpy as np
+import os
+import pytest
+from ecogvis.signal_processing.hilbert_transform import gaussian_filter_bank, \
+    hilbert_filter_bank
+from ecogvis.signal_processing.phase import LazyPhase, phase_conversion, \
+    quantize_phase
+
+from synthetic_nwb import make_lfp_nwb
+
+
+def test_quantize_phase():
+    phase = np.linspace(-np.pi, np.pi, 1001)
+    Xa = 3. * np.exp(1j * phase)
+    Xq = quantize_phase(Xa)
+    assert Xq.dtype == np.int16
+    assert Xq[0] == -32767 and Xq[-1] == 32767
+    np.testing.assert_allclose(Xq * phase_conversion, phase, rtol=0,
+                               atol=.501 * phase_conversion)
+    Xq = quantize_phase(Xa.astype('complex64'))
+    assert Xq.dtype == np.int16
+    np.testing.assert_allclose(Xq * phase_conversion, phase, rtol=0,
+                               atol=.501 * phase_conversion)
+    np.testing.assert_array_equal(quantize_phase(np.array([0, 1, -1])),
+                                  [0, 0, 32767])
+
+
+def test_lazy_phase():
+    file_name = 'test_lazy_phase.nwb'
+    rate, n_time = 400., 8000
+    bands_vals = np.array([[10., 40., 110.], [2., 4., 8.]])
+    X = 1e-4 * np.random.RandomState(0).randn(n_time, 4)
+    Xch = (X.T * 1e6).astype('float32')
+    filters = gaussian_filter_bank(n_time, rate, bands_vals[0], bands_vals[1])
+    expected = hilbert_filter_bank(Xch, rate, filters, use_rfft=True,
+                                   analytic=True).T
+    scale = abs(expected).max(axis=(0, 1))
+    try:
+        make_lfp_nwb(file_name, X, rate)
+        with pytest.raises(ValueError):
+            LazyPhase(file_name)
+
+        # time blocks of 2 s, with context
+        phase = LazyPhase(file_name, bands_vals, block_size=2.)
+        assert phase.shape == (n_time, 4, 3)
+        Za = phase.window(500, 7500, analytic=True)
+        np.testing.assert_allclose(Za, expected[500:7500], rtol=0,
+                                   atol=1e-5 * scale.min())
+        X1 = phase[500:7500, [1, 3], 2]
+        assert X1.shape == (7000, 2) and X1.dtype == np.float32
+        diff = abs(abs(expected[500:7500, [1, 3], 2]) *
+                   (np.exp(1j * X1) - np.exp(1j * np.angle(
+                       expected[500:7500, [1, 3], 2]))))
+        assert diff.max() < 1e-5 * scale[2]
+
+        # the FFTs of the blocks are computed once
+        misses = phase.cache_info().misses
+        phase[1000:2000, 0]
+        assert phase.cache_info().misses == misses
+        assert phase[10].shape == (4, 3)
+        np.testing.assert_array_equal(phase[::1000, 0, 0],
+                                      phase[:, 0, 0][::1000])
+        with pytest.raises(IndexError):
+            phase.window(0, n_time + 1)
+
+        # whole recording
+        phase = LazyPhase(file_name, bands_vals, block_size=100.)
+        np.testing.assert_allclose(phase.window(0, n_time, analytic=True),
+                                   expected, rtol=0, atol=1e-5 * scale.min())
+    finally:
+        os.remove(file_name)
@@ -1,9 +1,38 @@
 import numpy as np
-from pynwb import NWBHDF5IO
-from ecogvis.signal_processing.processing_data import high_gamma_estimation, spectral_decomposition, preprocess_raw_data, make_new_nwb
+from datetime import datetime
+from dateutil.tz import tzlocal
+from pynwb import NWBHDF5IO, NWBFile
+from pynwb.ecephys import ElectricalSeries
+from ecogvis.signal_processing.processing_data import high_gamma_estimation, spectral_decomposition, preprocess_raw_data, make_new_nwb, \
+    preprocess_high_gamma, get_bipolar_referenced_electrodes
+from ecogvis.signal_processing import processing_data
+from ecogvis.signal_processing.phase import LazyPhase
+from ecogvis.signal_processing.provenance import stage_status
+from scipy.signal import resample_poly
 import unittest
+from unittest import mock
 import os
 
+from synthetic_nwb import make_raw_nwb
+
+
+def read_lfp(path):
+    with NWBHDF5IO(path, 'r') as io:
+        nwbfile = io.read()
+        lfp = nwbfile.processing['ecephys'].data_interfaces['LFP'].electrical_series['preprocessed']
+        return lfp.data[:], lfp.rate
+
+
+def failing(function, n_blocks):
+    """Generator function `function`, which raises MemoryError after
+    n_blocks blocks (as a stage running out of memory)."""
+    def wrapper(*args, **kwargs):
+        for ii, X in enumerate(function(*args, **kwargs)):
+            if ii == n_blocks:
+                raise MemoryError()
+            yield X
+    return wrapper
+
 
 class ProcessingDataTestCase(unittest.TestCase):
 
@@ -171,4 +200,558 @@ class ProcessingDataTestCase(unittest.TestCase):
             nwbfile_correct = io.read()
             high_gamma_data_expected = nwbfile_correct.processing['ecephys'].data_interfaces['high_gamma'].data[:]
 
-        np.testing.assert_almost_equal(high_gamma_data, high_gamma_data_expected)
+        # high gamma is averaged in float32
+        np.testing.assert_allclose(high_gamma_data, high_gamma_data_expected,
+                                   rtol=1e-6)
+
+
+class StreamingPreprocessingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.whole_name = 'ecephys_synthetic_whole.nwb'
+        self.blocks_name = 'ecephys_synthetic_blocks.nwb'
+        make_raw_nwb(self.whole_name)
+        make_raw_nwb(self.blocks_name)
+
+    def tearDown(self):
+        for name in [self.whole_name, self.blocks_name]:
+            try:
+                os.remove(name)
+            except FileNotFoundError as e:
+                pass
+
+    def test_streaming_block_sizes(self):
+        config = {
+            'referencing': ('CAR', 2),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        preprocess_raw_data(self.whole_name, dict(config, block_size=60.))
+        preprocess_raw_data(self.blocks_name, dict(config, block_size=6.))
+
+        lfp_whole, rate_whole = read_lfp(self.whole_name)
+        lfp_blocks, rate_blocks = read_lfp(self.blocks_name)
+
+        assert rate_whole == rate_blocks == 400.
+        assert lfp_whole.shape == lfp_blocks.shape == (12000, 4)
+        assert lfp_blocks.dtype == np.float32
+        # Differences come only from the edges of the blocks
+        np.testing.assert_allclose(lfp_blocks, lfp_whole,
+                                   atol=5e-3 * np.std(lfp_whole))
+
+    def test_inexact_rate(self):
+        os.remove(self.blocks_name)
+        make_raw_nwb(self.blocks_name, duration=5., rate=1017.2526)
+        config = {'referencing': ('CAR', 2), 'Notch': 60,
+                  'Downsample': 400., 'block_size': 2.}
+        with self.assertRaises(ValueError):
+            preprocess_raw_data(self.blocks_name, config)
+
+    def test_common_median_reference(self):
+        config = {
+            'referencing': ('CMR', 4),
+            'Notch': None,
+            'Downsample': 400.
+        }
+        preprocess_raw_data(self.whole_name, dict(config, block_size=60.))
+        preprocess_raw_data(self.blocks_name, dict(config, block_size=6.))
+
+        lfp_whole, _ = read_lfp(self.whole_name)
+        lfp_blocks, _ = read_lfp(self.blocks_name)
+        # the median of the referenced channels is zero
+        np.testing.assert_allclose(np.median(lfp_whole, axis=1), 0,
+                                   atol=1e-6 * np.std(lfp_whole))
+        np.testing.assert_allclose(lfp_blocks, lfp_whole,
+                                   atol=5e-3 * np.std(lfp_whole))
+
+    def test_polyphase_resampling(self):
+        config = {
+            'referencing': ('CAR', 2),
+            'Notch': 60,
+            'Downsample': 400.,
+            'resample': 'poly'
+        }
+        preprocess_raw_data(self.whole_name, config)
+        preprocess_raw_data(self.blocks_name, dict(config, block_size=6.))
+
+        lfp_whole, rate = read_lfp(self.whole_name)
+        lfp_blocks, _ = read_lfp(self.blocks_name)
+        assert rate == 400.
+        assert lfp_whole.shape == lfp_blocks.shape == (12000, 4)
+        np.testing.assert_allclose(lfp_blocks, lfp_whole,
+                                   atol=5e-3 * np.std(lfp_whole))
+
+    def test_float32_precision(self):
+        config = {
+            'referencing': ('CMR', 2),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        for extra in [{}, {'block_size': 6., 'resample': 'poly'}]:
+            for name, precision in [(self.whole_name, 'float64'),
+                                    (self.blocks_name, 'float32')]:
+                if os.path.exists(name):
+                    os.remove(name)
+                make_raw_nwb(name)
+                preprocess_raw_data(name, dict(config, precision=precision,
+                                               **extra))
+            lfp64, _ = read_lfp(self.whole_name)
+            lfp32, _ = read_lfp(self.blocks_name)
+            np.testing.assert_allclose(lfp32, lfp64,
+                                       atol=1e-5 * np.std(lfp64))
+
+        # power in the precision of the analytic signals
+        bands_vals = np.array([[75., 90.], [7., 8.]])
+        power = []
+        for name, dtype in [(self.whole_name, 'complex128'),
+                            (self.blocks_name, 'complex64')]:
+            spectral_decomposition(name, bands_vals, dtype=dtype)
+            with NWBHDF5IO(name, 'r') as io:
+                ecephys = io.read().processing['ecephys']
+                power.append(ecephys.data_interfaces['DecompositionSeries'].data[:])
+        assert power[0].dtype == np.float64
+        assert power[1].dtype == np.float32
+        # (the LFPs differ too)
+        np.testing.assert_allclose(power[1], power[0],
+                                   atol=1e-4 * np.std(power[0]))
+
+    def test_parallel_resampling(self):
+        config = {
+            'referencing': ('CAR', 2),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        preprocess_raw_data(self.whole_name, config)
+        preprocess_raw_data(self.blocks_name, dict(config, n_jobs=2))
+
+        lfp_serial, _ = read_lfp(self.whole_name)
+        lfp_parallel, _ = read_lfp(self.blocks_name)
+        np.testing.assert_array_equal(lfp_parallel, lfp_serial)
+
+
+class FusedPipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.two_step_name = 'ecephys_synthetic_two_step.nwb'
+        self.fused_name = 'ecephys_synthetic_fused.nwb'
+        make_raw_nwb(self.two_step_name, n_channels=6, duration=10.)
+        make_raw_nwb(self.fused_name, n_channels=6, duration=10.)
+
+    def tearDown(self):
+        for name in [self.two_step_name, self.fused_name]:
+            try:
+                os.remove(name)
+            except FileNotFoundError as e:
+                pass
+
+    def test_fused_high_gamma(self):
+        config = {
+            'referencing': ('CAR', 3),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        bands_vals = np.array([[75., 90., 110.], [7., 8., 9.]])
+        preprocess_raw_data(self.two_step_name, config)
+        high_gamma_estimation(self.two_step_name, bands_vals)
+        preprocess_high_gamma(self.fused_name, config, bands_vals)
+
+        data = []
+        for name in [self.two_step_name, self.fused_name]:
+            with NWBHDF5IO(name, 'r') as io:
+                nwbfile = io.read()
+                ecephys = nwbfile.processing['ecephys'].data_interfaces
+                data.append((ecephys['LFP'].electrical_series['preprocessed'].data[:],
+                             ecephys['high_gamma'].data[:]))
+        np.testing.assert_array_equal(data[1][0], data[0][0])
+        assert data[1][1].shape == (4000, 6)
+        np.testing.assert_array_equal(data[1][1], data[0][1])
+
+    def test_fused_time_blocks(self):
+        # the High Gamma time blocks are computed from the LFP blocks while
+        # they are written
+        config = {
+            'referencing': ('CAR', 3),
+            'Notch': 60,
+            'Downsample': 400.,
+            'block_size': 2.
+        }
+        bands_vals = np.array([[75., 90., 110.], [7., 8., 9.]])
+        preprocess_raw_data(self.two_step_name, config)
+        high_gamma_estimation(self.two_step_name, bands_vals, block_size=2.)
+        preprocess_high_gamma(self.fused_name, config, bands_vals)
+
+        data = []
+        for name in [self.two_step_name, self.fused_name]:
+            with NWBHDF5IO(name, 'r') as io:
+                nwbfile = io.read()
+                ecephys = nwbfile.processing['ecephys'].data_interfaces
+                data.append((ecephys['LFP'].electrical_series['preprocessed'].data[:],
+                             ecephys['high_gamma'].data[:]))
+        np.testing.assert_array_equal(data[1][0], data[0][0])
+        assert data[1][1].shape == (4000, 6)
+        np.testing.assert_array_equal(data[1][1], data[0][1])
+        assert stage_status(self.fused_name, 'preprocess',
+                            config)[0] == 'current'
+        hg_config = {'bands_vals': bands_vals, 'dtype': 'complex128',
+                     'block_size': 2., 'block_context': None}
+        assert stage_status(self.fused_name, 'high_gamma',
+                            hg_config)[0] == 'current'
+
+    def test_time_blocks_decomposition(self):
+        config = {
+            'referencing': ('CAR', 3),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        bands_vals = np.array([[20., 75., 110.], [3., 7., 9.]])
+        for name in [self.two_step_name, self.fused_name]:
+            preprocess_raw_data(name, config)
+        spectral_decomposition(self.two_step_name, bands_vals)
+        high_gamma_estimation(self.two_step_name, bands_vals)
+        spectral_decomposition(self.fused_name, bands_vals, block_size=2.)
+        high_gamma_estimation(self.fused_name, bands_vals, block_size=2.,
+                              block_context=.5)
+
+        data = []
+        for name in [self.two_step_name, self.fused_name]:
+            with NWBHDF5IO(name, 'r') as io:
+                ecephys = io.read().processing['ecephys'].data_interfaces
+                data.append((ecephys['DecompositionSeries'].data[:],
+                             ecephys['high_gamma'].data[:]))
+        for expected, blocks in zip(data[0], data[1]):
+            assert blocks.shape == expected.shape
+            np.testing.assert_allclose(blocks, expected, rtol=0,
+                                       atol=1e-5 * abs(expected).max())
+
+    def test_multirate_decomposition(self):
+        config = {
+            'referencing': ('CAR', 3),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        bands_vals = np.array([[10., 40., 110.], [2., 4., 8.]])
+        for name in [self.two_step_name, self.fused_name]:
+            preprocess_raw_data(name, config)
+        spectral_decomposition(self.two_step_name, bands_vals)
+        spectral_decomposition(self.fused_name, bands_vals,
+                               multirate='native')
+        with NWBHDF5IO(self.two_step_name, 'r') as io:
+            ecephys = io.read().processing['ecephys'].data_interfaces
+            expected = ecephys['DecompositionSeries'].data[:]
+        with NWBHDF5IO(self.fused_name, 'r') as io:
+            ecephys = io.read().processing['ecephys'].data_interfaces
+            for name, rate, band in [('DecompositionSeries', 400., 2),
+                                     ('DecompositionSeries_200Hz', 200., 1),
+                                     ('DecompositionSeries_100Hz', 100., 0)]:
+                decs = ecephys[name]
+                assert decs.rate == rate
+                assert decs.bands['filter_param_0'][:] == [bands_vals[0, band]]
+                ref = expected[::int(400. / rate), :, band]
+                np.testing.assert_allclose(decs.data[:, :, 0], ref, rtol=0,
+                                           atol=2e-4 * abs(ref).max())
+
+        # 'common' replaces the native series (the configuration changed)
+        spectral_decomposition(self.fused_name, bands_vals,
+                               multirate='common')
+        with NWBHDF5IO(self.fused_name, 'r') as io:
+            ecephys = io.read().processing['ecephys'].data_interfaces
+            names = [name for name in ecephys
+                     if name.startswith('DecompositionSeries')]
+            assert names == ['DecompositionSeries']
+            common = ecephys['DecompositionSeries'].data[:]
+        assert common.shape == expected.shape
+        np.testing.assert_allclose(common, expected, rtol=0,
+                                   atol=2e-4 * abs(expected).max())
+
+        with self.assertRaises(ValueError):
+            spectral_decomposition(self.fused_name, bands_vals,
+                                   multirate='native', block_size=2.)
+
+    def test_output_rate(self):
+        config = {
+            'referencing': ('CAR', 3),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        bands_vals = np.array([[20., 75., 110.], [3., 7., 9.]])
+        preprocess_raw_data(self.two_step_name, config)
+        spectral_decomposition(self.two_step_name, bands_vals)
+        high_gamma_estimation(self.two_step_name, bands_vals)
+        with NWBHDF5IO(self.two_step_name, 'r') as io:
+            ecephys = io.read().processing['ecephys'].data_interfaces
+            full = (ecephys['DecompositionSeries'].data[:],
+                    ecephys['high_gamma'].data[:])
+        # anti-aliased decimation of the amplitude at the LFP rate
+        expected = [np.maximum(resample_poly(X, 1, 4, axis=0), 0)
+                    for X in full]
+
+        spectral_decomposition(self.two_step_name, bands_vals,
+                               output_rate=100.)
+        high_gamma_estimation(self.two_step_name, bands_vals, block_size=2.,
+                              output_rate=100.)
+        preprocess_high_gamma(self.fused_name, config, bands_vals=bands_vals,
+                              output_rate=100.)
+        for name in [self.two_step_name, self.fused_name]:
+            with NWBHDF5IO(name, 'r') as io:
+                ecephys = io.read().processing['ecephys'].data_interfaces
+                series = [ecephys['high_gamma']]
+                if name == self.two_step_name:
+                    series.append(ecephys['DecompositionSeries'])
+                for ts in series:
+                    assert ts.rate == 100.
+                    ref = expected[isinstance(ts, ElectricalSeries)]
+                    assert ts.data.shape == ref.shape
+                    # the edges are padded by reflection, not zeros
+                    np.testing.assert_allclose(ts.data[50:-50], ref[50:-50],
+                                               rtol=0,
+                                               atol=1e-5 * abs(ref).max())
+
+        with self.assertRaises(ValueError):
+            spectral_decomposition(self.fused_name, bands_vals,
+                                   output_rate=1000.)
+
+    def test_incremental_bands(self):
+        config = {
+            'referencing': ('CAR', 3),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        bands_vals = np.array([[20., 75., 110., 40.], [3., 7., 9., 4.]])
+        for name in [self.two_step_name, self.fused_name]:
+            preprocess_raw_data(name, config)
+        spectral_decomposition(self.two_step_name, bands_vals, block_size=2.)
+        spectral_decomposition(self.fused_name, bands_vals[:, :2],
+                               block_size=2.)
+        spectral_decomposition(self.fused_name, bands_vals[:, 1:],
+                               block_size=2., incremental=True)
+        # all the bands are there
+        spectral_decomposition(self.fused_name, bands_vals[:, ::-1],
+                               block_size=2., incremental=True)
+
+        data = []
+        for name in [self.two_step_name, self.fused_name]:
+            with NWBHDF5IO(name, 'r') as io:
+                decs = io.read().processing['ecephys'].data_interfaces[
+                    'DecompositionSeries']
+                np.testing.assert_array_equal(
+                    decs.bands.to_dataframe().to_numpy().T, bands_vals)
+                data.append(decs.data[:])
+        np.testing.assert_allclose(data[1], data[0],
+                                   atol=1e-6 * abs(data[0]).max())
+        status, _ = stage_status(self.fused_name, 'decomposition',
+                                 {'bands_vals': bands_vals,
+                                  'dtype': 'complex128', 'block_size': 2.,
+                                  'block_context': None})
+        assert status == 'current'
+
+        # contiguous data cannot be resized, all the bands are computed
+        spectral_decomposition(self.two_step_name, bands_vals[:, :1],
+                               storage={'chunk_duration': None})
+        spectral_decomposition(self.two_step_name, bands_vals[:, 3:],
+                               incremental=True)
+        with NWBHDF5IO(self.two_step_name, 'r') as io:
+            decs = io.read().processing['ecephys'].data_interfaces[
+                'DecompositionSeries']
+            np.testing.assert_array_equal(
+                decs.bands.to_dataframe().to_numpy().T, bands_vals[:, [0, 3]])
+            assert decs.data.shape == (4000, 6, 2)
+
+    def test_incremental_bands_failure(self):
+        config = {
+            'referencing': ('CAR', 3),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        bands_vals = np.array([[20., 75., 110.], [3., 7., 9.]])
+        preprocess_raw_data(self.fused_name, config)
+        spectral_decomposition(self.fused_name, bands_vals[:, :2],
+                               block_size=2.)
+        old_config = {'bands_vals': bands_vals[:, :2], 'dtype': 'complex128',
+                      'block_size': 2., 'block_context': None}
+
+        # the new band fails after its first time block
+        with mock.patch.object(processing_data, '_decomposition_blocks',
+                               failing(processing_data._decomposition_blocks,
+                                       1)):
+            with self.assertRaises(MemoryError):
+                spectral_decomposition(self.fused_name, bands_vals,
+                                       block_size=2., incremental=True)
+        with NWBHDF5IO(self.fused_name, 'r') as io:
+            decs = io.read().processing['ecephys'].data_interfaces[
+                'DecompositionSeries']
+            np.testing.assert_array_equal(
+                decs.bands.to_dataframe().to_numpy().T, bands_vals[:, :2])
+            assert decs.data.shape == (4000, 6, 2)
+        status, _ = stage_status(self.fused_name, 'decomposition', old_config)
+        assert status == 'current'
+
+        # the rerun adds the band
+        spectral_decomposition(self.fused_name, bands_vals, block_size=2.,
+                               incremental=True)
+        with NWBHDF5IO(self.fused_name, 'r') as io:
+            decs = io.read().processing['ecephys'].data_interfaces[
+                'DecompositionSeries']
+            assert decs.data.shape == (4000, 6, 3)
+            assert np.all(decs.data[-400:, :, 2] > 0)
+
+    def test_phase(self):
+        config = {
+            'referencing': ('CAR', 3),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        bands_vals = np.array([[20., 75., 110.], [3., 7., 9.]])
+        for name in [self.two_step_name, self.fused_name]:
+            preprocess_raw_data(name, config)
+        spectral_decomposition(self.two_step_name, bands_vals, phase=True)
+        spectral_decomposition(self.fused_name, bands_vals[:, :2], phase=True,
+                               block_size=2.)
+        spectral_decomposition(self.fused_name, bands_vals[:, 2:], phase=True,
+                               block_size=2., incremental=True)
+
+        # analytic signals computed from the LFP
+        Za = LazyPhase(self.two_step_name, block_size=100.).window(
+            0, 4000, analytic=True)
+        scale = abs(Za).max(axis=(0, 1))
+        for name in [self.two_step_name, self.fused_name]:
+            with NWBHDF5IO(name, 'r') as io:
+                ecephys = io.read().processing['ecephys'].data_interfaces
+                decs = ecephys['DecompositionSeries_phase']
+                assert decs.data.dtype == np.int16
+                assert decs.metric == 'phase'
+                np.testing.assert_array_equal(
+                    decs.bands.to_dataframe().to_numpy().T, bands_vals)
+                phase = decs.data[:] * decs.conversion
+                amplitude = ecephys['DecompositionSeries'].data[:]
+            # phase weighted by the amplitude, within the quantization step
+            diff = abs(amplitude * np.exp(1j * phase) - Za).max(axis=(0, 1))
+            assert np.all(diff < 1e-4 * scale)
+
+        # stale without phase
+        spectral_decomposition(self.fused_name, bands_vals, block_size=2.)
+        with NWBHDF5IO(self.fused_name, 'r') as io:
+            ecephys = io.read().processing['ecephys'].data_interfaces
+            assert 'DecompositionSeries_phase' not in ecephys
+        with self.assertRaises(ValueError):
+            spectral_decomposition(self.fused_name, bands_vals, phase=True,
+                                   output_rate=100.)
+
+
+    def test_phase_interrupted(self):
+        config = {
+            'referencing': ('CAR', 3),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        bands_vals = np.array([[20., 75.], [3., 7.]])
+        decomposition_config = {'bands_vals': bands_vals,
+                                'dtype': 'complex128', 'block_size': 2.,
+                                'block_context': None, 'phase': True}
+        preprocess_raw_data(self.fused_name, config)
+        # the series are filled after their second time block fails
+        with mock.patch.object(processing_data, '_decomposition_blocks',
+                               failing(processing_data._decomposition_blocks,
+                                       1)):
+            with self.assertRaises(MemoryError):
+                spectral_decomposition(self.fused_name, bands_vals,
+                                       phase=True, block_size=2.)
+        status, _ = stage_status(self.fused_name, 'decomposition',
+                                 decomposition_config)
+        assert status == 'stale'
+
+        # the rerun recomputes them
+        spectral_decomposition(self.fused_name, bands_vals, phase=True,
+                               block_size=2.)
+        status, _ = stage_status(self.fused_name, 'decomposition',
+                                 decomposition_config)
+        assert status == 'current'
+        with NWBHDF5IO(self.fused_name, 'r') as io:
+            ecephys = io.read().processing['ecephys'].data_interfaces
+            assert np.all(ecephys['DecompositionSeries'].data[-400:] > 0)
+            assert np.any(ecephys['DecompositionSeries_phase'].data[-400:])
+
+
+class BipolarReferencingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.name = 'ecephys_synthetic_bipolar.nwb'
+        make_raw_nwb(self.name, n_channels=9, duration=10.)
+
+    def tearDown(self):
+        try:
+            os.remove(self.name)
+        except FileNotFoundError as e:
+            pass
+
+    def make_electrodes(self, grid_size, n_strip=0, lattice=True):
+        nwbfile = NWBFile(session_description='synthetic', identifier='synthetic',
+                          session_start_time=datetime.now(tzlocal()))
+        device = nwbfile.create_device(name='device')
+        nwbfile.add_electrode_column(name='label', description='label')
+        nwbfile.add_electrode_column(name='bad', description='bad channel')
+        n_grid = int(np.prod(grid_size))
+        for name, n in [('grid', n_grid), ('strip', n_strip)]:
+            group = nwbfile.create_electrode_group(name=name, description='',
+                                                   location=name, device=device)
+            for i in range(n):
+                # Chang lab numbering of the grid, from the last electrode
+                x, y = divmod(n_grid - 1 - i, grid_size[1])[::-1]
+                if name == 'strip':
+                    x, y = i, -1
+                elif not lattice:
+                    x, y = 0, 0
+                nwbfile.add_electrode(x=float(x), y=float(y), z=3.,
+                                      imp=np.nan,
+                                      location='area{}'.format(i // 5),
+                                      filtering='none', group=group,
+                                      label='{}{}'.format(name, i),
+                                      bad=i == 4)
+        return nwbfile.create_electrode_table_region(
+            list(range(n_grid + n_strip)), 'all')
+
+    def expected(self, X, electrodes, grid_size):
+        """Bipolar channels and metadata, electrode by electrode."""
+        table = electrodes.table
+        layout = np.arange(np.prod(grid_size) - 1, -1, -1).reshape(grid_size).T
+        pairs = []
+        for i in range(layout.shape[0]):
+            for j in range(layout.shape[1]):
+                if j < layout.shape[1] - 1:
+                    pairs.append((layout[i, j], layout[i, j + 1]))
+                if i < layout.shape[0] - 1:
+                    pairs.append((layout[i, j], layout[i + 1, j]))
+        XX = np.array([X[a] - X[c] for a, c in pairs])
+        labels = ['-'.join([table['label'][a], table['label'][c]])
+                  for a, c in pairs]
+        bad = [table['bad'][a] or table['bad'][c] for a, c in pairs]
+        return XX, labels, bad
+
+    def test_bipolar_pairs(self):
+        X = np.random.RandomState(0).randn(12, 100)
+        cases = [((4, 3), 0, True, None), ((3, 4), 0, True, None),
+                 ((3, 3), 3, False, None), ((4, 3), 0, False, (4, 3))]
+        for grid_size, n_strip, lattice, given in cases:
+            electrodes = self.make_electrodes(grid_size, n_strip, lattice)
+            XX, table, region = get_bipolar_referenced_electrodes(
+                X, electrodes, 400., grid_size=given)
+            XX_expected, labels, bad = self.expected(X, electrodes, grid_size)
+            n = 2 * np.prod(grid_size) - np.sum(grid_size)
+            assert XX.shape == (n, 100)
+            np.testing.assert_array_equal(XX, XX_expected)
+            assert list(table['label'].data) == labels
+            assert list(table['bad'].data) == bad
+            assert len(region.data) == n
+
+    def test_preprocess_bipolar(self):
+        config = {
+            'referencing': ('bipolar', True),
+            'Notch': 60,
+            'Downsample': 400.
+        }
+        preprocess_raw_data(self.name, config)
+        with NWBHDF5IO(self.name, 'r') as io:
+            nwbfile = io.read()
+            ecephys = nwbfile.processing['ecephys'].data_interfaces
+            lfp = ecephys['LFP'].electrical_series['preprocessed']
+            assert lfp.data.shape == (4000, 12)
+            assert len(ecephys['bipolar-referenced metadata']) == 12
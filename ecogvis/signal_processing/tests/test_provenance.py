@@ -0,0 +1,151 @@
+import numpy as np
+from pynwb import NWBHDF5IO
+from ecogvis.signal_processing import processing_data
+from ecogvis.signal_processing.processing_data import preprocess_raw_data, \
+    high_gamma_estimation
+from ecogvis.signal_processing.periodogram import psd_estimate
+from ecogvis.signal_processing.provenance import parse_comments, \
+    stage_provenance, stage_status
+import json
+import unittest
+from unittest import mock
+import tempfile
+import shutil
+import os
+
+from synthetic_nwb import make_block
+
+
+def test_stage_provenance():
+    source = {'object_id': 'abc', 'shape': [10, 2]}
+    p1 = stage_provenance('preprocess', {'Notch': 60, 'n_jobs': 1}, source)
+    p2 = stage_provenance('preprocess', {'Notch': 60, 'n_jobs': 4}, source)
+    p3 = stage_provenance('preprocess', {'Notch': 50}, source)
+    assert p1['hash'] == p2['hash']
+    assert p1['hash'] != p3['hash']
+    # block size of the streaming preprocessing, e.g. chosen by memory_plan
+    p5 = stage_provenance('preprocess', {'Notch': 60, 'block_size': 10.},
+                          source)
+    assert p1['hash'] == p5['hash']
+    assert stage_provenance('decomposition', {'block_size': 10.},
+                            source)['hash'] != \
+        stage_provenance('decomposition', {}, source)['hash']
+    bands = np.array([[70., 80.], [5., 6.]])
+    p4 = stage_provenance('high_gamma', {'bands_vals': bands}, {'LFP': 'x'})
+    assert parse_comments(json.dumps(p4)) == p4
+
+
+def test_parse_legacy_comments():
+    provenance = parse_comments("referencing:('CAR', 16), Notch:60, Downsampled:400.0")
+    assert provenance['config']['referencing'] == ('CAR', 16)
+    assert provenance['config']['Notch'] == 60.
+    assert 'hash' not in provenance
+    provenance = parse_comments('referencing:None, Notch:None, Downsampled:No')
+    assert provenance['config'] == {'referencing': None, 'Notch': None,
+                                    'Downsample': None}
+    assert parse_comments('no comments') is None
+
+
+class StageStatusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.block_path = os.path.join(self.path, 'EC1_B1.nwb')
+        make_block(self.block_path)
+        self.config = {'referencing': ('CAR', 2), 'Notch': 60,
+                       'Downsample': 400.}
+        self.bands_vals = np.array([[80., 100.], [10., 12.]])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self):
+        with NWBHDF5IO(self.block_path, 'r') as io:
+            ecephys = io.read().processing['ecephys']
+            lfp = ecephys.data_interfaces['LFP'].electrical_series['preprocessed']
+            hg = ecephys.data_interfaces.get('high_gamma')
+            return lfp.data[:], None if hg is None else hg.data[:]
+
+    def test_rerun(self):
+        assert stage_status(self.block_path, 'preprocess', self.config)[0] == 'missing'
+        preprocess_raw_data(self.block_path, self.config)
+        high_gamma_estimation(self.block_path, self.bands_vals)
+        assert stage_status(self.block_path, 'preprocess', self.config)[0] == 'current'
+        lfp, hg = self.read()
+
+        # same inputs, nothing is recomputed
+        preprocess_raw_data(self.block_path, self.config)
+        high_gamma_estimation(self.block_path, self.bands_vals)
+        lfp2, hg2 = self.read()
+        np.testing.assert_array_equal(lfp, lfp2)
+        np.testing.assert_array_equal(hg, hg2)
+
+        # changed bands, only High Gamma is stale
+        bands_vals = self.bands_vals + 1.
+        status, _ = stage_status(self.block_path, 'high_gamma',
+                                 {'bands_vals': bands_vals, 'dtype': 'complex128'})
+        assert status == 'stale'
+        high_gamma_estimation(self.block_path, bands_vals)
+        lfp2, hg2 = self.read()
+        np.testing.assert_array_equal(lfp, lfp2)
+        assert not np.array_equal(hg, hg2)
+
+        # changed preprocessing, LFP is recomputed and High Gamma removed
+        config = dict(self.config, Notch=50)
+        assert stage_status(self.block_path, 'preprocess', config)[0] == 'stale'
+        preprocess_raw_data(self.block_path, config)
+        lfp2, hg2 = self.read()
+        assert not np.array_equal(lfp, lfp2)
+        assert hg2 is None
+        assert stage_status(self.block_path, 'preprocess', config)[0] == 'current'
+
+    def test_rerun_psd(self):
+        preprocess_raw_data(self.block_path, self.config)
+        psd_estimate(self.block_path, 'raw')
+        psd_estimate(self.block_path, 'preprocessed')
+        for stage in ['psd_raw', 'psd_preprocessed']:
+            status, _ = stage_status(self.block_path, stage, {'type': stage[4:]})
+            assert status == 'current'
+        # same inputs, the spectra are not written again
+        psd_estimate(self.block_path, 'preprocessed')
+
+        # changed preprocessing, the spectra of the LFP are removed, and
+        # those of the raw signals are kept
+        config = dict(self.config, Notch=50)
+        preprocess_raw_data(self.block_path, config)
+        with NWBHDF5IO(self.block_path, 'r') as io:
+            names = set(io.read().processing['ecephys'].data_interfaces)
+        assert 'Spectrum_fft_preprocessed' not in names
+        assert 'Spectrum_welch_preprocessed' not in names
+        assert {'Spectrum_fft_raw', 'Spectrum_welch_raw'} <= names
+        status, _ = stage_status(self.block_path, 'psd_preprocessed',
+                                 {'type': 'preprocessed'})
+        assert status == 'missing'
+        psd_estimate(self.block_path, 'preprocessed')
+        status, _ = stage_status(self.block_path, 'psd_preprocessed',
+                                 {'type': 'preprocessed'})
+        assert status == 'current'
+
+    def test_interrupted_write(self):
+        # the streaming preprocessing fails after writing 2 of the 5 blocks
+        config = dict(self.config, block_size=1.)
+        notch = processing_data.apply_linenoise_notch
+        calls = []
+
+        def failing_notch(*args, **kwargs):
+            calls.append(1)
+            if len(calls) > 2:
+                raise MemoryError()
+            return notch(*args, **kwargs)
+
+        with mock.patch.object(processing_data, 'apply_linenoise_notch',
+                               failing_notch):
+            with self.assertRaises(MemoryError):
+                preprocess_raw_data(self.block_path, config)
+        assert stage_status(self.block_path, 'preprocess', config)[0] == 'stale'
+
+        # the rerun recomputes the incomplete LFP
+        preprocess_raw_data(self.block_path, config)
+        assert stage_status(self.block_path, 'preprocess', config)[0] == 'current'
+        lfp, _ = self.read()
+        assert np.all(np.any(lfp[-400:] != 0, axis=0))
@@ -0,0 +1,53 @@
+import numpy as np
+from scipy.signal import resample_poly
+from ecogvis.signal_processing.resample import Resampler, resample, \
+    resample_ratio
+
+
+def test_resample_ratio():
+    assert resample_ratio(400., 3051.7578125) == (2048, 15625)
+    assert resample_ratio(800., 24000.) == (1, 30)
+    assert resample_ratio(400., 400. * np.pi) == (None, None)
+
+
+def test_resampler_matches_resample_poly():
+    X = np.random.RandomState(0).randn(3000, 3)
+    for up, down in [(1, 30), (2048, 15625), (3, 2)]:
+        Y = Resampler(up, down, pad='constant').process(X, last=True)
+        np.testing.assert_allclose(Y, resample_poly(X, up, down, axis=0),
+                                   atol=1e-12)
+
+
+def test_resample_float32():
+    X = np.random.RandomState(2).randn(5000, 2)
+    Y64 = resample(X, 400., 3051.7578125)
+    for method in ['poly', 'fft']:
+        Y32 = resample(X.astype('float32'), 400., 3051.7578125,
+                       method=method, dtype='float32')
+        assert Y32.dtype == np.float32
+        if method == 'poly':
+            np.testing.assert_allclose(Y32, Y64, atol=1e-5)
+
+
+def test_resampler_chunks():
+    X = np.random.RandomState(1).randn(10000, 2)
+    whole = Resampler(2048, 15625).process(X, last=True)
+    resampler = Resampler(2048, 15625)
+    bounds = [0, 777, 780, 4000, 9000, 10000]
+    chunks = [resampler.process(X[b0:b1], last=b1 == len(X))
+              for b0, b1 in zip(bounds[:-1], bounds[1:])]
+    assert whole.shape == (int(np.ceil(10000 * 2048 / 15625)), 2)
+    np.testing.assert_allclose(np.concatenate(chunks), whole, atol=1e-12)
+
+
+def test_resample_sinusoid():
+    fs, new_rate = 3051.7578125, 400.
+    t = np.arange(int(10 * fs)) / fs
+    X = np.sin(2 * np.pi * 13. * t)
+    Y = resample(X, new_rate, fs)
+    t_new = np.arange(len(Y)) / new_rate
+    np.testing.assert_allclose(Y, np.sin(2 * np.pi * 13. * t_new), atol=1e-2)
+    # irrational ratios fall back to the FFT resampling
+    new_rate = 400. * np.sqrt(2)
+    np.testing.assert_array_equal(resample(X, new_rate, fs, method='auto'),
+                                  resample(X, new_rate, fs, method='fft'))
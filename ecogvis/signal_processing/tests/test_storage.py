@@ -0,0 +1,117 @@
+import numpy as np
+import h5py
+import pytest
+from ecogvis.signal_processing.processing_data import preprocess_raw_data, \
+    spectral_decomposition, high_gamma_estimation, preprocess_high_gamma
+from ecogvis.signal_processing.provenance import stage_status
+from ecogvis.signal_processing.storage import storage_chunks, \
+    storage_options
+import unittest
+import tempfile
+import shutil
+import os
+
+from synthetic_nwb import make_block
+
+
+def test_storage_chunks():
+    assert storage_chunks((4000, 64), 400.) == (400, 16)
+    assert storage_chunks((4000, 8, 10), 400.) == (400, 8, 1)
+    assert storage_chunks((100, 64), 400., {'chunk_duration': 2.}) == (100, 16)
+    assert storage_chunks((4000, 64), 400., {'chunk_duration': None}) is None
+
+
+def test_storage_options():
+    options = storage_options({'compression': 'lzf'})
+    assert options['compression_opts'] is None
+    assert storage_options({'compression': 'gzip'})['compression_opts'] == 4
+    with pytest.raises(ValueError):
+        storage_options({'compression': 'szip'})
+    with pytest.raises(ValueError):
+        storage_options({'compression': 'gzip', 'compression_opts': 12})
+    with pytest.raises(ValueError):
+        storage_options({'chunk_duration': None, 'compression': 'gzip'})
+    with pytest.raises(ValueError):
+        storage_options({'chunks': (10, 10)})
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.block_path = os.path.join(self.path, 'EC1_B1.nwb')
+        make_block(self.block_path, n_channels=20)
+        self.config = {'referencing': ('CAR', 4), 'Notch': 60,
+                       'Downsample': 400.}
+        self.bands_vals = np.array([[80., 100.], [10., 12.]])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def datasets(self, path):
+        """Chunks, compression and data of the derived datasets."""
+        out = {}
+        with h5py.File(path, 'r') as f:
+            ecephys = f['processing/ecephys']
+            for name in ['LFP/preprocessed', 'DecompositionSeries',
+                         'high_gamma']:
+                if name in ecephys:
+                    dset = ecephys[name + '/data']
+                    out[name] = (dset.chunks, dset.compression, dset.shuffle,
+                                 dset[:])
+        return out
+
+    def test_default_storage(self):
+        preprocess_raw_data(self.block_path, self.config)
+        spectral_decomposition(self.block_path, self.bands_vals)
+        high_gamma_estimation(self.block_path, self.bands_vals)
+        out = self.datasets(self.block_path)
+        assert out['LFP/preprocessed'][:3] == ((400, 16), None, False)
+        assert out['DecompositionSeries'][:3] == ((400, 16, 1), None, False)
+        assert out['high_gamma'][:3] == ((400, 16), None, False)
+
+    def test_compressed_storage(self):
+        copy_path = os.path.join(self.path, 'EC1_B2.nwb')
+        shutil.copy(self.block_path, copy_path)
+        storage = {'chunk_duration': .5, 'chunk_channels': 8,
+                   'compression': 'gzip', 'compression_opts': 1,
+                   'shuffle': True}
+        preprocess_raw_data(self.block_path, dict(self.config, storage=storage))
+        spectral_decomposition(self.block_path, self.bands_vals,
+                               storage=storage)
+        high_gamma_estimation(self.block_path, self.bands_vals,
+                              storage={'compression': 'lzf'})
+        # the storage does not change the provenance
+        assert stage_status(self.block_path, 'preprocess',
+                            self.config)[0] == 'current'
+
+        contiguous = {'chunk_duration': None}
+        preprocess_raw_data(copy_path, dict(self.config, storage=contiguous))
+        spectral_decomposition(copy_path, self.bands_vals, storage=contiguous)
+        high_gamma_estimation(copy_path, self.bands_vals, storage=contiguous)
+
+        out = self.datasets(self.block_path)
+        ref = self.datasets(copy_path)
+        assert out['LFP/preprocessed'][:3] == ((200, 8), 'gzip', True)
+        assert out['DecompositionSeries'][:3] == ((200, 8, 1), 'gzip', True)
+        assert out['high_gamma'][:3] == ((400, 16), 'lzf', False)
+        for name in out:
+            assert ref[name][0] is None
+            np.testing.assert_array_equal(out[name][3], ref[name][3])
+
+    def test_streaming_storage(self):
+        storage = {'chunk_duration': 2., 'compression': 'gzip'}
+        preprocess_high_gamma(self.block_path,
+                              dict(self.config, block_size=None,
+                                   storage=storage),
+                              bands_vals=self.bands_vals)
+        out = self.datasets(self.block_path)
+        assert out['LFP/preprocessed'][:2] == ((800, 16), 'gzip')
+        assert out['high_gamma'][:2] == ((800, 16), 'gzip')
+
+        copy_path = os.path.join(self.path, 'EC1_B2.nwb')
+        make_block(copy_path, n_channels=20)
+        preprocess_raw_data(copy_path, dict(self.config, block_size=2.,
+                                            storage=storage))
+        assert self.datasets(copy_path)['LFP/preprocessed'][:2] == \
+            ((800, 16), 'gzip')
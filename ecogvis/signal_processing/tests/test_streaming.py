@@ -0,0 +1,73 @@
+import numpy as np
+import h5py
+import pytest
+import os
+from ecogvis.signal_processing.streaming import BlockReader, \
+    channel_blocks, channel_bounds, circular_blocks, circular_window, rational_period, \
+    time_blocks, with_chunk_cache
+
+
+def test_rational_period():
+    assert rational_period(3051.7578125, 400.) == (15625, 2048)
+    assert rational_period(24000., 800.) == (30, 1)
+    assert rational_period(400., 400.) == (1, 1)
+    # the period of an inexact rate stays short, and is not exact
+    n_old, n_new = rational_period(1017.2526, 400.)
+    assert n_old <= 2**16
+    assert not np.isclose(n_new * 1017.2526, n_old * 400., rtol=1e-12, atol=0)
+
+
+def test_time_blocks():
+    blocks = list(time_blocks(10, 4, context=1))
+    assert blocks == [(0, 4, 0, 5), (4, 8, 3, 9), (8, 10, 7, 10)]
+
+
+def test_circular_blocks():
+    X = np.arange(10)
+    blocks = [(start, stop, list(Xb))
+              for start, stop, Xb in circular_blocks(X, 4, 1)]
+    assert blocks == [(0, 4, [9, 0, 1, 2, 3, 4]), (4, 8, [3, 4, 5, 6, 7, 8]),
+                      (8, 10, [7, 8, 9, 0, 1, 2])]
+    assert list(circular_window(X, -2, 3)) == [8, 9, 0, 1, 2]
+    assert list(circular_window(X, 7, 12)) == [7, 8, 9, 0, 1]
+    assert list(circular_window(X, 2, 5)) == [2, 3, 4]
+
+
+def test_block_reader():
+    X = np.arange(19.)
+    reader = BlockReader((X[i:i + 3] for i in range(0, 19, 3)), X.shape,
+                         X.dtype, head=8, tail=X[-2:])
+    # the blocks are written while the signal is read in circular blocks
+    written = []
+    blocks = reader.blocks()
+    for (_, _, Xr), (_, _, Xb) in zip(circular_blocks(reader, 4, 2),
+                                      circular_blocks(X, 4, 2)):
+        np.testing.assert_array_equal(Xr, Xb)
+        written.append(next(blocks))
+    written.extend(blocks)
+    np.testing.assert_array_equal(np.concatenate(written), X)
+    with pytest.raises(ValueError):
+        reader[10:12]
+
+
+def test_channel_blocks():
+    file_name = 'test_channel_blocks.h5'
+    X = np.random.RandomState(0).randn(1000, 10)
+    try:
+        with h5py.File(file_name, 'w') as f:
+            dset = f.create_dataset('data', data=X, chunks=(100, 4),
+                                    compression='gzip')
+
+            # blocks are aligned to the chunks
+            assert channel_bounds(dset, 9) == [(0, 8), (8, 10)]
+            assert channel_bounds(dset, 2) == [(0, 4), (4, 8), (8, 10)]
+            assert channel_bounds(X, 4) == [(0, 4), (4, 8), (8, 10)]
+
+            slabs = [Xs for _, _, Xs in channel_blocks(dset, max_bytes=8000 * 5)]
+            assert [Xs.shape[1] for Xs in slabs] == [4, 4, 2]
+            np.testing.assert_array_equal(np.hstack(slabs), X)
+
+            cached = with_chunk_cache(dset, n_time=300)
+            np.testing.assert_array_equal(cached[250:750], X[250:750])
+    finally:
+        os.remove(file_name)
@@ -38,6 +38,7 @@ setup(
         'ndx-icephys-meta',
         'ndx-hierarchical-behavioral-data'],
     entry_points={
-        'console_scripts': ['ecogvis=ecogvis.ecogvis:cmd_line_shortcut'],
+        'console_scripts': ['ecogvis=ecogvis.ecogvis:cmd_line_shortcut',
+                            'ecogvis-batch=ecogvis.signal_processing.batch_processing:cmd_line_shortcut'],
     }
 )